@@ -1,4 +1,46 @@
-from .api import capture, pay, payouts, refund, status, status_change, void
-from .utils import order_to_xml, xml_to_string, xml_get_sha512, xml_check_sha512
-from .settings import test_settings, live_settings
-from .cardpay import CardPay
+# Public names are imported lazily on first access (PEP 562), so
+# ``import PyCardPay`` doesn't load lxml and requests until they are needed.
+import importlib
+
+_exports = {
+    'capture': 'api',
+    'pay': 'api',
+    'payouts': 'api',
+    'refund': 'api',
+    'status': 'api',
+    'status_change': 'api',
+    'void': 'api',
+    'order_to_xml': 'utils',
+    'xml_to_string': 'utils',
+    'xml_get_sha512': 'utils',
+    'xml_check_sha512': 'utils',
+    'xml_sign': 'utils',
+    'test_settings': 'settings',
+    'live_settings': 'settings',
+    'CardPay': 'cardpay',
+    'TransactionStore': 'store',
+    'CardPayRegistry': 'registry',
+}
+
+# Submodules that used to be loaded by ``import PyCardPay``
+_submodules = ('api', 'cardpay', 'exceptions', 'settings', 'utils')
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    try:
+        module = _exports[name]
+    except KeyError:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name)
+        )
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
@@ -0,0 +1,28 @@
+# coding=utf-8
+"""Command line tools: ``python -m PyCardPay <command> ...``
+
+Commands:
+
+* ``export`` -- export payments, refunds or payouts, see :mod:`PyCardPay.export`
+"""
+
+import sys
+
+from . import export
+
+COMMANDS = {
+    'export': export.main,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        sys.stderr.write('usage: python -m PyCardPay {{{}}} ...\n'.format(
+            ','.join(sorted(COMMANDS))))
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+# coding=utf-8
+"""One-pass aggregation of transaction rows for dashboards.
+
+:class:`Aggregator` consumes rows as list iterators yield them (see
+:func:`PyCardPay.api.iter_payments`) and keeps one small partial result per
+group: row count, declined count, amounts in exact integer minor units per
+currency and approximate distinct counts (:class:`HyperLogLog`) of fields
+such as customer id. Partial results of aggregators with the same
+parameters can be merged, so windows fetched in parallel (see
+:func:`fetch`), in other processes (aggregators can be pickled) or on other
+days are combined without going back to the rows.
+
+Rows can be grouped by any row field and by derived keys:
+
+* ``hour`` -- epoch milliseconds of the start of the hour of 'date'
+* ``day`` -- epoch milliseconds of the start of the UTC day of 'date'
+
+Usage example:
+
+>>> from PyCardPay.aggregate import Aggregator
+>>> aggregator = Aggregator(group_by=('hour', 'state', 'currency'))
+>>> aggregator.update(client.iter_payments(start_millis, end_millis))
+20000
+>>> aggregator.results()[0]
+{'hour': 1444647600000, 'state': 'COMPLETED', 'currency': 'EUR', 'count': 93,
+ 'declined': 0, 'decline_rate': 0.0, 'amounts': {'EUR': 4721053}, 'invalid': 0,
+ 'distinct': {'customers': 91}}
+>>> aggregator.merge(other_aggregator)
+"""
+
+import hashlib
+import math
+import operator
+
+from . import api
+from .currencies import to_minor
+from .store import KINDS
+
+# Default distinct counts: name -> row field
+DISTINCT = {'customers': 'customerId'}
+
+# Default number of HyperLogLog index bits; 2 ** 12 one-byte registers per
+# counter with about 1.6% standard error
+DEFAULT_PRECISION = 12
+
+DECLINED = 'DECLINED'
+
+_HOUR = 60 * 60 * 1000
+_DAY = 24 * _HOUR
+
+
+def _hour(row):
+    date = row.get('date')
+    return None if date is None else int(date) // _HOUR * _HOUR
+
+
+def _day(row):
+    date = row.get('date')
+    return None if date is None else int(date) // _DAY * _DAY
+
+
+# Derived group keys
+KEYS = {
+    'hour': _hour,
+    'day': _day,
+}
+
+
+def _hash(value):
+    """Returns 64-bit hash of *value*, the same in every process"""
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(),
+                          'big')
+
+
+class HyperLogLog:
+    """Approximate distinct counter using ``2 ** precision`` bytes.
+
+    Counters of the same precision are merged with :meth:`merge`; the result
+    is the same as if all values had been added to one counter.
+
+    :param precision: (optional) Number of index bits, 4-16
+    :type precision: int
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be 4-16')
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        h = _hash(value)
+        bits = 64 - self.precision
+        index = h >> bits
+        # Position of the leftmost 1 in the remaining bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge counters of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Returns estimated number of distinct values"""
+        m = len(self.registers)
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class _Group:
+    """Partial result of one group"""
+
+    __slots__ = ('count', 'declined', 'amounts', 'invalid', 'sketches')
+
+    def __init__(self, distinct):
+        self.count = 0
+        self.declined = 0
+        # currency -> sum in minor units
+        self.amounts = {}
+        # Rows whose amount couldn't be converted
+        self.invalid = 0
+        self.sketches = [None] * distinct
+
+
+class Aggregator:
+    """Groups rows and sums them up in one pass.
+
+    :param group_by: (optional) Row fields and derived keys (see :data:`KEYS`) rows are grouped by
+    :type group_by: tuple
+    :param distinct: (optional) Approximate distinct counts, name -> row field
+    :type distinct: dict
+    :param precision: (optional) Index bits of distinct counters, see :class:`HyperLogLog`
+    :type precision: int
+    """
+
+    def __init__(self, group_by=('state', 'currency'), distinct=DISTINCT,
+                 precision=DEFAULT_PRECISION):
+        self.group_by = tuple(group_by)
+        self.distinct = dict(distinct)
+        self.precision = precision
+        self._distinct_fields = [field for _, field in
+                                 sorted(self.distinct.items())]
+        # group key -> _Group
+        self._groups = {}
+
+    def _getters(self):
+        return [KEYS.get(name) or operator.methodcaller('get', name)
+                for name in self.group_by]
+
+    def __getstate__(self):
+        return {'group_by': self.group_by, 'distinct': self.distinct,
+                'precision': self.precision,
+                'groups': dict((key, (g.count, g.declined, g.amounts,
+                                      g.invalid, g.sketches))
+                               for key, g in self._groups.items())}
+
+    def __setstate__(self, state):
+        self.__init__(state['group_by'], state['distinct'],
+                      state['precision'])
+        for key, values in state['groups'].items():
+            group = self._groups[key] = _Group(len(self.distinct))
+            (group.count, group.declined, group.amounts, group.invalid,
+             group.sketches) = values
+
+    def update(self, rows):
+        """Adds *rows*, e.g. an iterator returned by :func:`PyCardPay.api.iter_payments`
+
+        :param rows: Transactions
+        :type rows: iterable of dicts
+        :returns: int -- Number of added rows
+        """
+        getters = self._getters()
+        fields = self._distinct_fields
+        groups = self._groups
+        distinct = len(fields)
+        count = 0
+        for row in rows:
+            key = tuple([getter(row) for getter in getters])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _Group(distinct)
+            group.count += 1
+            if row.get('state') == DECLINED:
+                group.declined += 1
+            currency = row.get('currency')
+            try:
+                amount = to_minor(row['amount'], currency)
+            except (KeyError, ValueError, TypeError, AttributeError):
+                group.invalid += 1
+            else:
+                currency = currency.upper()
+                group.amounts[currency] = \
+                    group.amounts.get(currency, 0) + amount
+            for n in range(distinct):
+                value = row.get(fields[n])
+                if value is not None:
+                    sketch = group.sketches[n]
+                    if sketch is None:
+                        sketch = group.sketches[n] = \
+                            HyperLogLog(self.precision)
+                    sketch.add(value)
+            count += 1
+        return count
+
+    def add(self, row):
+        """Adds one row"""
+        self.update((row,))
+
+    def merge(self, other):
+        """Adds partial results of *other*, an aggregator with the same parameters
+
+        :type other: :class:`Aggregator`
+        :returns: :class:`Aggregator` -- self
+        """
+        if (other.group_by, other.distinct, other.precision) != \
+                (self.group_by, self.distinct, self.precision):
+            raise ValueError('Cannot merge aggregators with different '
+                             'parameters')
+        groups = self._groups
+        for key, theirs in other._groups.items():
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _Group(len(self._distinct_fields))
+            group.count += theirs.count
+            group.declined += theirs.declined
+            group.invalid += theirs.invalid
+            for currency, amount in theirs.amounts.items():
+                group.amounts[currency] = \
+                    group.amounts.get(currency, 0) + amount
+            for n, sketch in enumerate(theirs.sketches):
+                if sketch is None:
+                    continue
+                if group.sketches[n] is None:
+                    group.sketches[n] = HyperLogLog(self.precision)
+                group.sketches[n].merge(sketch)
+        return self
+
+    def results(self):
+        """Returns aggregates of all groups, ordered by group key.
+
+        :returns: list of dicts
+
+        Dict structure:
+
+        >>> {
+            'state': 'DECLINED', 'currency': 'USD',  # values of group_by keys
+            'count': 120,           # Number of rows
+            'declined': 120,        # Rows in state 'DECLINED'
+            'decline_rate': 1.0,    # declined / count
+            'amounts': {'USD': 1823050},  # Sums in minor units per currency
+            'invalid': 0,           # Rows without valid amount and currency
+            'distinct': {'customers': 117},  # Approximate distinct counts
+        }
+        """
+        names = sorted(self.distinct)
+        result = []
+        for key in sorted(self._groups, key=_sort_key):
+            group = self._groups[key]
+            item = dict(zip(self.group_by, key))
+            item.update(
+                count=group.count,
+                declined=group.declined,
+                decline_rate=float(group.declined) / group.count
+                if group.count else 0.0,
+                amounts=dict(group.amounts),
+                invalid=group.invalid,
+                # Estimates can't exceed the number of rows
+                distinct=dict(
+                    (name, min(sketch.count(), group.count)
+                     if sketch is not None else 0)
+                    for name, sketch in zip(names, group.sketches)
+                ),
+            )
+            result.append(item)
+        return result
+
+
+def _sort_key(key):
+    # None and values of different types sort without errors
+    return tuple((value is not None, str(type(value)), value)
+                 for value in key)
+
+
+def fetch(client, start_millis, end_millis, kind='payments',
+          window=_DAY, max_in_flight=4, max_count=None, **kwargs):
+    """Aggregates transactions of a period, fetching windows in parallel.
+
+    Every window is aggregated separately while it's fetched and the
+    partial results are merged, rows are never held in memory.
+
+    :param client: Client providing credentials, wallet and settings
+    :type client: :class:`PyCardPay.CardPay`
+    :param kind: (optional) 'payments', 'refunds' or 'payouts'
+    :param window: (optional) Length of a window in milliseconds
+    :type window: int
+    :param max_in_flight: (optional) Windows fetched at the same time
+    :type max_in_flight: int
+    :param kwargs: :class:`Aggregator` parameters
+    :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+    :returns: :class:`Aggregator`
+    """
+    from .bulk import imap_unordered
+
+    url = getattr(client.settings, KINDS[kind])
+
+    def aggregate(period):
+        aggregator = Aggregator(**kwargs)
+        aggregator.update(api._iter_list(
+            url, client.client_login, client.client_password, period[0],
+            period[1], wallet_id=client.wallet_id, max_count=max_count,
+            transport=client.transport
+        ))
+        return aggregator
+
+    windows = ((start, min(start + window, end_millis))
+               for start in range(int(start_millis), int(end_millis), window))
+    result = Aggregator(**kwargs)
+    for period, aggregator, exc in imap_unordered(aggregate, windows,
+                                                  max_in_flight):
+        if exc is not None:
+            raise exc
+        result.merge(aggregator)
+    return result
@@ -7,24 +7,30 @@ except ImportError:
     from urllib.parse import urlencode
 from datetime import datetime
 
-import requests
-from lxml import etree
-
 from .exceptions import (
     XMLParsingError, JSONParsingError, HTTPError, TransactionNotFound,
-    CommunicationError,
 )
+from . import hooks, metrics
 from .utils import (
-    xml_to_string, xml_get_sha512, make_http_request, xml_http_request,
+    xml_sign, make_http_request, xml_http_request, parse_xml_response,
     parse_order,
 )
 from .settings import live_settings
+from .transport import send
 
 
 PAY_TIMEOUT = (3, 7)
+# Longest period (in milliseconds) accepted by list endpoints
+MAX_LIST_PERIOD = 7 * 24 * 60 * 60 * 1000 - 1
+# Transaction states (payments, refunds and payouts) that end processing.
+# CHARGED_BACK isn't one, it may still turn into CHARGEBACK_RESOLVED.
+FINAL_STATES = frozenset([
+    'COMPLETED', 'DECLINED', 'CANCELLED', 'VOIDED', 'REFUNDED',
+    'CHARGEBACK_RESOLVED',
+])
 
 
-def status_change(settings=live_settings, **kwargs):
+def status_change(settings=live_settings, transport=None, **kwargs):
     """Change transaction status.
 
     :param id: Transaction id
@@ -38,6 +44,8 @@ def status_change(settings=live_settings, **kwargs):
     :type reason: str|unicode
     :param amount: (optional) Refund amount in transaction currency. If not set then full refund will be made
     :type amount: Decimal|int
+    :param transport: (optional) Transport to use instead of the default one
+    :type transport: :class:`PyCardPay.transport.Transport`
     :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.XMLParsingError`
     :returns: dict
 
@@ -65,13 +73,15 @@ def status_change(settings=live_settings, **kwargs):
     | authorize     | void         |
     +---------------+--------------+
     """
-    xml = xml_http_request(settings.url_status_change, 'post', **kwargs)
+    xml = xml_http_request(settings.url_status_change, 'post',
+                           transport=transport, endpoint='status_change',
+                           **kwargs)
     if xml.get('is_executed') != 'yes':
         return {'is_executed': False, 'details': xml.get('details')}
     return {'is_executed': True, 'details': ''}
 
 
-def status(settings=live_settings, **kwargs):
+def status(settings=live_settings, transport=None, **kwargs):
     """Get transactions report
 
     :param client_login: Unique store id. It is the same as for administrative interface.
@@ -110,7 +120,8 @@ def status(settings=live_settings, **kwargs):
         ]
     }
     """
-    xml = xml_http_request(settings.url_status, 'post', **kwargs)
+    xml = xml_http_request(settings.url_status, 'post', transport=transport,
+                           endpoint='status', **kwargs)
     data = {'is_executed': True, 'details': '', 'orders': []}
 
     if xml.get('is_executed') != 'yes':
@@ -160,7 +171,7 @@ def capture(settings=live_settings, **kwargs):
     return status_change(settings=settings, **kwargs)
 
 
-def pay(xml, secret, settings=live_settings):
+def pay(xml, secret, settings=live_settings, transport=None):
     """Process payment
 
     :param xml: Order XML created with :func:`PyCardPay.utils.order_to_xml`
@@ -177,18 +188,30 @@ def pay(xml, secret, settings=live_settings):
         'url':  '...',              # URL you need to redirect customer to
     }
     """
-    order_xml = xml_to_string(xml, encode_base64=True)
-    order_sha = xml_get_sha512(xml, secret)
-    data = {'orderXML': order_xml, 'sha512': order_sha}
+    started = metrics.phase_started()
+    order_xml, order_sha = xml_sign(xml, secret)
+    metrics.phase_done('pay', 'sign', started)
+    return pay_signed(order_xml, order_sha, settings=settings,
+                      transport=transport)
+
+
+def pay_signed(order_xml, sha512, settings=live_settings, transport=None):
+    """Process payment with order already signed
+
+    :param order_xml: Base64 encoded order XML, see :func:`PyCardPay.utils.xml_sign`
+    :type order_xml: bytes|str
+    :param sha512: SHA512 checksum of order XML and secret
+    :type sha512: str
+    :raises: :class:`PyCardPay.exceptions.XMLParsingError` if response contains unknown xml structure.
+    :returns: dict -- see :func:`pay`
+    """
+    data = {'orderXML': order_xml, 'sha512': sha512}
+    event = hooks.start('pay', 'POST', settings.url_pay, data)
     r = make_http_request(settings.url_pay, method='post',
-                          http_timeout=PAY_TIMEOUT, **data)
-    try:
-        r_xml = etree.fromstring(r)
-    except etree.Error as e:
-        raise XMLParsingError(
-            u'Failed to parse response from CardPay service: {}'.format(e),
-            method='post', url=settings.url_pay, data=data, content=r
-        )
+                          http_timeout=PAY_TIMEOUT, transport=transport,
+                          endpoint='pay', event=event, **data)
+    r_xml = parse_xml_response(r, event, method='post', url=settings.url_pay,
+                               data=data)
     if r_xml.tag == 'redirect':
         return {
             'url': r_xml.get('url'),
@@ -202,8 +225,63 @@ def pay(xml, secret, settings=live_settings):
     )
 
 
+def _endpoint(base_url):
+    """Returns endpoint name of a v2 API url, e.g. 'payments'"""
+    return base_url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def _fail(event, error):
+    """Reports *error* to *event* of the request and raises it"""
+    if event is not None:
+        event.error(error)
+    raise error
+
+
+def _decode_json(r, method, url, data=None, event=None):
+    if event is not None:
+        event.parsing()
+    try:
+        result = json.loads(r.content.decode('utf-8'))
+    except ValueError as e:
+        error = JSONParsingError(
+            u'Failed to parse response from CardPay service: {}'.format(e),
+            method=method, url=url, data=data, content=r.content
+        )
+        if event is not None:
+            event.error(error)
+        raise error
+    if event is not None:
+        event.done()
+    return result
+
+
+def _get_json(url, client_login, client_password, params=None,
+              not_found=None, transport=None, endpoint='other',
+              wallet_id=None):
+    """GET JSON document from *url*.
+
+    :raises: :class:`PyCardPay.exceptions.TransactionNotFound` with message *not_found*
+        on HTTP 404 if *not_found* is set
+    :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`,
+        :class:`PyCardPay.exceptions.CommunicationError`
+    """
+    event = hooks.start(endpoint, 'GET', url, params, wallet_id=wallet_id)
+    r = send('GET', url, transport=transport, event=event, params=params,
+             auth=(client_login, client_password))
+    if r.status_code == 404 and not_found is not None:
+        _fail(event, TransactionNotFound(not_found))
+    elif r.status_code != 200:
+        _fail(event, HTTPError(
+            u'Expected HTTP response code "200" but '
+            u'received "{}"'.format(r.status_code),
+            method='GET', url=r.url, response=r
+        ))
+    return _decode_json(r, 'GET', r.url, event=event)
+
+
 def payouts(wallet_id, client_login, client_password, data,
-            card=None, card_token=None, settings=live_settings):
+            card=None, card_token=None, settings=live_settings,
+            transport=None):
     """Create Payout order.
 
     :param wallet_id: Unique merchant’s ID used by the CardPay payment system
@@ -300,32 +378,22 @@ def payouts(wallet_id, client_login, client_password, data,
     request_payload = {'data': request_data}
 
     url = settings.url_payouts + '?' + urlencode({'walletId': wallet_id})
-    try:
-        r = requests.post(url, json=request_payload,
-                          auth=(client_login, client_password))
-    except requests.exceptions.RequestException as exc:
-        raise CommunicationError(
-            'Communication error while performing payout request', exc
-        )
+    event = hooks.start('payouts', 'POST', url, request_payload,
+                        wallet_id=wallet_id)
+    r = send('POST', url, transport=transport, event=event,
+             json=request_payload, auth=(client_login, client_password))
 
     if not (200 <= r.status_code < 300) and r.status_code not in (400, 500):
-        raise HTTPError(
+        _fail(event, HTTPError(
             u'Expected HTTP response code "200" but '
             u'received "{}"'.format(r.status_code),
             method='POST', url=url, data=request_data, response=r
-        )
-    try:
-        r_json = json.loads(r.content.decode('utf-8'))
-    except ValueError as e:
-        raise JSONParsingError(
-            u'Failed to parse response from CardPay service: {}'.format(e),
-            method='POST', url=url, data=request_data, content=r.content
-        )
-    return r_json
+        ))
+    return _decode_json(r, 'POST', url, data=request_data, event=event)
 
 
 def _list(base_url, client_login, client_password, start_millis, end_millis,
-          wallet_id=None, max_count=None):
+          wallet_id=None, max_count=None, transport=None):
     """Get the list of orders for a period of time. This service will return only orders available for this user to be seen.
 
     :param base_url: Base API URL to send request to
@@ -367,30 +435,75 @@ def _list(base_url, client_login, client_password, start_millis, end_millis,
     if max_count is not None:
         params['maxCount'] = max_count
     url = base_url + '?' + urlencode(params)
+    endpoint = _endpoint(base_url)
+    r = _get_json(url, client_login, client_password, transport=transport,
+                  endpoint=endpoint, wallet_id=wallet_id)
+    registry = metrics.active
+    if registry is not None:
+        registry.list_page(endpoint, r.get('hasMore'))
+    return r
 
-    try:
-        r = requests.get(url, auth=(client_login, client_password))
-    except requests.exceptions.RequestException as exc:
-        raise CommunicationError('Communication error', exc)
 
-    if r.status_code != 200:
-        raise HTTPError(
-            u'Expected HTTP response code "200" but '
-            u'received "{}"'.format(r.status_code),
-            method='GET', url=url, response=r
-        )
-    try:
-        r_json = json.loads(r.content.decode('utf-8'))
-    except ValueError as e:
-        raise JSONParsingError(
-            u'Failed to parse response from CardPay service: {}'.format(e),
-            method='GET', url=url, content=r.content
-        )
-    return r_json
+def _iter_list(base_url, client_login, client_password, start_millis,
+               end_millis, wallet_id=None, max_count=None, transport=None):
+    """Iterate over all orders for a period of time.
+
+    Unlike :func:`_list` the period may be longer than :data:`MAX_LIST_PERIOD`
+    (it is split into windows) and pages are followed while ``hasMore`` is set.
+
+    :param base_url: Base API URL to send request to
+    :type base_url: str|unicode
+    :param client_login: Unique store id. It is the same as for administrative interface
+    :type client_login: str|unicode
+    :param client_password: Store password. It is the same as for administrative interface
+    :type client_password: str|unicode
+    :param start_millis: Epoch time in milliseconds when requested period starts (inclusive)
+    :type start_millis: int
+    :param end_millis: Epoch time in milliseconds when requested period ends (not inclusive)
+    :type end_millis: int
+    :param wallet_id: (optional) Limit result with single WebSite orders
+    :type wallet_id: int
+    :param max_count: (optional) Page size, must be less than default 10000
+    :type max_count: int
+    :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+    :returns: iterator of dicts, see :func:`list_payments` for structure
+    """
+    start_millis, end_millis = int(start_millis), int(end_millis)
+    while start_millis < end_millis:
+        window_end = min(end_millis, start_millis + MAX_LIST_PERIOD)
+        page_start = start_millis
+        # Ids already returned with date == page_start; pages overlap by one
+        # millisecond so orders sharing the boundary timestamp aren't lost.
+        boundary_ids = set()
+        while True:
+            r = _list(base_url, client_login, client_password, page_start,
+                      window_end, wallet_id=wallet_id, max_count=max_count,
+                      transport=transport)
+            rows = r.get('data') or []
+            last_date = page_start
+            for row in rows:
+                if row.get('date') == page_start and \
+                        row.get('id') in boundary_ids:
+                    continue
+                yield row
+                if row.get('date') is not None:
+                    last_date = max(last_date, int(row['date']))
+            if not r.get('hasMore') or not rows:
+                break
+            if last_date == page_start and \
+                    all(row.get('id') in boundary_ids for row in rows):
+                # Whole page is one millisecond we've already seen
+                break
+            if last_date != page_start:
+                boundary_ids = set()
+            boundary_ids.update(row.get('id') for row in rows
+                                if row.get('date') == last_date)
+            page_start = last_date
+        start_millis = window_end
 
 
 def _status(base_url, id, client_login, client_password,
-            settings=live_settings):
+            settings=live_settings, transport=None):
     """Use this call to get the status of the transaction by it’s id.
 
     :param base_url: Base API URL to send request to
@@ -410,32 +523,16 @@ def _status(base_url, id, client_login, client_password,
     }
     """
     url = base_url + '/' + str(id)
-
-    try:
-        r = requests.get(url, auth=(client_login, client_password))
-    except requests.exceptions.RequestException as exc:
-        raise CommunicationError('Communication error', exc)
-
-    if r.status_code == 404:
-        raise TransactionNotFound('Payment with ID {} is not found'.format(id))
-    elif r.status_code != 200:
-        raise HTTPError(
-            u'Expected HTTP response code "200" but '
-            u'received "{}"'.format(r.status_code),
-            method='GET', url=url, response=r
-        )
-    try:
-        r_json = json.loads(r.content.decode('utf-8'))
-    except ValueError as e:
-        raise JSONParsingError(
-            u'Failed to parse response from CardPay service: {}'.format(e),
-            method='GET', url=url, content=r.content
-        )
-    return r_json
+    return _get_json(
+        url, client_login, client_password, transport=transport,
+        not_found='Payment with ID {} is not found'.format(id),
+        endpoint=_endpoint(base_url)
+    )
 
 
 def list_payments(client_login, client_password, start_millis, end_millis,
-                  wallet_id=None, max_count=None, settings=live_settings):
+                  wallet_id=None, max_count=None, settings=live_settings,
+                  transport=None):
     """Get the list of orders for a period of time. This service will return only orders available for this user to be seen.
 
     :param client_login: Unique store id. It is the same as for administrative interface
@@ -480,10 +577,26 @@ def list_payments(client_login, client_password, start_millis, end_millis,
     """
     return _list(settings.url_payments, client_login, client_password,
                  start_millis, end_millis, wallet_id=wallet_id,
-                 max_count=max_count)
+                 max_count=max_count, transport=transport)
+
+
+def iter_payments(client_login, client_password, start_millis, end_millis,
+                  wallet_id=None, max_count=None, settings=live_settings,
+                  transport=None):
+    """Iterate over orders for a period of time of any length, following pages.
+
+    Takes the same parameters as :func:`list_payments`.
+
+    :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+    :returns: iterator of dicts, see :func:`list_payments` for structure
+    """
+    return _iter_list(settings.url_payments, client_login, client_password,
+                      start_millis, end_millis, wallet_id=wallet_id,
+                      max_count=max_count, transport=transport)
 
 
-def payments_status(id, client_login, client_password, settings=live_settings):
+def payments_status(id, client_login, client_password, settings=live_settings,
+                    transport=None):
     """Use this call to get the status of the payment by it’s id.
 
     :param id: Transaction id
@@ -504,11 +617,13 @@ def payments_status(id, client_login, client_password, settings=live_settings):
         }
     }
     """
-    return _status(settings.url_payments, id, client_login, client_password)
+    return _status(settings.url_payments, id, client_login, client_password,
+                   transport=transport)
 
 
 def list_refunds(client_login, client_password, start_millis, end_millis,
-                 wallet_id=None, max_count=None, settings=live_settings):
+                 wallet_id=None, max_count=None, settings=live_settings,
+                 transport=None):
     """Get the list of refunds for a period of time. This service will return only orders available for this user to be seen.
 
     :param client_login: Unique store id. It is the same as for administrative interface
@@ -550,10 +665,26 @@ def list_refunds(client_login, client_password, start_millis, end_millis,
     """
     return _list(settings.url_refunds, client_login, client_password,
                  start_millis, end_millis, wallet_id=wallet_id,
-                 max_count=max_count)
+                 max_count=max_count, transport=transport)
 
 
-def refunds_status(id, client_login, client_password, settings=live_settings):
+def iter_refunds(client_login, client_password, start_millis, end_millis,
+                 wallet_id=None, max_count=None, settings=live_settings,
+                 transport=None):
+    """Iterate over refunds for a period of time of any length, following pages.
+
+    Takes the same parameters as :func:`list_refunds`.
+
+    :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+    :returns: iterator of dicts, see :func:`list_refunds` for structure
+    """
+    return _iter_list(settings.url_refunds, client_login, client_password,
+                      start_millis, end_millis, wallet_id=wallet_id,
+                      max_count=max_count, transport=transport)
+
+
+def refunds_status(id, client_login, client_password, settings=live_settings,
+                   transport=None):
     """Use this call to get the status of the refund by it’s id.
 
     :param id: Transaction id
@@ -574,11 +705,13 @@ def refunds_status(id, client_login, client_password, settings=live_settings):
         }
     }
     """
-    return _status(settings.url_refunds, id, client_login, client_password)
+    return _status(settings.url_refunds, id, client_login, client_password,
+                   transport=transport)
 
 
 def list_payouts(client_login, client_password, start_millis, end_millis,
-                 wallet_id=None, max_count=None, settings=live_settings):
+                 wallet_id=None, max_count=None, settings=live_settings,
+                 transport=None):
     """Get the list of payouts for a period of time. This service will return only orders available for this user to be seen.
 
     :param client_login: Unique store id. It is the same as for administrative interface
@@ -617,10 +750,26 @@ def list_payouts(client_login, client_password, start_millis, end_millis,
     """
     return _list(settings.url_payouts, client_login, client_password,
                  start_millis, end_millis, wallet_id=wallet_id,
-                 max_count=max_count)
+                 max_count=max_count, transport=transport)
+
+
+def iter_payouts(client_login, client_password, start_millis, end_millis,
+                 wallet_id=None, max_count=None, settings=live_settings,
+                 transport=None):
+    """Iterate over payouts for a period of time of any length, following pages.
+
+    Takes the same parameters as :func:`list_payouts`.
+
+    :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+    :returns: iterator of dicts, see :func:`list_payouts` for structure
+    """
+    return _iter_list(settings.url_payouts, client_login, client_password,
+                      start_millis, end_millis, wallet_id=wallet_id,
+                      max_count=max_count, transport=transport)
 
 
-def payouts_status(id, client_login, client_password, settings=live_settings):
+def payouts_status(id, client_login, client_password, settings=live_settings,
+                   transport=None):
     """Use this call to get the status of the payout by it’s id.
 
     :param id: Transaction id
@@ -641,11 +790,12 @@ def payouts_status(id, client_login, client_password, settings=live_settings):
         }
     }
     """
-    return _status(settings.url_payouts, id, client_login, client_password)
+    return _status(settings.url_payouts, id, client_login, client_password,
+                   transport=transport)
 
 
 def payouts_status_by_number(number, wallet_id, client_login, client_password,
-                             settings=live_settings):
+                             settings=live_settings, transport=None):
     """Use this call to get the status of the payouts by merchant id (number).
 
     :param number: Merchant order number
@@ -684,26 +834,7 @@ def payouts_status_by_number(number, wallet_id, client_login, client_password,
 
     {'data': [], 'hasMore': False}
     """
-
-    try:
-        r = requests.get(
-            settings.url_payouts,
-            params={'number': number, 'wallet_id': wallet_id},
-            auth=(client_login, client_password)
-        )
-    except requests.exceptions.RequestException as exc:
-        raise CommunicationError('Communication error', exc)
-
-    if r.status_code != 200:
-        raise HTTPError(
-            u'Expected HTTP response code "200" but '
-            u'received "{}"'.format(r.status_code),
-            method='GET', url=r.url, response=r
-        )
-    try:
-        return json.loads(r.content.decode('utf-8'))
-    except ValueError as e:
-        raise JSONParsingError(
-            u'Failed to parse response from CardPay service: {}'.format(e),
-            method='GET', url=r.url, content=r.content
-        )
+    return _get_json(settings.url_payouts, client_login, client_password,
+                     params={'number': number, 'wallet_id': wallet_id},
+                     transport=transport, endpoint='payouts',
+                     wallet_id=wallet_id)
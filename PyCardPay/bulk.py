@@ -0,0 +1,322 @@
+# coding=utf-8
+
+import json
+import os
+import queue
+import threading
+import time
+from decimal import Decimal
+
+from . import api, hooks, validation
+from .exceptions import PyCardPayException
+
+
+# Default number of requests running at the same time
+DEFAULT_MAX_IN_FLIGHT = 16
+
+
+def imap_unordered(fn, items, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Calls *fn* for every item in threads and yields results as they complete.
+
+    *items* is consumed lazily: at most *max_in_flight* calls are running or
+    waiting, so very long iterators don't pile up in memory.
+
+    :param fn: Function called with every item
+    :type fn: callable
+    :param items: Items to process
+    :type items: iterable
+    :param max_in_flight: (optional) Maximum number of concurrent calls
+    :type max_in_flight: int
+    :returns: iterator of ``(item, result, exception)`` tuples; either
+        *result* or *exception* is ``None``
+    """
+    # Imported here, it's the slowest import of ``PyCardPay.cardpay``
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        running = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(running) < max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                running[executor.submit(fn, item)] = item
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                exc = future.exception()
+                if exc is not None:
+                    yield item, None, exc
+                else:
+                    yield item, future.result(), None
+
+
+def _status_change_result(result, exc):
+    if exc is None:
+        return result
+    return {'is_executed': False, 'details': str(exc), 'exception': exc}
+
+
+def iter_status_changes(fn, items, key, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Runs status changes concurrently and yields results as they complete.
+
+    :param fn: Function making one status change, e.g. :meth:`PyCardPay.CardPay.capture`
+    :type fn: callable
+    :param items: Arguments of *fn* calls
+    :type items: iterable
+    :param key: Returns transaction id of an item
+    :type key: callable
+    :param max_in_flight: (optional) Maximum number of concurrent requests
+    :type max_in_flight: int
+    :returns: iterator of ``(id, result)`` tuples
+
+    *result* is a dict returned by :func:`PyCardPay.api.status_change`. When
+    the request raised an exception it is
+    ``{'is_executed': False, 'details': str(exc), 'exception': exc}``.
+    """
+    for item, result, exc in imap_unordered(fn, items, max_in_flight):
+        yield key(item), _status_change_result(result, exc)
+
+
+class PayoutLedger:
+    """Append-only journal of payouts made by :func:`iter_payouts`.
+
+    Every payout is recorded as ``submitted`` (synced to disk before the
+    request is sent) and then as ``done`` or ``failed``. Reading the file
+    back tells which payouts of an interrupted run are finished and which
+    have unknown outcome and must be checked with CardPay before a retry.
+
+    :param path: Journal file name, created if missing
+    :type path: str|unicode
+    """
+
+    SUBMITTED = 'submitted'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line of a crashed run
+                        continue
+                    self._entries[entry['merchantOrderId']] = entry
+        self._file = open(path, 'a')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def get(self, merchant_order_id):
+        """Returns the last entry ``{'merchantOrderId', 'state', 'result'}`` or ``None``"""
+        return self._entries.get(merchant_order_id)
+
+    def record(self, merchant_order_id, state, result=None):
+        entry = {'merchantOrderId': merchant_order_id, 'state': state}
+        if result is not None:
+            entry['result'] = result
+        line = json.dumps(entry, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            self._entries[merchant_order_id] = entry
+            self._file.write(line)
+            self._file.flush()
+            if state == self.SUBMITTED:
+                os.fsync(self._file.fileno())
+
+
+def find_payout(client, merchant_order_id):
+    """Looks up payout by *merchant_order_id*.
+
+    :returns: ``{'data': row}`` with list row of the payout or ``None``
+    """
+    r = client.payouts_status_by_number(merchant_order_id)
+    rows = [row for row in r.get('data') or []
+            if row.get('number') == merchant_order_id]
+    return {'data': rows[0]} if rows else None
+
+
+def find_refund(client, payment_id, since_millis, amount=None):
+    """Looks up refund of payment *payment_id* made at or after *since_millis*.
+
+    :param amount: (optional) Refund amount, any refund matches if not set
+    :type amount: Decimal|int|str
+    :returns: ``{'data': row}`` with list row of the refund or ``None``
+    """
+    payment_id = str(payment_id)
+    if amount is not None:
+        amount = Decimal(str(amount))
+    rows = api._iter_list(
+        client.settings.url_refunds, client.client_login,
+        client.client_password, since_millis, int(time.time() * 1000) + 1,
+        wallet_id=client.wallet_id, transport=client.transport
+    )
+    for row in rows:
+        if str(row.get('originalOrderId')) != payment_id or \
+                row.get('state') in ('DECLINED', 'CANCELLED'):
+            continue
+        if amount is None or Decimal(str(row.get('amount'))) == amount:
+            return {'data': row}
+    return None
+
+
+def _payout(client, ledger, item, retries):
+    data = item['data']
+    if client.validate:
+        # Rejected before anything is recorded, nothing was submitted
+        errors = validation.validate_payout_item(item)
+        if errors:
+            return {'errors': errors}
+    key = data['merchantOrderId']
+    entry = ledger.get(key) if ledger is not None else None
+    if entry is not None and entry['state'] == PayoutLedger.DONE:
+        return dict(entry.get('result') or {}, skipped=True)
+    # A payout submitted earlier may exist: the run was interrupted before
+    # its outcome was recorded, or it failed, possibly with an ambiguous 5xx
+    uncertain = entry is not None and entry['state'] in (
+        PayoutLedger.SUBMITTED, PayoutLedger.FAILED)
+    attempt = 0
+    while True:
+        if uncertain:
+            found = find_payout(client, key)
+            if found is not None:
+                if ledger is not None:
+                    ledger.record(key, PayoutLedger.DONE, found)
+                return dict(found, skipped=True)
+        if ledger is not None:
+            ledger.record(key, PayoutLedger.SUBMITTED)
+        try:
+            with hooks.context(attempt=attempt + 1):
+                result = client.payouts(data, card=item.get('card'),
+                                        card_token=item.get('card_token'))
+        except PyCardPayException:
+            attempt += 1
+            if attempt > retries:
+                raise
+            uncertain = True
+            continue
+        if ledger is not None:
+            ledger.record(key, PayoutLedger.FAILED if 'errors' in result
+                          else PayoutLedger.DONE, result)
+        return result
+
+
+def iter_payouts(client, payouts, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 ledger=None, retries=2):
+    """Creates many payouts concurrently and yields results as they complete.
+
+    Before a payout with unknown outcome is sent again (a failed attempt, an
+    entry left ``submitted`` in *ledger* by an interrupted run or recorded as
+    ``failed``, e.g. after HTTP 500) CardPay is
+    asked with :meth:`PyCardPay.CardPay.payouts_status_by_number` whether it
+    already exists, so ``merchantOrderId`` is never paid out twice.
+
+    :param client: Client making the payouts
+    :type client: :class:`PyCardPay.CardPay`
+    :param payouts: Dicts with ``data`` and either ``card`` or ``card_token``
+        keys, see :meth:`PyCardPay.CardPay.payouts`; may be a lazy iterator
+    :type payouts: iterable
+    :param max_in_flight: (optional) Maximum number of concurrent payouts
+    :type max_in_flight: int
+    :param ledger: (optional) Journal used to resume interrupted runs
+    :type ledger: :class:`PayoutLedger`
+    :param retries: (optional) Attempts after communication or HTTP errors
+    :type retries: int
+    :returns: iterator of ``(merchantOrderId, result)`` tuples
+
+    *result* is the response of :meth:`PyCardPay.CardPay.payouts`, with
+    ``'skipped': True`` added when the payout was found already made.
+    When all attempts failed it is ``{'errors': [], 'exception': exc}``.
+    """
+    def payout(item):
+        return _payout(client, ledger, item, retries)
+
+    for item, result, exc in imap_unordered(payout, payouts, max_in_flight):
+        if exc is not None:
+            result = {'errors': [], 'exception': exc}
+        yield item['data']['merchantOrderId'], result
+
+
+def prefetch(items, size):
+    """Consumes *items* in a background thread, up to *size* ahead of the caller.
+
+    Useful as a pipeline stage: CPU work done while producing items overlaps
+    with the caller waiting on the network. Exceptions raised by *items* are
+    re-raised to the caller.
+
+    :param items: Items to produce
+    :type items: iterable
+    :param size: Maximum number of produced items not consumed yet
+    :type size: int
+    :returns: iterator
+    """
+    buffer = queue.Queue(size)
+    stop = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        buffer.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            buffer.put((end, None))
+        except Exception as exc:
+            buffer.put((end, exc))
+
+    thread = threading.Thread(target=produce, name='PyCardPay-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc = buffer.get()
+            if item is end:
+                if exc is not None:
+                    raise exc
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def iter_payments(client, payments, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """Builds, signs and sends many payments; yields results as they complete.
+
+    See :meth:`PyCardPay.CardPay.pay_many` for parameters and results.
+    """
+    def sign(payment):
+        try:
+            return payment, client._sign_payment(payment), None
+        except Exception as exc:
+            return payment, None, exc
+
+    def send(signed):
+        payment, signature, exc = signed
+        if exc is not None:
+            raise exc
+        return api.pay_signed(signature[0], signature[1],
+                              settings=client.settings,
+                              transport=client.transport)
+
+    signed = prefetch((sign(payment) for payment in payments),
+                      max_in_flight * 2)
+    for item, result, exc in imap_unordered(send, signed, max_in_flight):
+        if exc is not None:
+            result = {'exception': exc}
+        yield item[0]['order'].get('number'), result
@@ -0,0 +1,252 @@
+# coding=utf-8
+
+import logging
+import marshal
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .store import KIND_SETTLED_STATES
+
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS status_cache (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    wallet_id INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (kind, id, wallet_id)
+);
+CREATE INDEX IF NOT EXISTS status_cache_expires ON status_cache (expires);
+"""
+
+
+def status_state(result):
+    """Returns state of a status response (see :func:`PyCardPay.api.payments_status`)"""
+    data = result.get('data') if isinstance(result, dict) else None
+    return data.get('state') if isinstance(data, dict) else None
+
+
+def is_final(kind, result, final_states=KIND_SETTLED_STATES):
+    """Checks whether status response *result* of a *kind* transaction never changes
+
+    :param final_states: (optional) States that never change, or dict of them by kind
+    :type final_states: set|dict
+    """
+    if isinstance(final_states, dict):
+        final_states = final_states.get(kind, ())
+    return status_state(result) in final_states
+
+
+class StatusCache:
+    """In-process LRU cache of status responses.
+
+    Responses of transactions in one of *final_states* never change and are
+    kept for *final_ttl* seconds, others only for *ttl* seconds. By default
+    completed payments aren't final, they may still be refunded or charged
+    back (see :data:`PyCardPay.store.KIND_SETTLED_STATES`).
+
+    :param max_size: (optional) Maximum number of cached responses
+    :type max_size: int
+    :param ttl: (optional) Seconds non-final responses are valid
+    :type ttl: int|float
+    :param final_ttl: (optional) Seconds final responses are valid
+    :type final_ttl: int|float
+    :param final_states: (optional) States that never change, or dict of them by kind
+    :type final_states: set|dict
+    """
+
+    def __init__(self, max_size=10000, ttl=5, final_ttl=24 * 60 * 60,
+                 final_states=KIND_SETTLED_STATES):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.final_ttl = final_ttl
+        self.final_states = final_states
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, kind, id, wallet_id=None):
+        """Returns cached status response of transaction *id* or ``None``
+
+        :param kind: One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param id: Transaction id
+        :type id: int|str
+        :param wallet_id: (optional) Wallet the response was received for;
+            wallets sharing a cache don't see each other's responses
+        :type wallet_id: int
+        """
+        key = (kind, str(id), wallet_id)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[0] > time.time():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self._items[key]
+            self.misses += 1
+        return None
+
+    def set(self, kind, id, result, wallet_id=None):
+        """Caches status response of transaction *id*"""
+        final = is_final(kind, result, self.final_states)
+        expires = time.time() + (self.final_ttl if final else self.ttl)
+        key = (kind, str(id), wallet_id)
+        with self._lock:
+            self._items[key] = (expires, result)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class SharedStatusCache:
+    """Status cache shared by processes on one host, e.g. pre-forked web
+    server workers, through a SQLite database in WAL mode.
+
+    Has the same interface and expiry rules as :class:`StatusCache`.
+    Responses are stored :mod:`marshal` encoded. Every process and thread
+    opens its own connection, so readers neither wait for each other nor
+    for writers; connections inherited through ``fork()`` are not reused.
+    Failed reads and writes (e.g. a busy or locked database) are logged;
+    a failed read counts as a miss. Writes are not synced to disk, so
+    responses cached shortly before an OS crash or power loss may be lost.
+
+    :param path: Database file name, on a local file system
+    :type path: str|unicode
+    :param max_size: (optional) Maximum number of cached responses
+    :type max_size: int
+    :param ttl: (optional) Seconds non-final responses are valid
+    :type ttl: int|float
+    :param final_ttl: (optional) Seconds final responses are valid
+    :type final_ttl: int|float
+    :param final_states: (optional) States that never change, or dict of them by kind
+    :type final_states: set|dict
+    :param prune_interval: (optional) Writes of a process between removals of expired responses
+    :type prune_interval: int
+
+    Usage example:
+
+    >>> cache = SharedStatusCache('/run/myshop/cardpay-status.sqlite')
+    >>> client = CardPay(..., status_cache=cache)
+    """
+
+    def __init__(self, path, max_size=100000, ttl=5,
+                 final_ttl=24 * 60 * 60, final_states=KIND_SETTLED_STATES,
+                 prune_interval=1000):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.final_ttl = final_ttl
+        self.final_states = final_states
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        db = self._connection()
+        with db:
+            db.executescript(_SCHEMA)
+
+    def _connection(self):
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            db = sqlite3.connect(self.path, timeout=1,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # Losing recent entries on power loss only costs extra requests
+            db.execute('PRAGMA synchronous=OFF')
+            local.db = db
+            local.pid = pid
+        return local.db
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM status_cache WHERE expires > ?',
+            (time.time(),)
+        ).fetchone()[0]
+
+    def get(self, kind, id, wallet_id=None):
+        """Returns cached status response of transaction *id* or ``None``
+
+        :param kind: One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param id: Transaction id
+        :type id: int|str
+        :param wallet_id: (optional) Wallet the response was received for;
+            wallets sharing a cache don't see each other's responses
+        :type wallet_id: int
+        """
+        try:
+            row = self._connection().execute(
+                'SELECT value FROM status_cache '
+                'WHERE kind = ? AND id = ? AND wallet_id = ? AND expires > ?',
+                (kind, str(id), wallet_id or 0, time.time())
+            ).fetchone()
+        except sqlite3.Error:
+            logger.warning('Failed to read cached %s status of %s', kind, id,
+                           exc_info=True)
+            row = None
+        if row is not None:
+            try:
+                result = marshal.loads(row[0])
+            except (EOFError, ValueError, TypeError):
+                # Written by another Python version
+                result = None
+            if result is not None:
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def set(self, kind, id, result, wallet_id=None):
+        """Caches status response of transaction *id*"""
+        final = is_final(kind, result, self.final_states)
+        now = time.time()
+        expires = now + (self.final_ttl if final else self.ttl)
+        try:
+            value = marshal.dumps(result)
+            db = self._connection()
+            db.execute(
+                'INSERT OR REPLACE INTO status_cache '
+                '(kind, id, wallet_id, expires, value) VALUES (?, ?, ?, ?, ?)',
+                (kind, str(id), wallet_id or 0, expires, value)
+            )
+            self._writes += 1
+            if self._writes % self.prune_interval == 0:
+                self.prune(now)
+        except (sqlite3.Error, ValueError):
+            logger.warning('Failed to cache %s status of %s', kind, id,
+                           exc_info=True)
+
+    def prune(self, now=None):
+        """Removes expired responses and, above *max_size*, those expiring first"""
+        db = self._connection()
+        db.execute('DELETE FROM status_cache WHERE expires <= ?',
+                   (now or time.time(),))
+        excess = db.execute('SELECT COUNT(*) FROM status_cache')\
+            .fetchone()[0] - self.max_size
+        if excess > 0:
+            db.execute(
+                'DELETE FROM status_cache WHERE rowid IN ('
+                'SELECT rowid FROM status_cache ORDER BY expires LIMIT ?)',
+                (excess,)
+            )
+
+    def clear(self):
+        self._connection().execute('DELETE FROM status_cache')
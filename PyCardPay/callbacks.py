@@ -0,0 +1,409 @@
+# coding=utf-8
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from urllib.parse import parse_qs
+
+from .dedup import callback_key
+from .exceptions import PyCardPayException
+
+
+logger = logging.getLogger(__name__)
+
+# Overflow policies applied when the queue of parsed callbacks is full
+REJECT = 'reject'            # answer 503, CardPay will redeliver the callback
+BLOCK = 'block'              # wait up to *put_timeout* seconds, then reject
+DROP_OLDEST = 'drop_oldest'  # discard the oldest queued callback; it is
+                             # forgotten by *dedup*, but already answered
+                             # with 200, so CardPay won't redeliver it
+
+# Largest accepted callback body in bytes
+MAX_BODY_SIZE = 1024 * 1024
+
+_STAGES = ('verify', 'queue', 'handle')
+
+
+class CallbackStats:
+    """Counters and per stage timings of a callback application.
+
+    *timings* maps stage name ('verify', 'queue', 'handle') to
+    ``[count, total seconds, max seconds]``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ['received', 'accepted', 'duplicate', 'invalid', 'rejected',
+             'dropped', 'handled', 'failed'], 0
+        )
+        self.timings = dict((stage, [0, 0.0, 0.0]) for stage in _STAGES)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def time(self, stage, seconds):
+        with self._lock:
+            timing = self.timings[stage]
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+    def snapshot(self):
+        """Returns copy of counters and timings as dict"""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': dict((stage, list(timing))
+                                for stage, timing in self.timings.items()),
+            }
+
+
+def _parse_form(body):
+    form = parse_qs(body.decode('ascii', 'replace'))
+    try:
+        return form['orderXML'][0], form['sha512'][0]
+    except (KeyError, IndexError):
+        return None, None
+
+
+class _BaseCallbackApp:
+
+    def __init__(self, client, handler, workers=4, queue_size=1000,
+                 overflow=REJECT, put_timeout=1.0, dedup=None):
+        if overflow not in (REJECT, BLOCK, DROP_OLDEST):
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        self.client = client
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.put_timeout = put_timeout
+        self.dedup = dedup
+        self.stats = CallbackStats()
+
+    def verify(self, body):
+        """Verifies and parses callback request body.
+
+        Callbacks already known to *dedup* are answered with 200 without
+        being parsed again.
+
+        :returns: ``(status, order, key)`` where *order* is ``None`` unless
+            the callback is valid and new, and *key* is its dedup key
+        """
+        self.stats.incr('received')
+        started = time.time()
+        order_xml, sha512 = _parse_form(body)
+        if order_xml is None:
+            self.stats.incr('invalid')
+            return 400, None, None
+        key = None
+        if self.dedup is not None:
+            key = callback_key(sha512)
+            if key is not None and key in self.dedup:
+                self.stats.incr('duplicate')
+                return 200, None, key
+        try:
+            order = self.client.parse_callback(order_xml, sha512)
+        except (PyCardPayException, TypeError, ValueError):
+            self.stats.incr('invalid')
+            return 400, None, None
+        finally:
+            self.stats.time('verify', time.time() - started)
+        if key is not None and not self.dedup.add(key):
+            # Same callback was accepted concurrently
+            self.stats.incr('duplicate')
+            return 200, None, key
+        return 200, order, key
+
+    def _forget(self, key):
+        if key is not None:
+            self.dedup.discard(key)
+
+    def _rejected(self, key):
+        self._forget(key)
+        return 503
+
+    def _dropped(self, item):
+        if item is None:
+            # Stop sentinel, workers are stopping anyway
+            return
+        self.stats.incr('dropped')
+        # Redelivery of the dropped callback isn't a duplicate
+        self._forget(item[1])
+        logger.warning('Callback queue full, dropped order %s',
+                       item[0].get('id'))
+
+    def _handled(self, key, enqueued, started, exc=None):
+        self.stats.time('queue', started - enqueued)
+        self.stats.time('handle', time.time() - started)
+        if exc is None:
+            self.stats.incr('handled')
+        else:
+            self.stats.incr('failed')
+            # Redelivery of the failed callback isn't a duplicate
+            self._forget(key)
+            logger.error('Callback handler failed', exc_info=exc)
+
+
+class CallbackApp(_BaseCallbackApp):
+    """WSGI application receiving CardPay callbacks.
+
+    Callbacks are verified and parsed with :meth:`PyCardPay.CardPay.parse_callback`
+    in the request thread and answered right away; parsed orders are put to a
+    bounded queue drained by *workers* threads calling ``handler(order)``.
+
+    :param client: Client whose secret callbacks are verified with
+    :type client: :class:`PyCardPay.CardPay`
+    :param handler: Called with every parsed order dict from a worker thread
+    :type handler: callable
+    :param workers: (optional) Number of worker threads
+    :type workers: int
+    :param queue_size: (optional) Maximum number of parsed callbacks waiting for a worker
+    :type queue_size: int
+    :param overflow: (optional) What to do when the queue is full: :data:`REJECT`, :data:`BLOCK` or :data:`DROP_OLDEST`
+    :type overflow: str
+    :param put_timeout: (optional) Seconds to wait for free space with :data:`BLOCK` policy
+    :type put_timeout: int|float
+    :param dedup: (optional) Set of handled callbacks, redelivered callbacks are skipped
+    :type dedup: :class:`PyCardPay.dedup.CallbackDeduplicator`
+
+    Usage example (gunicorn ``myshop.callbacks:app``):
+
+    >>> client = CardPay(...)
+    >>> app = CallbackApp(client, handle_order, workers=8)
+
+    Invalid callbacks are answered with 400, callbacks not fitting into the
+    queue with 503 so CardPay delivers them again later.
+    """
+
+    def __init__(self, *args, **kwargs):
+        _BaseCallbackApp.__init__(self, *args, **kwargs)
+        self.queue = queue.Queue(self.queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Starts worker threads; called automatically on first request"""
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name='PyCardPay-callback-{}'.format(n)
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Lets workers finish queued callbacks and stops them"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            order, key, enqueued = item
+            started = time.time()
+            try:
+                self.handler(order)
+            except Exception as exc:
+                self._handled(key, enqueued, started, exc)
+            else:
+                self._handled(key, enqueued, started)
+
+    def submit(self, order, key=None):
+        """Queues parsed *order* according to the overflow policy.
+
+        :param key: (optional) Dedup key of the callback, forgotten if the
+            order is dropped or its handler fails
+        :type key: bytes
+        :returns: bool -- False if the order was rejected
+        """
+        item = (order, key, time.time())
+        try:
+            if self.overflow == BLOCK:
+                self.queue.put(item, timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow != DROP_OLDEST:
+                self.stats.incr('rejected')
+                return False
+            try:
+                self._dropped(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            return self.submit(order, key)
+        self.stats.incr('accepted')
+        return True
+
+    def __call__(self, environ, start_response):
+        if not self._threads:
+            self.start()
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return _wsgi_response(start_response, 405)
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > MAX_BODY_SIZE:
+            self.stats.incr('invalid')
+            return _wsgi_response(start_response, 413)
+        status, order, key = self.verify(environ['wsgi.input'].read(length))
+        if order is not None and not self.submit(order, key):
+            status = self._rejected(key)
+        return _wsgi_response(start_response, status)
+
+
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 503: 'Service Unavailable',
+}
+
+
+def _wsgi_response(start_response, status):
+    body = _REASONS[status].encode('ascii')
+    start_response(
+        '{} {}'.format(status, _REASONS[status]),
+        [('Content-Type', 'text/plain'),
+         ('Content-Length', str(len(body)))]
+    )
+    return [body]
+
+
+class AsyncCallbackApp(_BaseCallbackApp):
+    """ASGI application receiving CardPay callbacks.
+
+    Works like :class:`CallbackApp` but parsed orders are drained by
+    *workers* asyncio tasks. *handler* may be a coroutine function; plain
+    functions are run in the default executor so they don't block the loop.
+    Takes the same parameters as :class:`CallbackApp`.
+
+    Usage example (uvicorn ``myshop.callbacks:app``):
+
+    >>> app = AsyncCallbackApp(client, handle_order, workers=32)
+    """
+
+    def __init__(self, *args, **kwargs):
+        _BaseCallbackApp.__init__(self, *args, **kwargs)
+        self.queue = None
+        self._tasks = []
+
+    async def start(self):
+        """Starts worker tasks; called on lifespan startup or first request"""
+        if self._tasks:
+            return
+        self.queue = asyncio.Queue(self.queue_size)
+        self._tasks = [asyncio.ensure_future(self._work())
+                       for _ in range(self.workers)]
+
+    async def stop(self):
+        """Lets workers finish queued callbacks and stops them"""
+        tasks, self._tasks = self._tasks, []
+        for _ in tasks:
+            await self.queue.put(None)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def _work(self):
+        loop = asyncio.get_event_loop()
+        is_coroutine = asyncio.iscoroutinefunction(self.handler)
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            order, key, enqueued = item
+            started = time.time()
+            try:
+                if is_coroutine:
+                    await self.handler(order)
+                else:
+                    await loop.run_in_executor(None, self.handler, order)
+            except Exception as exc:
+                self._handled(key, enqueued, started, exc)
+            else:
+                self._handled(key, enqueued, started)
+
+    async def submit(self, order, key=None):
+        """Queues parsed *order* according to the overflow policy.
+
+        :param key: (optional) Dedup key of the callback, forgotten if the
+            order is dropped or its handler fails
+        :type key: bytes
+        :returns: bool -- False if the order was rejected
+        """
+        item = (order, key, time.time())
+        try:
+            if self.overflow == BLOCK:
+                await asyncio.wait_for(self.queue.put(item),
+                                       self.put_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            if self.overflow != DROP_OLDEST:
+                self.stats.incr('rejected')
+                return False
+            try:
+                self._dropped(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                pass
+            return await self.submit(order, key)
+        self.stats.incr('accepted')
+        return True
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if not self._tasks:
+            await self.start()
+        if scope['method'] != 'POST':
+            return await _asgi_response(send, 405)
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(body) > MAX_BODY_SIZE:
+                self.stats.incr('invalid')
+                return await _asgi_response(send, 413)
+        status, order, key = self.verify(body)
+        if order is not None and not await self.submit(order, key):
+            status = self._rejected(key)
+        await _asgi_response(send, status)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def _asgi_response(send, status):
+    body = _REASONS[status].encode('ascii')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain'),
+                    (b'content-length', str(len(body)).encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
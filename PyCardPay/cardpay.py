@@ -1,12 +1,21 @@
 import base64
 import hashlib
-
-from . import api
+import logging
+import socket
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+from . import api, bulk, hooks, metrics, transport as transports, validation
 from .utils import (
-    order_to_xml, xml_to_string, xml_get_sha512, parse_response, parse_order,
+    order_to_xml, xml_sign, parse_response, parse_order,
 )
 from .settings import test_settings, live_settings
-from .exceptions import SignatureError
+from .exceptions import SignatureError, CommunicationError, ValidationError
+
+
+logger = logging.getLogger(__name__)
 
 
 class CardPay:
@@ -22,10 +31,26 @@ class CardPay:
     :type client_password: str|unicode
     :param test: Switch to testing mode (uses sandbox server)
     :type test: bool
+    :param store: (optional) Local transaction mirror answering :meth:`payouts_status_by_number` while fresh
+    :type store: :class:`PyCardPay.store.TransactionStore`
+    :param store_max_age: (optional) Seconds since the last sync while *store* is trusted
+    :type store_max_age: int|float
+    :param status_cache: (optional) Cache of status responses
+    :type status_cache: :class:`PyCardPay.cache.StatusCache`|:class:`PyCardPay.cache.SharedStatusCache`
+    :param transport: (optional) HTTP transport, the process wide default if not set
+    :type transport: :class:`PyCardPay.transport.Transport`
+    :param settings: (optional) Service URLs overriding *test*, e.g. of :class:`PyCardPay.fakeserver.FakeCardPay`
+    :type settings: :class:`PyCardPay.settings.Settings`
+    :param warmup: (optional) Call :meth:`warmup` with default arguments when created
+    :type warmup: bool
+    :param validate: (optional) Validate order and payout data locally before sending,
+        see :mod:`PyCardPay.validation`; off by default, invalid data is sent to CardPay as is
+    :type validate: bool
     """
 
     def __init__(self, wallet_id, secret, client_login, client_password,
-                 test=False):
+                 test=False, store=None, store_max_age=60, status_cache=None,
+                 transport=None, settings=None, warmup=False, validate=False):
         self.wallet_id = wallet_id
         if not isinstance(secret, bytes):
             secret = secret.encode('ascii')
@@ -37,7 +62,59 @@ class CardPay:
         self.client_password_sha256 = hashlib.sha256(client_password)\
             .hexdigest()
         self.test = test
-        self.settings = test_settings if test else live_settings
+        if settings is None:
+            settings = test_settings if test else live_settings
+        self.settings = settings
+        self.store = store
+        self.store_max_age = store_max_age
+        self.status_cache = status_cache
+        self.transport = transport
+        self.validate = validate
+        if warmup:
+            self.warmup()
+
+    def warmup(self, connections=2, keepalive=transports.KEEPALIVE_IDLE):
+        """Resolves service hosts and opens pooled connections to them, so the
+        first requests don't wait for DNS and TLS handshakes.
+
+        Resolved addresses are cached for new connections, see
+        :func:`PyCardPay.transport.resolve`. Hosts that can't be reached are
+        logged and skipped.
+
+        :param connections: (optional) Connections opened per host
+        :type connections: int
+        :param keepalive: (optional) Seconds between TCP keep-alive probes on idle connections,
+            ``None`` disables probes
+        :type keepalive: int
+        :returns: dict -- Number of open connections per host, e.g. ``{'https://cardpay.com': 2}``
+        """
+        transport = transports.get_transport(self.transport)
+        result = {}
+        for url in self.settings:
+            parts = urlsplit(url)
+            origin = '{}://{}'.format(parts.scheme, parts.netloc)
+            if origin in result:
+                continue
+            result[origin] = 0
+            try:
+                transports.resolve(parts.hostname)
+                result[origin] = transport.warmup(origin + '/', connections,
+                                                  keepalive)
+            except (socket.error, CommunicationError):
+                logger.warning('Failed to warm up connections to %s', origin,
+                               exc_info=True)
+        return result
+
+    def _get_status(self, kind, id, fetch):
+        if self.status_cache is not None:
+            result = self.status_cache.get(kind, id, self.wallet_id)
+            if result is not None:
+                return result
+        result = fetch(id, self.client_login, self.client_password,
+                       settings=self.settings, transport=self.transport)
+        if self.status_cache is not None:
+            self.status_cache.set(kind, id, result, self.wallet_id)
+        return result
 
     def sign_order(self, order):
         """Prepare orderXML and sha512.
@@ -60,15 +137,23 @@ class CardPay:
             'locale': 'ru',                 # (str|unicode) Optional. Preferred locale for the payment page.
             'ip': '10.20.30.40',            # (str|unicode) Optional. Customers IPv4 address. Used only in "Gateway Mode".
         }
-        """
 
+        :raises: KeyError if wasn't specified required items in order parameter,
+            :class:`PyCardPay.exceptions.ValidationError` if they are missing or invalid and *validate* is enabled.
+        """
+        if self.validate:
+            self._validate_order(order)
         order = dict(order, wallet_id=self.wallet_id)
+        started = metrics.phase_started()
         xml = order_to_xml(order)
-        order_xml = xml_to_string(xml, encode_base64=True).decode('utf-8')
-        order_sha = xml_get_sha512(xml, self.secret)
+        metrics.phase_done('pay', 'build', started)
+        started = metrics.phase_started()
+        order_xml, order_sha = xml_sign(xml, self.secret)
+        metrics.phase_done('pay', 'sign', started)
 
-        return {'orderXML': order_xml, 'sha512': order_sha}
+        return {'orderXML': order_xml.decode('utf-8'), 'sha512': order_sha}
 
+    @hooks.traced
     def status(self, **kwargs):
         """Get transactions report
 
@@ -107,8 +192,10 @@ class CardPay:
                           client_password=self.client_password_sha256,
                           wallet_id=self.wallet_id,
                           settings=self.settings,
+                          transport=self.transport,
                           **kwargs)
 
+    @hooks.traced
     def void(self, id):
         """Change transaction status to "VOID"
 
@@ -124,8 +211,10 @@ class CardPay:
         """
         return api.void(id=id, client_login=self.client_login,
                         client_password=self.client_password_sha256,
-                        settings=self.settings)
+                        settings=self.settings,
+                        transport=self.transport)
 
+    @hooks.traced
     def refund(self, id, reason, amount=None):
         """Change transaction status to "REFUND"
 
@@ -145,8 +234,10 @@ class CardPay:
         kwargs = {} if amount is None else {'amount': amount}
         return api.refund(id=id, reason=reason, client_login=self.client_login,
                           client_password=self.client_password_sha256,
-                          settings=self.settings, **kwargs)
+                          settings=self.settings,
+                          transport=self.transport, **kwargs)
 
+    @hooks.traced
     def capture(self, id):
         """Change transaction status to "CAPTURE"
 
@@ -162,8 +253,60 @@ class CardPay:
         """
         return api.capture(id=id, client_login=self.client_login,
                            client_password=self.client_password_sha256,
-                           settings=self.settings)
+                           settings=self.settings,
+                           transport=self.transport)
+
+    def _status_changes(self, fn, items, key, max_in_flight, stream):
+        results = bulk.iter_status_changes(fn, items, key, max_in_flight)
+        return results if stream else dict(results)
+
+    def capture_many(self, ids, max_in_flight=bulk.DEFAULT_MAX_IN_FLIGHT,
+                     stream=False):
+        """Change status of many transactions to "CAPTURE" concurrently
+
+        :param ids: Transaction ids, may be a lazy iterator of any length
+        :type ids: iterable
+        :param max_in_flight: (optional) Maximum number of concurrent requests
+        :type max_in_flight: int
+        :param stream: (optional) Yield ``(id, result)`` tuples as they complete instead of returning dict
+        :type stream: bool
+        :returns: dict -- result of :meth:`capture` keyed by transaction id
+
+        Return dict structure:
 
+        >>> {
+            1001: {'is_executed': True, 'details': ''},
+            1002: {'is_executed': False, 'details': 'Reason'},
+            1003: {'is_executed': False, 'details': 'Communication error',
+                   'exception': CommunicationError(...)},
+        }
+        """
+        return self._status_changes(self.capture, ids, lambda id: id,
+                                    max_in_flight, stream)
+
+    def void_many(self, ids, max_in_flight=bulk.DEFAULT_MAX_IN_FLIGHT,
+                  stream=False):
+        """Change status of many transactions to "VOID" concurrently
+
+        Takes the same parameters and returns the same structure as :meth:`capture_many`.
+        """
+        return self._status_changes(self.void, ids, lambda id: id,
+                                    max_in_flight, stream)
+
+    def refund_many(self, refunds, max_in_flight=bulk.DEFAULT_MAX_IN_FLIGHT,
+                    stream=False):
+        """Refund many transactions concurrently
+
+        :param refunds: ``(id, reason)`` or ``(id, reason, amount)`` tuples, may be a lazy iterator
+        :type refunds: iterable
+
+        Other parameters and returned structure are the same as in :meth:`capture_many`.
+        """
+        return self._status_changes(lambda args: self.refund(*args), refunds,
+                                    lambda args: args[0], max_in_flight,
+                                    stream)
+
+    @hooks.traced
     def pay(self, order, items=None, billing=None, shipping=None, card=None,
             card_token=None, recurring=None):
         """Process payment
@@ -184,7 +327,8 @@ class CardPay:
         :type card_token: str
         :param recurring: Recurring payment
         :type recurring: dict
-        :raises: KeyError if wasn't specified required items in order parameter.
+        :raises: KeyError if required items are missing, :class:`PyCardPay.exceptions.ValidationError`
+            if they are missing or invalid and *validate* is enabled.
         :raises: :class:`PyCardPay.exceptions.XMLParsingError` if response contains unknown xml structure.
         :returns: dict -- see below for description
 
@@ -263,6 +407,14 @@ class CardPay:
             'url':  '...',              # URL you need to redirect customer to
         }
         """
+        xml = self._order_xml(order, items=items, billing=billing,
+                              shipping=shipping, card=card,
+                              card_token=card_token, recurring=recurring)
+        return api.pay(xml, self.secret, settings=self.settings,
+                       transport=self.transport)
+
+    def _order_xml(self, order, items=None, billing=None, shipping=None,
+                   card=None, card_token=None, recurring=None):
         if order.get('generate_card_token'):
             assert card_token is None, \
                 ('"card_token" and "generate_card_token" arguments '
@@ -272,7 +424,10 @@ class CardPay:
                 ('If "card_token" is used card object must contain '
                  'only "cvv" field')
 
+        if self.validate:
+            card = self._validate_order(order, items, card, card_token)
         order = dict(order, wallet_id=self.wallet_id)
+        started = metrics.phase_started()
         xml = order_to_xml(
             order,
             items=items,
@@ -282,8 +437,52 @@ class CardPay:
             card_token=card_token,
             recurring=recurring
         )
-        return api.pay(xml, self.secret, settings=self.settings)
+        metrics.phase_done('pay', 'build', started)
+        return xml
+
+    def _validate_order(self, order, items=None, card=None, card_token=None):
+        """Raises :class:`ValidationError` for invalid *order*; returns *card* with normalized number"""
+        errors = validation.validate_order(order, items=items, card=card,
+                                           card_token=card_token)
+        if errors:
+            raise ValidationError(errors)
+        if card and card.get('num'):
+            card = dict(card, num=validation.normalize_pan(card['num']))
+        return card
+
+    def _sign_payment(self, payment):
+        xml = self._order_xml(**payment)
+        started = metrics.phase_started()
+        signature = xml_sign(xml, self.secret)
+        metrics.phase_done('pay', 'sign', started)
+        return signature
+
+    def pay_many(self, payments, max_in_flight=bulk.DEFAULT_MAX_IN_FLIGHT):
+        """Process many payments concurrently, e.g. gateway mode *card_token* renewals.
+
+        Orders are built and signed in a separate pipeline stage while
+        previous ones are being sent, at most *max_in_flight* at once.
+
+        :param payments: Dicts of :meth:`pay` keyword arguments (``order``, ``card``, ``card_token``, ...);
+            may be a lazy iterator of any length
+        :type payments: iterable
+        :param max_in_flight: (optional) Maximum number of concurrent requests
+        :type max_in_flight: int
+        :returns: iterator of ``(order number, result)`` tuples as payments complete
+
+        *result* is the dict returned by :meth:`pay`, or ``{'exception': exc}``
+        if the order couldn't be built or the request failed.
+
+        Usage example:
+
+        >>> renewals = ({'order': {'number': s.id, 'amount': s.price, 'email': s.email, 'is_gateway': True},
+        ...              'card': {'cvv': s.cvv}, 'card_token': s.card_token} for s in due_subscriptions())
+        >>> for number, result in client.pay_many(renewals, max_in_flight=64):
+        ...     ...
+        """
+        return bulk.iter_payments(self, payments, max_in_flight=max_in_flight)
 
+    @hooks.traced
     def payouts(self, data, card=None, card_token=None):
         """Create Payout order.
 
@@ -360,6 +559,9 @@ class CardPay:
                 }
             ]
         }
+
+        With *validate* enabled, invalid data is rejected with the same
+        structure without sending a request.
         """
         if card_token is not None:
             assert card is None, ('"card_token" and "card" arguments '
@@ -367,13 +569,63 @@ class CardPay:
         else:
             assert set(card.keys()) == set(['number', 'expiryMonth',
                                             'expiryYear'])
+        if self.validate:
+            errors = validation.validate_payout(data, card=card,
+                                                card_token=card_token)
+            if errors:
+                return {'errors': errors}
+            if card is not None:
+                card = dict(card, number=validation.normalize_pan(
+                    card['number']))
 
         return api.payouts(
             self.wallet_id, self.client_login, self.client_password,
             data=data, card=card, card_token=card_token,
-            settings=self.settings
+            settings=self.settings, transport=self.transport
         )
 
+    def payouts_many(self, payouts, max_in_flight=bulk.DEFAULT_MAX_IN_FLIGHT,
+                     ledger=None, retries=2):
+        """Create many Payout orders concurrently.
+
+        :param payouts: Dicts with ``data`` and ``card`` or ``card_token`` keys, see :meth:`payouts`
+        :type payouts: iterable
+        :param max_in_flight: (optional) Maximum number of concurrent payouts
+        :type max_in_flight: int
+        :param ledger: (optional) Journal file name or :class:`PyCardPay.bulk.PayoutLedger`; an interrupted
+            run resumes from it without paying anything out twice
+        :type ledger: str|unicode
+        :param retries: (optional) Attempts after communication or HTTP errors
+        :type retries: int
+        :returns: iterator of ``(merchantOrderId, result)`` tuples as payouts complete
+
+        See :func:`PyCardPay.bulk.iter_payouts` for details.
+
+        Usage example:
+
+        >>> rows = ({'data': {...}, 'card': {...}} for row in read_payout_file())
+        >>> for merchant_order_id, result in client.payouts_many(rows, ledger='payouts-2016-12-20.log'):
+        ...     if 'errors' in result:
+        ...         print(merchant_order_id, result['errors'])
+        """
+        if ledger is None or isinstance(ledger, bulk.PayoutLedger):
+            return bulk.iter_payouts(self, payouts,
+                                     max_in_flight=max_in_flight,
+                                     ledger=ledger, retries=retries)
+        return self._payouts_with_ledger(payouts, max_in_flight,
+                                         bulk.PayoutLedger(ledger), retries)
+
+    def _payouts_with_ledger(self, payouts, max_in_flight, ledger, retries):
+        # Ledger opened from a file name is closed when iteration ends
+        try:
+            for item in bulk.iter_payouts(self, payouts,
+                                          max_in_flight=max_in_flight,
+                                          ledger=ledger, retries=retries):
+                yield item
+        finally:
+            ledger.close()
+
+    @hooks.traced
     def list_payments(self, start_millis, end_millis, wallet_id=None,
                       max_count=None):
         """Get the list of orders for a period of time. This service will return only orders available for this user to be seen.
@@ -417,8 +669,22 @@ class CardPay:
         return api.list_payments(self.client_login, self.client_password,
                                  start_millis=start_millis, end_millis=end_millis,
                                  wallet_id=self.wallet_id, max_count=max_count,
-                                 settings=self.settings)
+                                 settings=self.settings,
+                                 transport=self.transport)
+
+    def iter_payments(self, start_millis, end_millis, max_count=None):
+        """Iterate over orders for a period of time of any length, following pages.
+
+        See :func:`PyCardPay.api.iter_payments` for details.
+        """
+        return api.iter_payments(
+            self.client_login, self.client_password,
+            start_millis=start_millis, end_millis=end_millis,
+            wallet_id=self.wallet_id, max_count=max_count,
+            settings=self.settings, transport=self.transport
+        )
 
+    @hooks.traced
     def payments_status(self, id):
         """Use this call to get the status of the payment by it’s id.
 
@@ -440,9 +706,9 @@ class CardPay:
             }
         }
         """
-        return api.payments_status(id, self.client_login, self.client_password,
-                                   settings=self.settings)
+        return self._get_status('payments', id, api.payments_status)
 
+    @hooks.traced
     def list_refunds(self, start_millis, end_millis, wallet_id=None,
                      max_count=None):
         """Get the list of refunds for a period of time. This service will return only orders available for this user to be seen.
@@ -484,9 +750,22 @@ class CardPay:
             self.client_login, self.client_password,
             start_millis=start_millis, end_millis=end_millis,
             wallet_id=self.wallet_id, max_count=max_count,
-            settings=self.settings
+            settings=self.settings, transport=self.transport
         )
 
+    def iter_refunds(self, start_millis, end_millis, max_count=None):
+        """Iterate over refunds for a period of time of any length, following pages.
+
+        See :func:`PyCardPay.api.iter_refunds` for details.
+        """
+        return api.iter_refunds(
+            self.client_login, self.client_password,
+            start_millis=start_millis, end_millis=end_millis,
+            wallet_id=self.wallet_id, max_count=max_count,
+            settings=self.settings, transport=self.transport
+        )
+
+    @hooks.traced
     def refunds_status(self, id):
         """Use this call to get the status of the refund by it’s id.
 
@@ -508,9 +787,9 @@ class CardPay:
             }
         }
         """
-        return api.refunds_status(id, self.client_login, self.client_password,
-                                  settings=self.settings)
+        return self._get_status('refunds', id, api.refunds_status)
 
+    @hooks.traced
     def list_payouts(self, start_millis, end_millis, wallet_id=None,
                      max_count=None):
         """Get the list of payouts for a period of time. This service will return only orders available for this user to be seen.
@@ -549,9 +828,22 @@ class CardPay:
             self.client_login, self.client_password,
             start_millis=start_millis, end_millis=end_millis,
             wallet_id=self.wallet_id, max_count=max_count,
-            settings=self.settings
+            settings=self.settings, transport=self.transport
+        )
+
+    def iter_payouts(self, start_millis, end_millis, max_count=None):
+        """Iterate over payouts for a period of time of any length, following pages.
+
+        See :func:`PyCardPay.api.iter_payouts` for details.
+        """
+        return api.iter_payouts(
+            self.client_login, self.client_password,
+            start_millis=start_millis, end_millis=end_millis,
+            wallet_id=self.wallet_id, max_count=max_count,
+            settings=self.settings, transport=self.transport
         )
 
+    @hooks.traced
     def payouts_status(self, id):
         """Use this call to get the status of the payout by it’s id.
 
@@ -573,16 +865,23 @@ class CardPay:
             }
         }
         """
-        return api.payouts_status(id, self.client_login, self.client_password,
-                                  settings=self.settings)
+        return self._get_status('payouts', id, api.payouts_status)
 
+    @hooks.traced
     def payouts_status_by_number(self, number):
+        if self.store is not None:
+            rows = self.store.find_by_number(number, kind='payouts',
+                                             wallet_id=self.wallet_id)
+            if rows and self.store.current_rows(
+                    'payouts', rows, self.store_max_age,
+                    wallet_id=self.wallet_id):
+                return {'data': rows, 'hasMore': False}
         return api.payouts_status_by_number(
             number=number,
             wallet_id=self.wallet_id,
             client_login=self.client_login,
             client_password=self.client_password,
-            settings=self.settings
+            settings=self.settings, transport=self.transport
         )
 
     def parse_callback(self, base64_string, sha512):
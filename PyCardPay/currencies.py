@@ -0,0 +1,75 @@
+# coding=utf-8
+"""ISO 4217 currency codes and the number of digits of their minor units."""
+
+from decimal import Decimal, InvalidOperation
+
+_EXPONENTS = {
+    0: 'BIF CLP DJF GNF ISK JPY KMF KRW PYG RWF UGX UYI VND VUV XAF XOF XPF',
+    2: 'AED AFN ALL AMD ANG AOA ARS AUD AWG AZN BAM BBD BDT BGN BMD BND BOB '
+       'BOV BRL BSD BTN BWP BYN BZD CAD CDF CHE CHF CHW CNY COP COU CRC CUP '
+       'CVE CZK DKK DOP DZD EGP ERN ETB EUR FJD FKP GBP GEL GHS GIP GMD GTQ '
+       'GYD HKD HNL HTG HUF IDR ILS INR IRR JMD KES KGS KHR KPW KYD KZT LAK '
+       'LBP LKR LRD LSL MAD MDL MGA MKD MMK MNT MOP MRU MUR MVR MWK MXN MXV '
+       'MYR MZN NAD NGN NIO NOK NPR NZD PAB PEN PGK PHP PKR PLN QAR RON RSD '
+       'RUB SAR SBD SCR SDG SEK SGD SHP SLE SOS SRD SSP STN SVC SYP SZL THB '
+       'TJS TMT TOP TRY TTD TWD TZS UAH USD USN UYU UZS VED VES WST XCD XCG '
+       'YER ZAR ZMW ZWG',
+    3: 'BHD IQD JOD KWD LYD OMR TND',
+    4: 'CLF UYW',
+}
+
+# Currency code -> digits after the decimal point, e.g. {'USD': 2, 'JPY': 0}
+EXPONENTS = dict((code, exponent) for exponent, codes in _EXPONENTS.items()
+                 for code in codes.split())
+
+CURRENCIES = frozenset(EXPONENTS)
+
+_POWERS = tuple(10 ** n for n in range(max(EXPONENTS.values()) + 1))
+
+
+def exponent(currency):
+    """Returns number of minor unit digits of *currency*
+
+    :raises: KeyError on unknown currency codes
+    """
+    return EXPONENTS[currency.upper()]
+
+
+def to_minor(amount, currency):
+    """Converts *amount* in *currency* to integer minor units, e.g. ``to_minor('14.14', 'EUR') == 1414``
+
+    :param amount: Amount as returned by CardPay, e.g. '14.14' or 14.14
+    :type amount: str|int|float|:class:`decimal.Decimal`
+    :raises: KeyError on unknown currency codes, ValueError if *amount* isn't a
+        number or has more decimal places than *currency* allows
+    :returns: int
+    """
+    digits = EXPONENTS.get(currency)
+    if digits is None:
+        digits = EXPONENTS[currency.upper()]
+    if amount.__class__ is str:
+        # Fast path for the usual '123.45'
+        whole, _, fraction = amount.partition('.')
+        if len(fraction) <= digits and whole.isdecimal() and \
+                (fraction.isdecimal() or not fraction):
+            return int(whole + fraction) * _POWERS[digits - len(fraction)]
+    elif isinstance(amount, int) and not isinstance(amount, bool):
+        return amount * 10 ** digits
+    try:
+        value = Decimal(str(amount)).scaleb(digits)
+    except (InvalidOperation, ValueError):
+        raise ValueError('Invalid amount: {!r}'.format(amount))
+    if not value.is_finite():
+        raise ValueError('Invalid amount: {!r}'.format(amount))
+    if value != value.to_integral_value():
+        raise ValueError('Amount {!r} has more than {} decimal places for {}'
+                         .format(amount, digits, currency))
+    return int(value)
+
+
+def from_minor(minor, currency):
+    """Converts integer *minor* units of *currency* to :class:`decimal.Decimal`
+
+    :raises: KeyError on unknown currency codes
+    """
+    return Decimal(minor).scaleb(-EXPONENTS[currency.upper()])
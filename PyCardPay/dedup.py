@@ -0,0 +1,162 @@
+# coding=utf-8
+
+import binascii
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Default time in seconds a callback is remembered
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def callback_key(sha512):
+    """Returns compact dedup key of a callback.
+
+    The *sha512* sent with a callback is already a digest of the payload and
+    the secret, so its first 16 bytes identify the notification without
+    hashing the payload again.
+
+    :param sha512: SHA512 checksum sent with the callback
+    :type sha512: str
+    :returns: bytes or ``None`` if *sha512* isn't a hex string
+    """
+    try:
+        return binascii.unhexlify(sha512[:32])
+    except (TypeError, ValueError):
+        return None
+
+
+class CallbackDeduplicator:
+    """Bounded in-memory set of handled callbacks.
+
+    Keys expire after *ttl* seconds; when *max_size* keys are stored the
+    oldest one is evicted. All operations are O(1).
+
+    :param max_size: (optional) Maximum number of remembered callbacks
+    :type max_size: int
+    :param ttl: (optional) Seconds a callback is remembered
+    :type ttl: int|float
+    """
+
+    def __init__(self, max_size=100000, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _expire(self, now):
+        keys = self._keys
+        while keys:
+            key, added = next(iter(keys.items()))
+            if now - added < self.ttl and len(keys) <= self.max_size:
+                break
+            keys.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            added = self._keys.get(key)
+        return added is not None and time.time() - added < self.ttl
+
+    def add(self, key):
+        """Remembers *key*.
+
+        :returns: bool -- False if *key* was already remembered
+        """
+        now = time.time()
+        with self._lock:
+            added = self._keys.get(key)
+            if added is not None and now - added < self.ttl:
+                return False
+            self._keys.pop(key, None)
+            self._keys[key] = now
+            self._expire(now)
+        return True
+
+    def discard(self, key):
+        """Forgets *key*, e.g. when its callback couldn't be handled"""
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+class FileDeduplicator:
+    """Set of handled callbacks shared by processes through a SQLite file.
+
+    Has the interface of :class:`CallbackDeduplicator`, which is used as a
+    local front so keys seen by this process are answered without I/O.
+    Every process and thread opens its own connection, so it can be created
+    before a pre-forking server forks its workers.
+
+    :param path: Database file name
+    :type path: str|unicode
+    :param ttl: (optional) Seconds a callback is remembered
+    :type ttl: int|float
+    :param max_size: (optional) Size of the in-memory front
+    :type max_size: int
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_size=100000):
+        self.path = path
+        self.ttl = ttl
+        self._front = CallbackDeduplicator(max_size=max_size, ttl=ttl)
+        self._local = threading.local()
+        self._last_prune = 0
+        db = self._db()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS callbacks '
+                       '(key BLOB PRIMARY KEY, added REAL NOT NULL) '
+                       'WITHOUT ROWID')
+
+    def _db(self):
+        local = self._local
+        pid = os.getpid()
+        # Connections inherited through fork() must not be used
+        if getattr(local, 'pid', None) != pid:
+            db = sqlite3.connect(self.path, timeout=10,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            local.db = db
+            local.pid = pid
+        return local.db
+
+    def __contains__(self, key):
+        if key in self._front:
+            return True
+        row = self._db().execute(
+            'SELECT added FROM callbacks WHERE key = ?', (key,)
+        ).fetchone()
+        return row is not None and time.time() - row[0] < self.ttl
+
+    def add(self, key):
+        """Remembers *key* for all processes.
+
+        :returns: bool -- False if *key* was already remembered
+        """
+        if key in self._front:
+            return False
+        now = time.time()
+        db = self._db()
+        cursor = db.execute(
+            'INSERT INTO callbacks (key, added) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET added = excluded.added '
+            'WHERE callbacks.added < ?',
+            (key, now, now - self.ttl)
+        )
+        added = cursor.rowcount == 1
+        self._front.add(key)
+        if now - self._last_prune > self.ttl / 100:
+            self._last_prune = now
+            db.execute('DELETE FROM callbacks WHERE added < ?',
+                       (now - self.ttl,))
+        return added
+
+    def discard(self, key):
+        """Forgets *key*, e.g. when its callback couldn't be handled"""
+        self._front.discard(key)
+        self._db().execute('DELETE FROM callbacks WHERE key = ?', (key,))
@@ -1,16 +1,71 @@
+from .redact import redact
+
+# Bytes of the response body kept in errors, ``None`` keeps the whole body
+CONTENT_LIMIT = 2048
+
+# Keep response objects in :attr:`HTTPError.response` and HTTP library
+# exceptions wrapped by :class:`CommunicationError`; by default only status
+# code, headers and a body snippet are kept
+KEEP_RESPONSE = False
+
+
+def _snippet(content):
+    if content is None or CONTENT_LIMIT is None or \
+            len(content) <= CONTENT_LIMIT:
+        return content
+    return content[:CONTENT_LIMIT]
+
+
 class PyCardPayException(Exception):
     """Base PyCardPay exception."""
     pass
 
 
-class ParsingError(PyCardPayException):
+class _RequestError(PyCardPayException):
+    """Error of a request with bounded memory footprint.
+
+    Request *data* is redacted once when the error is created (see
+    :func:`PyCardPay.redact.redact`) and the response body is cut to
+    :data:`CONTENT_LIMIT` bytes.
+
+    :ivar content: Response body snippet
+    :ivar content_length: Size of the whole response body
+    """
+
     def __init__(self, msg, method=None, url=None, data=None, content=None):
         self.msg = msg
         self.method = method
         self.url = url
-        self.data = data
-        self.content = content
-        super(ParsingError, self).__init__(msg)
+        self.data = redact(data)
+        self.content_length = len(content) if content is not None else None
+        self.content = _snippet(content)
+        self._summary = None
+        super(_RequestError, self).__init__(msg)
+
+    @property
+    def summary(self):
+        """Request and response details as text, rendered on first access"""
+        if self._summary is None:
+            lines = [self.msg]
+            if self.url is not None:
+                lines.append(u'{} {}'.format((self.method or '').upper(),
+                                             self.url))
+            if self.data is not None:
+                lines.append(u'data: {!r}'.format(self.data))
+            if self.content is not None:
+                content = self.content
+                if isinstance(content, bytes):
+                    content = content.decode('utf-8', 'replace')
+                truncated = len(self.content) < self.content_length
+                lines.append(u'content ({} bytes{}): {}'.format(
+                    self.content_length, ', truncated' if truncated else '',
+                    content))
+            self._summary = u'\n'.join(lines)
+        return self._summary
+
+
+class ParsingError(_RequestError):
+    pass
 
 
 class XMLParsingError(ParsingError):
@@ -28,22 +83,37 @@ class SignatureError(PyCardPayException):
     pass
 
 
-class HTTPError(PyCardPayException):
+class HTTPError(_RequestError):
     """Raised when requests.Response.response_code contains value
     other than 2xx.
+
+    The response is dropped after its status code, headers and a body
+    snippet are captured, unless :data:`KEEP_RESPONSE` is set.
+
+    :ivar status_code: HTTP status code
+    :ivar headers: Response headers
     """
     def __init__(self, msg, method=None, url=None, data=None, response=None):
-        self.msg = msg
-        self.method = method
-        self.url = url
-        self.data = data
-        self.response = response
-        super(HTTPError, self).__init__(msg)
+        content = None
+        self.status_code = self.headers = None
+        if response is not None:
+            content = response.content
+            self.status_code = response.status_code
+            self.headers = dict(response.headers)
+        self.response = response if KEEP_RESPONSE else None
+        super(HTTPError, self).__init__(msg, method=method, url=url,
+                                        data=data, content=content)
 
 
 class CommunicationError(PyCardPayException):
     """Raised when arbitrary requests exception occures"""
     def __init__(self, msg, exc):
+        if not KEEP_RESPONSE:
+            # requests exceptions hold the sent request with its body and
+            # credentials
+            for name in ('request', 'response'):
+                if getattr(exc, name, None) is not None:
+                    setattr(exc, name, None)
         self.exc = exc
         self.msg = msg
         super(CommunicationError, self).__init__(exc)
@@ -51,3 +121,25 @@ class CommunicationError(PyCardPayException):
 
 class TransactionNotFound(PyCardPayException):
     pass
+
+
+class StatusTimeout(PyCardPayException):
+    """Raised when a transaction didn't reach a final state in time
+
+    :ivar data: Last seen list row or status ``data`` of the transaction, if any
+    """
+    def __init__(self, msg, data=None):
+        self.data = data
+        super(StatusTimeout, self).__init__(msg)
+
+
+class ValidationError(PyCardPayException, ValueError):
+    """Raised when local validation rejected request data before sending it
+
+    :ivar errors: Errors in CardPay API format, see :mod:`PyCardPay.validation`
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        msg = u'; '.join(u'{}: {}'.format(e['source']['pointer'], e['detail'])
+                         for e in errors)
+        super(ValidationError, self).__init__(msg)
@@ -0,0 +1,462 @@
+# coding=utf-8
+"""Streaming export of payments, refunds and payouts to CSV, JSONL or Parquet.
+
+The requested period is split into windows fetched concurrently. Every
+fetched window is saved to a gzipped JSONL checkpoint file, so an export
+that was interrupted fetches only the missing windows when it's run again.
+The output is assembled from checkpoints in date order while later windows
+are still being fetched; at most a few windows are held in flight, so memory
+use doesn't depend on the length of the period. Checkpoints are removed after
+the output is complete.
+
+Usage example::
+
+    python -m PyCardPay export payments --url https://cardpay.com/MI \\
+        --wallet-id 1 --login login --start 2024-01-01 --end 2024-07-01 \\
+        --format csv --output payments.csv.gz
+
+or from code:
+
+>>> from PyCardPay import export
+>>> export.export(client, 'payments', start_millis, end_millis, 'payments.jsonl.gz')
+{'rows': 183204, 'windows': 182, 'resumed': 0}
+"""
+
+import argparse
+import bz2
+import calendar
+import collections
+import concurrent.futures
+import csv
+import datetime as dt
+import gzip
+import json
+import logging
+import lzma
+import os
+import shutil
+import sys
+import tempfile
+
+from . import api
+from .store import KINDS
+
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+# Default length of a fetched window in milliseconds
+DEFAULT_WINDOW = 24 * 60 * 60 * 1000
+
+# Default CSV/Parquet columns per kind, other fields are only kept in JSONL
+COLUMNS = {
+    'payments': ('id', 'number', 'state', 'date', 'customerId', 'email',
+                 'currency', 'amount', 'refundedAmount', 'is3d', 'authCode',
+                 'declineCode', 'declineReason', 'note'),
+    'refunds': ('id', 'number', 'state', 'date', 'customerId', 'email',
+                'currency', 'amount', 'is3d', 'authCode', 'originalOrderId'),
+    'payouts': ('id', 'number', 'state', 'date', 'currency', 'amount',
+                'is3d'),
+}
+
+# Rows per Parquet row group
+PARQUET_ROW_GROUP = 65536
+
+_COMPRESSION = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+_OPENERS = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+
+
+def _infer_compression(output):
+    return _COMPRESSION.get(os.path.splitext(output)[1].lower())
+
+
+def _open_text(path, compression):
+    if path == '-':
+        # export() rejects compression of standard output
+        return os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8',
+                         newline='')
+    opener = _OPENERS.get(compression, open) if compression else open
+    return opener(path, 'wt', encoding='utf-8', newline='')
+
+
+class _JSONLWriter:
+    """Copies checkpoint lines as they are, they already are JSON"""
+
+    def __init__(self, path, compression, columns):
+        self.file = _open_text(path, compression)
+        self.columns = columns
+
+    def write_line(self, line):
+        if self.columns is None:
+            self.file.write(line)
+        else:
+            row = json.loads(line)
+            self.file.write(json.dumps(
+                dict((k, row.get(k)) for k in self.columns),
+                ensure_ascii=False, separators=(',', ':')))
+            self.file.write('\n')
+
+    def close(self):
+        self.file.close()
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return value
+
+
+class _CSVWriter:
+    def __init__(self, path, compression, columns):
+        self.file = _open_text(path, compression)
+        self.columns = columns
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write_line(self, line):
+        row = json.loads(line)
+        self.writer.writerow([_cell(row.get(k)) for k in self.columns])
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetWriter:
+    """Writes row groups of :data:`PARQUET_ROW_GROUP` rows; 'date' is int64, other columns are strings"""
+
+    def __init__(self, path, compression, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Parquet export requires pyarrow: '
+                              'pip install pyarrow')
+        if path == '-':
+            raise ValueError('Parquet output must be a file')
+        self.pyarrow = pyarrow
+        self.columns = columns
+        self.schema = pyarrow.schema([
+            (name, pyarrow.int64() if name == 'date' else pyarrow.string())
+            for name in columns
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression=compression or 'snappy')
+        self.batch = dict((name, []) for name in columns)
+        self.size = 0
+
+    def write_line(self, line):
+        row = json.loads(line)
+        for name in self.columns:
+            value = row.get(name)
+            if value is not None and name != 'date':
+                value = _cell(value)
+                if not isinstance(value, str):
+                    value = json.dumps(value)
+            self.batch[name].append(value)
+        self.size += 1
+        if self.size >= PARQUET_ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        if self.size:
+            self.writer.write_table(self.pyarrow.Table.from_pydict(
+                self.batch, schema=self.schema))
+            for values in self.batch.values():
+                del values[:]
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+_WRITERS = {'csv': _CSVWriter, 'jsonl': _JSONLWriter,
+            'parquet': _ParquetWriter}
+
+
+def _windows(start_millis, end_millis, window):
+    while start_millis < end_millis:
+        window_end = min(end_millis, start_millis + window)
+        yield start_millis, window_end
+        start_millis = window_end
+
+
+def _checkpoint(checkpoint_dir, kind, wallet_id, start, end):
+    return os.path.join(checkpoint_dir, '{}-{}-{}-{}.jsonl.gz'.format(
+        kind, wallet_id or 0, start, end))
+
+
+def _fetch_window(client, kind, start, end, path, max_count):
+    """Saves rows of one window to checkpoint *path*, returns their number"""
+    tmp = path + '.tmp'
+    count = 0
+    rows = api._iter_list(
+        getattr(client.settings, KINDS[kind]), client.client_login,
+        client.client_password, start, end, wallet_id=client.wallet_id,
+        max_count=max_count, transport=client.transport
+    )
+    with gzip.open(tmp, 'wt', compresslevel=1, encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+    # A checkpoint exists only once its window is complete
+    os.replace(tmp, path)
+    logger.debug('Fetched %s %d..%d: %d rows', kind, start, end, count)
+    return count
+
+
+def _done(count):
+    future = concurrent.futures.Future()
+    future.set_result(count)
+    return future
+
+
+def export(client, kind, start_millis, end_millis, output, format='jsonl',
+           window=DEFAULT_WINDOW, workers=4, checkpoint_dir=None,
+           compression=None, columns=None, max_count=None, progress=None):
+    """Exports transactions of a period.
+
+    :param client: Client providing credentials, wallet and settings
+    :type client: :class:`PyCardPay.CardPay`
+    :param kind: 'payments', 'refunds' or 'payouts'
+    :param start_millis: Epoch time in milliseconds when exported period starts (inclusive)
+    :type start_millis: int
+    :param end_millis: Epoch time in milliseconds when exported period ends (not inclusive)
+    :type end_millis: int
+    :param output: Output file, '-' for standard output (uncompressed)
+    :type output: str|unicode
+    :param format: (optional) 'jsonl', 'csv' or 'parquet' (requires pyarrow)
+    :param window: (optional) Length of a fetched and checkpointed window in milliseconds
+    :type window: int
+    :param workers: (optional) Windows fetched concurrently
+    :type workers: int
+    :param checkpoint_dir: (optional) Directory of window checkpoints, ``<output>.parts`` by default.
+        Writing to standard output without it uses a temporary directory removed even when
+        the export fails, so it can't be resumed.
+        A given directory is kept, only the checkpoints of this export are removed from it.
+    :type checkpoint_dir: str|unicode
+    :param compression: (optional) 'gzip', 'bz2' or 'xz' (Parquet codec name for Parquet),
+        inferred from *output* extension by default; not supported for standard output
+    :param columns: (optional) CSV/Parquet columns, :data:`COLUMNS` of *kind* by default;
+        JSONL rows are exported whole unless set
+    :type columns: list
+    :param max_count: (optional) Page size of list requests
+    :type max_count: int
+    :param progress: (optional) Called with ``(start, end, rows, resumed)`` for every window written to output
+    :type progress: callable
+    :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`,
+        :class:`PyCardPay.exceptions.CommunicationError`
+    :returns: dict -- ``{'rows': int, 'windows': int, 'resumed': int}``
+    """
+    if kind not in KINDS:
+        raise ValueError('Unknown kind: {!r}'.format(kind))
+    if format not in _WRITERS:
+        raise ValueError('Unknown format: {!r}'.format(format))
+    if columns is None and format != 'jsonl':
+        columns = COLUMNS[kind]
+    if output == '-':
+        if compression:
+            raise ValueError('Compressed output must be a file, pipe '
+                             'standard output through a compressor instead')
+    elif compression is None and format != 'parquet':
+        compression = _infer_compression(output)
+    # Only directories of the export itself are removed as a whole, in a
+    # given one only checkpoints of this export are
+    temporary = owned = checkpoint_dir is None
+    if checkpoint_dir is None:
+        if output == '-':
+            checkpoint_dir = tempfile.mkdtemp(prefix='pycardpay-export-')
+        else:
+            checkpoint_dir = output + '.parts'
+            temporary = False
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    checkpoints = []
+
+    # Output is written next to its final place and renamed when complete
+    target = output if output == '-' else output + '.tmp'
+    writer = _WRITERS[format](target, compression, columns)
+    stats = {'rows': 0, 'windows': 0, 'resumed': 0}
+    windows = _windows(int(start_millis), int(end_millis), window)
+    pending = collections.deque()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            # Fetch ahead of the writer, but not the whole period at once
+            while len(pending) < workers * 2:
+                try:
+                    start, end = next(windows)
+                except StopIteration:
+                    break
+                path = _checkpoint(checkpoint_dir, kind, client.wallet_id,
+                                   start, end)
+                checkpoints.append(path)
+                if os.path.exists(path):
+                    pending.append((start, end, path, True, _done(None)))
+                else:
+                    pending.append((start, end, path, False, executor.submit(
+                        _fetch_window, client, kind, start, end, path,
+                        max_count)))
+            if not pending:
+                break
+            start, end, path, resumed, future = pending.popleft()
+            future.result()
+            rows = 0
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    writer.write_line(line)
+                    rows += 1
+            stats['rows'] += rows
+            stats['windows'] += 1
+            stats['resumed'] += resumed
+            if progress is not None:
+                progress(start, end, rows, resumed)
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        writer.close()
+        if target != '-':
+            os.remove(target)
+        if temporary:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        raise
+    executor.shutdown()
+    writer.close()
+    if target != '-':
+        os.replace(target, output)
+    if owned:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    else:
+        for path in checkpoints:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return stats
+
+
+def parse_time(value):
+    """Parses epoch milliseconds or ISO 8601 date/time (UTC unless an offset is given)"""
+    if value.isdigit():
+        return int(value)
+    if len(value) == 10:
+        value += 'T00:00:00'
+    value = value.replace('Z', '+00:00')
+    parsed = dt.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(dt.timezone.utc)
+    return calendar.timegm(parsed.timetuple()) * 1000 + \
+        parsed.microsecond // 1000
+
+
+def main(argv=None):
+    from .cardpay import CardPay
+    from .settings import base_url_settings, live_settings, test_settings
+
+    parser = argparse.ArgumentParser(
+        prog='python -m PyCardPay export',
+        description='Export payments, refunds or payouts of a period',
+    )
+    parser.add_argument('kind', choices=sorted(KINDS))
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help="service base URL, e.g. "
+                                      "'https://cardpay.com/MI'")
+    target.add_argument('--sandbox', action='store_true',
+                        help='use sandbox.cardpay.com')
+    parser.add_argument('--wallet-id', type=int, default=None)
+    parser.add_argument('--login', default=os.environ.get('CARDPAY_LOGIN'),
+                        help='defaults to $CARDPAY_LOGIN')
+    parser.add_argument('--password',
+                        default=os.environ.get('CARDPAY_PASSWORD'),
+                        help='defaults to $CARDPAY_PASSWORD')
+    parser.add_argument('--start', type=parse_time, required=True,
+                        help='ISO date/time (UTC) or epoch milliseconds, '
+                             'inclusive')
+    parser.add_argument('--end', type=parse_time, required=True,
+                        help='ISO date/time (UTC) or epoch milliseconds, '
+                             'not inclusive')
+    parser.add_argument('--format', choices=FORMATS, default=None,
+                        help='inferred from --output by default')
+    parser.add_argument('--output', '-o', default='-',
+                        help="output file, '-' for standard output")
+    parser.add_argument('--compression', default=None,
+                        help='gzip, bz2 or xz; inferred from --output '
+                             'by default')
+    parser.add_argument('--columns', default=None,
+                        help='comma separated CSV/Parquet columns')
+    parser.add_argument('--window', type=float, default=1,
+                        help='days fetched per request window')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='defaults to <output>.parts; standard output '
+                             'exports can only be resumed with it')
+    parser.add_argument('--quiet', '-q', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.output == '-' and args.compression:
+        parser.error('--compression requires --output, pipe standard '
+                     'output through a compressor instead')
+    if not args.login or not args.password:
+        parser.error('--login and --password (or $CARDPAY_LOGIN and '
+                     '$CARDPAY_PASSWORD) are required')
+    if args.url:
+        settings = base_url_settings(args.url)
+    else:
+        settings = test_settings if args.sandbox else live_settings
+    fmt = args.format
+    if fmt is None:
+        name = args.output
+        if _infer_compression(name):
+            name = os.path.splitext(name)[0]
+        fmt = os.path.splitext(name)[1].lstrip('.').lower()
+        if fmt not in FORMATS:
+            fmt = 'jsonl'
+
+    def progress(start, end, rows, resumed):
+        if not args.quiet:
+            sys.stderr.write('{} {} .. {}: {} rows{}\n'.format(
+                args.kind, _format_millis(start), _format_millis(end), rows,
+                ' (checkpoint)' if resumed else ''))
+
+    if args.output != '-' or args.checkpoint_dir:
+        resume = 'Rerun the same command to resume\n'
+    else:
+        # Checkpoints of standard output exports are temporary
+        resume = 'Use --checkpoint-dir to make the export resumable\n'
+
+    # Secret is only needed to sign orders, exports don't sign anything
+    client = CardPay(args.wallet_id, '', args.login, args.password,
+                     settings=settings, validate=False)
+    try:
+        stats = export(client, args.kind, args.start, args.end, args.output,
+                       format=fmt, window=int(args.window * DEFAULT_WINDOW),
+                       workers=args.workers,
+                       checkpoint_dir=args.checkpoint_dir,
+                       compression=args.compression,
+                       columns=args.columns.split(',') if args.columns
+                       else None,
+                       progress=progress)
+    except KeyboardInterrupt:
+        sys.stderr.write('Interrupted\n' + resume)
+        return 130
+    except Exception as exc:
+        sys.stderr.write('Export failed: {}\n'.format(exc) + resume)
+        return 1
+    if not args.quiet:
+        sys.stderr.write('{rows} rows in {windows} windows, {resumed} from '
+                         'checkpoints\n'.format(**stats))
+    return 0
+
+
+def _format_millis(millis):
+    return dt.datetime.fromtimestamp(millis / 1000.0, dt.timezone.utc)\
+        .strftime('%Y-%m-%dT%H:%M:%S')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
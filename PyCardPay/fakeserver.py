@@ -0,0 +1,690 @@
+# coding=utf-8
+"""Local stand-in for the CardPay service.
+
+Implements the endpoints of :class:`PyCardPay.settings.Settings` well enough
+to load test clients offline: generated transactions are listed, looked up
+and changed like on the real service, and every response can be delayed,
+failed or cut off at configurable rates.
+
+Usage example:
+
+>>> server = FakeCardPay(wallets={20: ('secret', 'login', 'password')},
+...                      volume=10000, latency=lognormal(0.05, 0.5),
+...                      error_rate=0.01)
+>>> settings = server.start()
+>>> client = CardPay(20, 'secret', 'login', 'password', settings=settings)
+>>> client.list_payments(start_millis, end_millis)['hasMore']
+True
+>>> server.stop()
+
+From the command line::
+
+    python -m PyCardPay.fakeserver --port 8000 --volume 100000 --latency lognormal:0.05,0.5
+"""
+
+import argparse
+import base64
+import bisect
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree
+
+from .api import MAX_LIST_PERIOD
+from .settings import base_url_settings
+
+
+# Default wallet: wallet_id -> (secret, client_login, client_password)
+DEFAULT_WALLETS = {1: ('secret', 'login', 'password')}
+
+# Largest page returned by list endpoints, like on the real service
+MAX_COUNT = 10000
+
+# Default period generated transactions are spread over, in milliseconds
+DEFAULT_PERIOD = 30 * 24 * 60 * 60 * 1000
+
+# Endpoint names used as *latency* and *error_rate* keys
+ENDPOINTS = ('pay', 'status', 'status_change', 'list', 'get', 'create')
+
+KINDS = ('payments', 'refunds', 'payouts')
+
+_STATES = [
+    ('COMPLETED', 70), ('DECLINED', 10), ('AUTHORIZED', 8), ('REFUNDED', 5),
+    ('VOIDED', 3), ('IN_PROGRESS', 2), ('CHARGED_BACK', 2),
+]
+
+# order-report status_name of payment states
+_STATUS_NAMES = {
+    'NEW': 'new', 'IN_PROGRESS': 'in_progress', 'AUTHORIZED': 'authorized',
+    'COMPLETED': 'capture_success', 'DECLINED': 'declined',
+    'VOIDED': 'voided', 'REFUNDED': 'refunded',
+    'CHARGED_BACK': 'chargeback',
+}
+
+# order-change-status: status_to -> (allowed states, new state)
+_TRANSITIONS = {
+    'capture': (('AUTHORIZED',), 'COMPLETED'),
+    'void': (('AUTHORIZED',), 'VOIDED'),
+    'refund': (('COMPLETED',), 'REFUNDED'),
+}
+
+
+def constant(seconds):
+    """Latency distribution: always *seconds*"""
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    """Latency distribution: uniform between *low* and *high* seconds"""
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential(mean):
+    """Latency distribution: exponential with *mean* seconds"""
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+
+def lognormal(median, sigma):
+    """Latency distribution: log-normal with *median* seconds, long tail for large *sigma*"""
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+def parse_latency(spec):
+    """Parses command line latency, e.g. '0.05', 'uniform:0.01,0.1' or 'lognormal:0.05,0.5'"""
+    name, _, args = spec.partition(':')
+    if not args:
+        return constant(float(name))
+    distributions = {'constant': constant, 'uniform': uniform,
+                     'exponential': exponential, 'lognormal': lognormal}
+    try:
+        distribution = distributions[name]
+    except KeyError:
+        raise ValueError('Unknown latency distribution: {}'.format(name))
+    return distribution(*[float(arg) for arg in args.split(',')])
+
+
+class _Response:
+    __slots__ = ('status', 'content_type', 'body')
+
+    def __init__(self, status, content_type, body):
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+
+def _json(status, obj):
+    return _Response(status, 'application/json',
+                     json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+
+def _xml(tag, children=(), **attrs):
+    element = ElementTree.Element(tag, dict(
+        (k, str(v)) for k, v in attrs.items() if v is not None
+    ))
+    element.extend(children)
+    return _Response(200, 'application/xml',
+                     ElementTree.tostring(element, encoding='utf-8'))
+
+
+def _text(status, text):
+    return _Response(status, 'text/plain', text.encode('utf-8'))
+
+
+def _parse_date(value, default):
+    if not value:
+        return default
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int((datetime.strptime(value, fmt) -
+                        datetime(1970, 1, 1)).total_seconds() * 1000)
+        except ValueError:
+            pass
+    return default
+
+
+class FakeCardPay:
+    """Fake CardPay server.
+
+    :param wallets: (optional) wallet_id -> ``(secret, client_login, client_password)``
+    :type wallets: dict
+    :param volume: (optional) Number of generated payments per wallet; about 10% as many refunds
+        (partial refunds of the refunded payments) and payouts are generated
+    :type volume: int
+    :param period: (optional) Milliseconds before now the generated transactions are spread over
+    :type period: int
+    :param latency: (optional) Latency distribution (see :func:`lognormal` and others)
+        or dict of them keyed by endpoint name (see :data:`ENDPOINTS`) with optional 'default'
+    :type latency: callable|dict
+    :param error_rate: (optional) Share of requests answered with HTTP 500, or dict keyed by endpoint name
+    :type error_rate: float|dict
+    :param disconnect_rate: (optional) Share of requests whose connection is closed without response
+    :type disconnect_rate: float
+    :param garbage_rate: (optional) Share of successful responses cut in half, so they fail to parse
+    :type garbage_rate: float
+    :param page_size: (optional) Largest number of rows returned by a list request
+    :type page_size: int
+    :param seed: (optional) Random seed of generated data and failures
+    :type seed: int
+    :param host: (optional) Interface to listen on
+    :type host: str
+    :param port: (optional) Port to listen on, a free one if 0
+    :type port: int
+
+    Attributes controlling failures and latency may be changed while the
+    server is running. :attr:`stats` counts requests per endpoint and outcome.
+    """
+
+    def __init__(self, wallets=None, volume=1000, period=DEFAULT_PERIOD,
+                 latency=None, error_rate=0.0, disconnect_rate=0.0,
+                 garbage_rate=0.0, page_size=MAX_COUNT, seed=None,
+                 host='127.0.0.1', port=0):
+        self.wallets = dict(wallets or DEFAULT_WALLETS)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+        self.garbage_rate = garbage_rate
+        self.page_size = page_size
+        self.host = host
+        self.port = port
+        self.stats = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._logins = {}
+        for wallet_id, (secret, login, password) in self.wallets.items():
+            self._logins[login] = (wallet_id, password)
+        self._rows = {}         # (kind, wallet_id) -> rows ordered by date
+        self._dates = {}        # (kind, wallet_id) -> dates of rows
+        self._by_id = {}        # (kind, id) -> (wallet_id, row)
+        self._next_id = 100000
+        self._server = None
+        self._thread = None
+        self._generate(volume, period)
+
+    # Data
+
+    def _new_id(self):
+        self._next_id += 1
+        return str(self._next_id)
+
+    def _add(self, kind, wallet_id, row):
+        key = (kind, wallet_id)
+        rows = self._rows.setdefault(key, [])
+        dates = self._dates.setdefault(key, [])
+        position = bisect.bisect_right(dates, row['date'])
+        rows.insert(position, row)
+        dates.insert(position, row['date'])
+        self._by_id[(kind, row['id'])] = (wallet_id, row)
+
+    def _generate(self, volume, period):
+        rng = self._rng
+        states = [state for state, weight in _STATES for _ in range(weight)]
+        end = int(time.time() * 1000)
+        start = end - period
+        for wallet_id in sorted(self.wallets):
+            payments = []
+            for n in range(volume):
+                state = rng.choice(states)
+                amount = '{:.2f}'.format(rng.randint(100, 100000) / 100.0)
+                row = {
+                    'id': self._new_id(),
+                    'number': 'order{:08d}'.format(n),
+                    'state': state,
+                    'date': rng.randint(start, end - 1),
+                    'customerId': str(rng.randint(1, max(volume // 5, 1))),
+                    'is3d': rng.random() < 0.3,
+                    'currency': rng.choice(('USD', 'EUR', 'GBP')),
+                    'amount': amount,
+                    'email': 'customer{}@example.com'.format(n),
+                }
+                if state == 'DECLINED':
+                    row['declineReason'] = 'Insufficient funds'
+                    row['declineCode'] = '51'
+                else:
+                    row['authCode'] = 'A{:05d}'.format(rng.randint(0, 99999))
+                if state == 'REFUNDED':
+                    row['refundedAmount'] = amount
+                payments.append(row)
+            for row in sorted(payments, key=lambda row: row['date']):
+                self._add('payments', wallet_id, row)
+            # Every refunded payment gets one to three partial refunds
+            # adding up to its refundedAmount, about 10% of the volume
+            for payment in payments:
+                if payment['state'] != 'REFUNDED':
+                    continue
+                cents = int(round(float(payment['amount']) * 100))
+                parts = min(rng.choice((1, 2, 2, 3)), cents)
+                cuts = sorted(rng.sample(range(1, cents), parts - 1))
+                date = payment['date']
+                for low, high in zip([0] + cuts, cuts + [cents]):
+                    date = rng.randint(date, end)
+                    self._add('refunds', wallet_id, {
+                        'id': self._new_id(),
+                        'number': payment['number'],
+                        'state': 'COMPLETED',
+                        'date': date,
+                        'currency': payment['currency'],
+                        'amount': '{:.2f}'.format((high - low) / 100.0),
+                        'originalOrderId': payment['id'],
+                    })
+            for n in range(volume // 10):
+                self._add('payouts', wallet_id, {
+                    'id': self._new_id(),
+                    'number': 'PO{:08d}'.format(n),
+                    'state': rng.choice(('COMPLETED',) * 9 + ('DECLINED',)),
+                    'date': rng.randint(start, end - 1),
+                    'currency': 'USD',
+                    'amount': '{:.2f}'.format(rng.randint(100, 100000) / 100.0),
+                })
+
+    def count(self, kind, wallet_id=None):
+        """Returns number of stored transactions of *kind*"""
+        with self._lock:
+            return sum(len(rows) for (k, w), rows in self._rows.items()
+                       if k == kind and wallet_id in (None, w))
+
+    def rows(self, kind, wallet_id):
+        """Returns copy of the stored transactions of *kind* ordered by date"""
+        with self._lock:
+            return [dict(row) for row in self._rows.get((kind, wallet_id), [])]
+
+    # Request handling
+
+    def _option(self, value, endpoint, default):
+        if isinstance(value, dict):
+            return value.get(endpoint, value.get('default', default))
+        return value if value is not None else default
+
+    def _count(self, endpoint, outcome):
+        key = (endpoint, outcome)
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def handle(self, method, path, query, form, body, auth):
+        """Answers one request.
+
+        :returns: :class:`_Response` or ``None`` if the connection must be dropped
+        """
+        endpoint, handler, args = self._route(method, path)
+        if handler is None:
+            self._count('unknown', 404)
+            return _text(404, 'Not Found')
+        rng = self._rng
+        latency = self._option(self.latency, endpoint, None)
+        if latency is not None:
+            time.sleep(max(latency(rng), 0))
+        if rng.random() < self.disconnect_rate:
+            self._count(endpoint, 'disconnect')
+            return None
+        if rng.random() < self._option(self.error_rate, endpoint, 0.0):
+            self._count(endpoint, 500)
+            return _text(500, 'Internal Server Error')
+        response = handler(query, form, body, auth, *args)
+        if response.status == 200 and rng.random() < self.garbage_rate:
+            self._count(endpoint, 'garbage')
+            return _Response(200, response.content_type,
+                             response.body[:len(response.body) // 2])
+        self._count(endpoint, response.status)
+        return response
+
+    def _route(self, method, path):
+        parts = [part for part in path.split('/') if part]
+        if len(parts) >= 2 and parts[-2:] == ['service', 'order-report']:
+            return 'status', self._order_report, ()
+        if len(parts) >= 2 and parts[-2:] == ['service', 'order-change-status']:
+            return 'status_change', self._change_status, ()
+        if parts and parts[-1] == 'cardpayment.html':
+            return 'pay', self._pay, ()
+        for n in (1, 2):
+            if len(parts) > n and parts[-n] in KINDS and parts[-n - 1] == 'v2':
+                kind = parts[-n]
+                if n == 2:
+                    return 'get', self._get, (kind, parts[-1])
+                if method == 'POST' and kind == 'payouts':
+                    return 'create', self._create_payout, ()
+                return 'list', self._list, (kind,)
+        return None, None, None
+
+    def _wallet(self, login, password, wallet_id=None):
+        account = self._logins.get(login)
+        if account is None:
+            return None
+        hashed = hashlib.sha256(account[1].encode('utf-8')).hexdigest()
+        if password not in (account[1], hashed):
+            return None
+        if wallet_id not in (None, '') and str(wallet_id) != str(account[0]):
+            return None
+        return account[0]
+
+    def _list(self, query, form, body, auth, kind):
+        wallet_id = self._wallet(*auth) if auth else None
+        if wallet_id is None:
+            return _json(401, {'message': 'Unauthorized'})
+        if 'number' in query:
+            return self._find_by_number(query, kind, wallet_id)
+        try:
+            start = int(query['startMillis'])
+            end = int(query['endMillis'])
+            max_count = int(query.get('maxCount') or MAX_COUNT)
+        except (KeyError, ValueError):
+            return _json(400, {'message': 'startMillis and endMillis are required'})
+        if 'walletId' in query and query['walletId'] != str(wallet_id):
+            return _json(403, {'message': 'Forbidden'})
+        if end <= start or end - start > MAX_LIST_PERIOD or \
+                not 0 < max_count <= MAX_COUNT:
+            return _json(400, {'message': 'Invalid period or maxCount'})
+        max_count = min(max_count, self.page_size)
+        key = (kind, wallet_id)
+        with self._lock:
+            dates = self._dates.get(key, [])
+            first = bisect.bisect_left(dates, start)
+            last = bisect.bisect_left(dates, end)
+            rows = [dict(row) for row in
+                    self._rows[key][first:min(last, first + max_count)]] \
+                if dates else []
+        return _json(200, {'data': rows, 'hasMore': last - first > max_count})
+
+    def _find_by_number(self, query, kind, wallet_id):
+        number = query['number']
+        with self._lock:
+            rows = [dict(row) for row in self._rows.get((kind, wallet_id), [])
+                    if row['number'] == number]
+        return _json(200, {'data': rows, 'hasMore': False})
+
+    def _get(self, query, form, body, auth, kind, id):
+        wallet_id = self._wallet(*auth) if auth else None
+        if wallet_id is None:
+            return _json(401, {'message': 'Unauthorized'})
+        with self._lock:
+            found = self._by_id.get((kind, id))
+            if found is None or found[0] != wallet_id:
+                return _json(404, {'message': 'Not found'})
+            return _json(200, {'data': dict(found[1])})
+
+    def _create_payout(self, query, form, body, auth):
+        wallet_id = self._wallet(auth[0], auth[1], query.get('walletId')) \
+            if auth else None
+        if wallet_id is None:
+            return _json(401, {'message': 'Unauthorized'})
+        try:
+            request = json.loads(body.decode('utf-8'))['data']
+            number = request['merchantOrderId']
+            amount = request['amount']
+        except (ValueError, KeyError, TypeError):
+            return _json(400, {'errors': [{
+                'status': '400', 'title': 'Invalid Request',
+                'detail': 'merchantOrderId and amount are required',
+            }]})
+        if not request.get('cardToken') and \
+                not (request.get('card') or {}).get('number'):
+            return _json(400, {'errors': [{
+                'status': '400', 'source': {'pointer': '/data/card/number'},
+                'title': 'Invalid Attribute',
+                'detail': 'invalid credit card number',
+            }]})
+        now = int(time.time() * 1000)
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now / 1000.0))
+        with self._lock:
+            id = self._new_id()
+            self._add('payouts', wallet_id, {
+                'id': id, 'number': number, 'state': 'COMPLETED',
+                'date': now, 'currency': request.get('currency'),
+                'amount': str(amount),
+            })
+        return _json(201, {
+            'data': {'type': 'PAYOUTS', 'id': id, 'created': stamp,
+                     'updated': stamp, 'rrn': id.zfill(12),
+                     'merchantOrderId': number, 'status': 'SUCCESS'},
+            'links': {'self': '{}/{}'.format(self.settings.url_payouts, id)},
+        })
+
+    def _change_status(self, query, form, body, auth):
+        wallet_id = self._wallet(form.get('client_login'),
+                                 form.get('client_password'))
+        if wallet_id is None:
+            return _xml('response', is_executed='no',
+                        details='Authentication failed')
+        status_to = form.get('status_to')
+        if status_to not in _TRANSITIONS:
+            return _xml('response', is_executed='no',
+                        details='Unknown status [{}]'.format(status_to))
+        allowed, state = _TRANSITIONS[status_to]
+        if status_to == 'refund' and not form.get('reason'):
+            return _xml('response', is_executed='no',
+                        details='Refund reason is required')
+        with self._lock:
+            found = self._by_id.get(('payments', form.get('id')))
+            if found is None or found[0] != wallet_id:
+                return _xml('response', is_executed='no',
+                            details='Order not found')
+            payment = found[1]
+            if payment['state'] not in allowed:
+                return _xml('response', is_executed='no',
+                            details='Status [{}] not allowed after [{}]'.format(
+                                status_to, payment['state']))
+            payment['state'] = state
+            if status_to == 'refund':
+                amount = form.get('amount') or payment['amount']
+                payment['refundedAmount'] = amount
+                self._add('refunds', wallet_id, {
+                    'id': self._new_id(), 'number': payment['number'],
+                    'state': 'COMPLETED', 'date': int(time.time() * 1000),
+                    'currency': payment['currency'], 'amount': amount,
+                    'originalOrderId': payment['id'],
+                })
+        return _xml('response', is_executed='yes', details='')
+
+    def _order_report(self, query, form, body, auth):
+        wallet_id = self._wallet(form.get('client_login'),
+                                 form.get('client_password'),
+                                 form.get('wallet_id'))
+        if wallet_id is None:
+            return _xml('response', is_executed='no',
+                        details='Authentication failed')
+        number = form.get('number')
+        start = _parse_date(form.get('date_begin'), 0)
+        end = _parse_date(form.get('date_end'), None)
+        with self._lock:
+            rows = [row for row in self._rows.get(('payments', wallet_id), [])
+                    if start <= row['date'] and (end is None or row['date'] < end)
+                    and (number is None or row['number'] == number)][-10:]
+            orders = [ElementTree.Element('orderu', {
+                'id': row['id'],
+                'orderu_number': row['number'],
+                'status_name': _STATUS_NAMES.get(row['state'], 'unknown'),
+                'date_in': time.strftime('%Y-%m-%d %H:%M',
+                                         time.gmtime(row['date'] / 1000.0)),
+                'amount': row['amount'],
+                'hold_number': hashlib.sha1(row['id'].encode('ascii')).hexdigest(),
+                'email': row['email'],
+            }) for row in rows]
+        return _xml('response', orders, is_executed='yes', details='')
+
+    def _pay(self, query, form, body, auth):
+        try:
+            xml_string = base64.standard_b64decode(form['orderXML'])
+            order = ElementTree.fromstring(xml_string)
+            wallet_id = int(order.get('wallet_id'))
+            secret = self.wallets[wallet_id][0]
+        except (KeyError, ValueError, TypeError, ElementTree.ParseError):
+            return _text(400, 'Invalid orderXML')
+        if not isinstance(secret, bytes):
+            secret = secret.encode('ascii')
+        sha512 = hashlib.sha512(xml_string + secret).hexdigest()
+        if form.get('sha512') != sha512:
+            return _text(400, 'Invalid sha512')
+        gateway = order.get('is_gateway') == 'yes'
+        card = order.find('card')
+        row = {
+            'number': order.get('number'),
+            'state': 'NEW',
+            'date': int(time.time() * 1000),
+            'is3d': False,
+            'currency': order.get('currency') or 'USD',
+            'amount': order.get('amount'),
+            'email': order.get('email'),
+        }
+        if order.get('customer_id'):
+            row['customerId'] = order.get('customer_id')
+        with self._lock:
+            row['id'] = self._new_id()
+            if gateway and card is not None:
+                row['state'] = 'AUTHORIZED' \
+                    if order.get('is_two_phase') == 'yes' else 'COMPLETED'
+            self._add('payments', wallet_id, row)
+        if not (gateway and card is not None):
+            return _xml('redirect', url='http://{}:{}/MI/payment.html?id={}'
+                        .format(self.host, self.port, row['id']))
+        number = card.get('num') or ''
+        return _xml(
+            'order', id=row['id'], number=row['number'],
+            status='APPROVED' if row['state'] == 'COMPLETED' else 'PENDING',
+            date=time.strftime('%d.%m.%Y %H:%M:%S'),
+            card_bin=number[:6], card_num='...' + number[-4:],
+            card_holder=card.get('holder'), is_3d='false',
+            currency=row['currency'], amount=row['amount'],
+            approval_code='A{:05d}'.format(self._rng.randint(0, 99999)),
+        )
+
+    # Serving
+
+    @property
+    def url(self):
+        return 'http://{}:{}/MI'.format(self.host, self.port)
+
+    @property
+    def settings(self):
+        """:class:`PyCardPay.settings.Settings` pointing to this server"""
+        return base_url_settings(self.url)
+
+    def _bind(self):
+        if self._server is None:
+            self._server = _Server((self.host, self.port), _Handler)
+            self._server.fake = self
+            self.port = self._server.server_address[1]
+        return self._server
+
+    def start(self):
+        """Starts serving in a background thread, returns :attr:`settings`"""
+        server = self._bind()
+        if self._thread is None:
+            self._thread = threading.Thread(target=server.serve_forever,
+                                            name='PyCardPay-fakeserver')
+            self._thread.daemon = True
+            self._thread.start()
+        return self.settings
+
+    def serve_forever(self):
+        self._bind().serve_forever()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        form = {}
+        if self.headers.get('Content-Type', '').startswith(
+                'application/x-www-form-urlencoded'):
+            form = dict((k, v[0]) for k, v in
+                        parse_qs(body.decode('utf-8')).items())
+        auth = None
+        header = self.headers.get('Authorization', '')
+        if header.startswith('Basic '):
+            try:
+                auth = tuple(base64.b64decode(header[6:]).decode('latin1')
+                             .split(':', 1))
+            except ValueError:
+                pass
+        response = self.server.fake.handle(method, url.path, query, form,
+                                           body, auth)
+        if response is None:
+            self.close_connection = True
+            return
+        self.send_response(response.status)
+        self.send_header('Content-Type', response.content_type)
+        self.send_header('Content-Length', str(len(response.body)))
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake CardPay server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--wallet', action='append', default=[],
+                        metavar='ID:SECRET:LOGIN:PASSWORD')
+    parser.add_argument('--volume', type=int, default=1000,
+                        help='generated payments per wallet')
+    parser.add_argument('--days', type=float, default=30,
+                        help='days the generated transactions are spread over')
+    parser.add_argument('--latency', type=parse_latency, default=None,
+                        help="e.g. '0.05', 'uniform:0.01,0.1', 'lognormal:0.05,0.5'")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--garbage-rate', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=MAX_COUNT)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    wallets = {}
+    for spec in args.wallet:
+        wallet_id, secret, login, password = spec.split(':', 3)
+        wallets[int(wallet_id)] = (secret, login, password)
+    server = FakeCardPay(
+        wallets=wallets or None, volume=args.volume,
+        period=int(args.days * 24 * 60 * 60 * 1000), latency=args.latency,
+        error_rate=args.error_rate, disconnect_rate=args.disconnect_rate,
+        garbage_rate=args.garbage_rate, page_size=args.page_size,
+        seed=args.seed, host=args.host, port=args.port,
+    )
+    server._bind()
+    print(json.dumps(server.settings._asdict(), indent=2))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
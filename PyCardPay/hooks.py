@@ -0,0 +1,315 @@
+# coding=utf-8
+"""Request lifecycle hooks and tracing spans.
+
+Functions registered with :func:`add_hook` are called with a
+:class:`RequestEvent` at every stage of a CardPay request:
+
+* ``on_request_start`` -- before the request is sent
+* ``on_response`` -- response headers and body were received
+* ``on_error`` -- the request failed: connection, HTTP status or parsing error
+* ``on_parse_done`` -- the response was parsed successfully
+
+With :func:`set_tracer` every request and every :class:`PyCardPay.CardPay`
+call is wrapped in a span. The tracer is an OpenTelemetry tracer or any
+object with the same ``start_span`` and ``start_as_current_span`` methods.
+
+Credentials, signed order XML and card numbers are redacted from event data
+and span attributes. While no hooks, tracer or metrics are enabled, no event
+objects are created.
+
+Usage example:
+
+>>> from opentelemetry import trace
+>>> from PyCardPay import hooks
+>>> hooks.set_tracer(trace.get_tracer('PyCardPay'))
+>>> hooks.add_hook('on_error', lambda event: log.warning(
+...     'CardPay %s failed: %r', event.endpoint, event.exception))
+"""
+
+import contextvars
+import functools
+import logging
+import time
+
+from . import metrics
+from .redact import redact
+
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('on_request_start', 'on_response', 'on_error', 'on_parse_done')
+
+# True while any hook or tracer is set
+active = False
+
+_hooks = dict((event, ()) for event in EVENTS)
+_tracer = None
+_context = contextvars.ContextVar('PyCardPay.hooks.context', default=None)
+
+
+def _update_active():
+    global active
+    active = _tracer is not None or any(_hooks.values())
+
+
+def add_hook(event, fn):
+    """Registers *fn* to be called with :class:`RequestEvent` on *event*
+
+    :param event: One of :data:`EVENTS`
+    :type event: str
+    :raises: ValueError on unknown event names
+    """
+    if event not in _hooks:
+        raise ValueError('Unknown event: {}'.format(event))
+    _hooks[event] = _hooks[event] + (fn,)
+    _update_active()
+    return fn
+
+
+def remove_hook(event, fn):
+    _hooks[event] = tuple(hook for hook in _hooks[event] if hook is not fn)
+    _update_active()
+
+
+def set_tracer(tracer):
+    """Sets tracer spans are created with, ``None`` disables spans"""
+    global _tracer
+    _tracer = tracer
+    _update_active()
+
+
+def clear():
+    """Removes all hooks and the tracer"""
+    global _tracer
+    for event in EVENTS:
+        _hooks[event] = ()
+    _tracer = None
+    _update_active()
+
+
+class _Context:
+    __slots__ = ('token', 'attributes', 'span_manager')
+
+    def __init__(self, attributes, name=None):
+        self.attributes = attributes
+        self.token = None
+        self.span_manager = None
+        if name is not None and _tracer is not None:
+            self.span_manager = _tracer.start_as_current_span(
+                name, attributes=_span_attributes(attributes))
+
+    def __enter__(self):
+        parent = _context.get()
+        if parent is not None:
+            self.attributes = dict(parent, **self.attributes)
+        self.token = _context.set(self.attributes)
+        if self.span_manager is not None:
+            return self.span_manager.__enter__()
+
+    def __exit__(self, *exc_info):
+        _context.reset(self.token)
+        if self.span_manager is not None:
+            return self.span_manager.__exit__(*exc_info)
+
+
+class _NullContext:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_context = _NullContext()
+
+
+def context(**attributes):
+    """Context manager adding *attributes* (e.g. ``wallet_id``, ``attempt``) to events inside it"""
+    if not active and metrics.active is None:
+        return _null_context
+    return _Context(attributes)
+
+
+def span(name, **attributes):
+    """Context manager of a span named *name* that also works like :func:`context`"""
+    if not active:
+        return _null_context
+    return _Context(attributes, name)
+
+
+def traced(method):
+    """Wraps :class:`PyCardPay.CardPay` *method* in a span with the client's wallet_id"""
+    name = 'CardPay.' + method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not active:
+            return method(self, *args, **kwargs)
+        with _Context({'wallet_id': self.wallet_id}, name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _span_attributes(attributes):
+    return dict(('cardpay.' + key, value) for key, value in attributes.items()
+                if isinstance(value, (str, bool, int, float)))
+
+
+def _fire(event, request_event):
+    for hook in _hooks[event]:
+        try:
+            hook(request_event)
+        except Exception:
+            logger.exception('PyCardPay %s hook failed', event)
+
+
+class RequestEvent:
+    """State of one request passed to hooks.
+
+    :ivar endpoint: Endpoint name, see :mod:`PyCardPay.metrics`
+    :ivar method: HTTP method
+    :ivar url: Request URL
+    :ivar wallet_id: Wallet the request is made for, if known
+    :ivar attempt: Attempt number, 1 unless the request is retried
+    :ivar status_code: HTTP status code once a response was received
+    :ivar bytes_sent: Request body size
+    :ivar bytes_received: Response body size
+    :ivar timings: Seconds per phase: 'connect', 'ttfb', 'download', 'parse' and 'total'
+    :ivar exception: Exception the request failed with
+    :ivar span: Span of the request while a tracer is set
+    """
+
+    __slots__ = ('endpoint', 'method', 'url', 'wallet_id', 'attempt',
+                 'status_code', 'bytes_sent', 'bytes_received', 'timings',
+                 'exception', 'span', '_data', '_redacted', '_registry',
+                 '_started', '_parse_started', '_responded', '_finished')
+
+    def __init__(self, registry, endpoint, method, url, data=None,
+                 wallet_id=None):
+        context = _context.get() or {}
+        self.endpoint = endpoint
+        self.method = method
+        self.url = url
+        self.wallet_id = wallet_id if wallet_id is not None \
+            else context.get('wallet_id')
+        self.attempt = context.get('attempt', 1)
+        self.status_code = None
+        self.bytes_sent = None
+        self.bytes_received = None
+        self.timings = {}
+        self.exception = None
+        self.span = None
+        self._data = data
+        self._redacted = None
+        self._registry = registry
+        self._started = time.perf_counter()
+        self._parse_started = None
+        self._responded = False
+        self._finished = False
+        if _tracer is not None:
+            self.span = _tracer.start_span(
+                'CardPay {} {}'.format(method, endpoint),
+                attributes=_span_attributes(self.attributes()))
+        if _hooks['on_request_start']:
+            _fire('on_request_start', self)
+
+    @property
+    def data(self):
+        """Request parameters with credentials and card data redacted"""
+        if self._redacted is None and self._data is not None:
+            self._redacted = redact(self._data)
+        return self._redacted
+
+    def attributes(self):
+        """Returns event fields as dict, e.g. for logging"""
+        result = {'endpoint': self.endpoint, 'method': self.method,
+                  'url': self.url, 'attempt': self.attempt}
+        for name in ('wallet_id', 'status_code', 'bytes_sent',
+                     'bytes_received'):
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = value
+        for phase, seconds in self.timings.items():
+            result[phase + '_seconds'] = seconds
+        return result
+
+    def request_started(self):
+        if self._registry is not None:
+            self._registry.request_started(self.endpoint)
+
+    def response(self, r):
+        """Records received :class:`PyCardPay.transport.Response`"""
+        self._responded = True
+        self.status_code = r.status_code
+        self.bytes_sent = r.sent
+        self.bytes_received = len(r.content)
+        if r.connect is not None:
+            self.timings['connect'] = r.connect
+        self.timings['ttfb'] = r.ttfb
+        self.timings['download'] = r.download
+        if self._registry is not None:
+            self._registry.request_finished(self.endpoint, r)
+        if _hooks['on_response']:
+            _fire('on_response', self)
+
+    def parsing(self):
+        """Marks start of the parse phase"""
+        self._parse_started = time.perf_counter()
+
+    def done(self):
+        """Records successful end of the request"""
+        if self._finished:
+            return
+        self._finished = True
+        now = time.perf_counter()
+        if self._parse_started is not None:
+            self.timings['parse'] = now - self._parse_started
+        self.timings['total'] = now - self._started
+        if self._registry is not None:
+            self._registry.parsed(self.endpoint, self._started,
+                                  self._parse_started or now)
+        if _hooks['on_parse_done']:
+            _fire('on_parse_done', self)
+        self._end_span()
+
+    def error(self, exc):
+        """Records failure of the request with *exc*"""
+        if self._finished:
+            return
+        self._finished = True
+        self.exception = exc
+        self.timings['total'] = time.perf_counter() - self._started
+        if self._registry is not None:
+            if self._responded:
+                self._registry.error(self.endpoint, exc)
+            else:
+                self._registry.request_finished(self.endpoint, exc=exc)
+        if _hooks['on_error']:
+            _fire('on_error', self)
+        if self.span is not None:
+            try:
+                self.span.record_exception(exc)
+            except Exception:
+                logger.exception('PyCardPay span failed')
+        self._end_span()
+
+    def _end_span(self):
+        span = self.span
+        if span is None:
+            return
+        try:
+            for key, value in _span_attributes(self.attributes()).items():
+                span.set_attribute(key, value)
+            span.end()
+        except Exception:
+            logger.exception('PyCardPay span failed')
+
+
+def start(endpoint, method, url, data=None, wallet_id=None):
+    """Returns :class:`RequestEvent` of a new request, ``None`` while hooks, tracer and metrics are disabled"""
+    registry = metrics.active
+    if registry is None and not active:
+        return None
+    return RequestEvent(registry, endpoint, method, url, data, wallet_id)
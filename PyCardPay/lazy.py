@@ -0,0 +1,40 @@
+# coding=utf-8
+
+import importlib
+
+
+class LazyModule:
+    """Module imported on first attribute access.
+
+    Lets modules name heavy dependencies (lxml, requests) at the top without
+    importing them, so ``import PyCardPay`` stays cheap. Looked up attributes
+    are cached on the instance, later accesses cost a plain attribute lookup.
+
+    :param name: Full module name, e.g. ``'lxml.etree'``
+    :type name: str
+    :param attr: (optional) Use this attribute of the module instead of the module itself
+    :type attr: str
+
+    >>> etree = LazyModule('lxml.etree')
+    >>> E = LazyModule('lxml.builder', 'E')
+    """
+
+    def __init__(self, name, attr=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_attr'] = attr
+
+    def _load(self):
+        target = importlib.import_module(self._name)
+        if self._attr is not None:
+            target = getattr(target, self._attr)
+        return target
+
+    def __getattr__(self, name):
+        value = getattr(self._load(), name)
+        self.__dict__[name] = value
+        return value
+
+    def __repr__(self):
+        return '<LazyModule {}{}>'.format(
+            self._name, '.' + self._attr if self._attr else ''
+        )
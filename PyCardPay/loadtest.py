@@ -0,0 +1,353 @@
+# coding=utf-8
+"""Load generator measuring throughput and latency of PyCardPay calls.
+
+Sends a weighted mix of calls to any :class:`PyCardPay.settings.Settings`
+target and reports throughput, latency percentiles and errors per endpoint
+together with the client CPU time spent per request, e.g.::
+
+    python -m PyCardPay.loadtest --fake --mix payments_status=8,pay=1,list_payments=1 \\
+        --rate 200,400,800 --concurrency 32 --duration 30
+
+With ``--rate`` arrivals are open-loop: requests are started on a Poisson
+schedule regardless of how fast earlier ones complete, and latency is
+measured from the scheduled start, so queueing in the client is included.
+Without it every one of ``--concurrency`` workers sends requests back to
+back (closed loop).
+
+.. warning::
+    ``status_change`` voids transactions and ``pay`` creates orders. Use it
+    against the sandbox or a :mod:`PyCardPay.fakeserver` only.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from .cardpay import CardPay
+from .settings import Settings, base_url_settings, test_settings
+from .transport import RequestsTransport, Urllib3Transport
+
+
+def _pay(client, ids, n):
+    return client.pay({'number': 'load{}-{}'.format(int(time.time()), n),
+                       'amount': 10, 'email': 'load@example.com'})
+
+
+def _id(ids, n):
+    return ids[n % len(ids)] if ids else str(n)
+
+
+OPERATIONS = {
+    'pay': _pay,
+    'status': lambda client, ids, n: client.status(),
+    'status_change': lambda client, ids, n: client.void(_id(ids, n)),
+    'payments_status': lambda client, ids, n: client.payments_status(_id(ids, n)),
+    'refunds_status': lambda client, ids, n: client.refunds_status(_id(ids, n)),
+    'payouts_status': lambda client, ids, n: client.payouts_status(_id(ids, n)),
+    'list_payments': lambda client, ids, n: client.list_payments(*_period()),
+    'list_refunds': lambda client, ids, n: client.list_refunds(*_period()),
+    'list_payouts': lambda client, ids, n: client.list_payouts(*_period()),
+}
+
+DEFAULT_MIX = 'payments_status=6,list_payments=1,pay=1,status_change=1,status=1'
+
+# Requests waiting for a free worker before new arrivals are shed
+MAX_BACKLOG = 10000
+
+
+def _period():
+    end = int(time.time() * 1000)
+    return end - 60 * 60 * 1000, end
+
+
+def parse_mix(spec):
+    """Parses 'name=weight,...' into list of ``(name, weight)``
+
+    :raises: ValueError on unknown operation names
+    """
+    mix = []
+    for part in spec.split(','):
+        name, _, weight = part.strip().partition('=')
+        if name not in OPERATIONS:
+            raise ValueError('Unknown operation: {}'.format(name))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted *values*"""
+    if not values:
+        return None
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Recorder:
+    """Thread-safe latencies and errors per operation"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.shed = 0
+
+    def record(self, name, seconds, exc=None):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if exc is not None:
+                errors = self.errors.setdefault(name, {})
+                key = type(exc).__name__
+                errors[key] = errors.get(key, 0) + 1
+
+    def summary(self, elapsed, cpu):
+        """Returns report of the run as dict"""
+        endpoints = {}
+        total = 0
+        for name, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            total += len(latencies)
+            errors = self.errors.get(name, {})
+            endpoints[name] = {
+                'requests': len(latencies),
+                'errors': sum(errors.values()),
+                'error_types': dict(errors),
+                'throughput': len(latencies) / elapsed,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1],
+            }
+        return {
+            'elapsed': elapsed,
+            'requests': total,
+            'throughput': total / elapsed if elapsed else 0,
+            'errors': sum(e['errors'] for e in endpoints.values()),
+            'shed': self.shed,
+            'cpu_seconds': cpu,
+            'cpu_per_request': cpu / total if total else None,
+            'endpoints': endpoints,
+        }
+
+
+def _call(client, ids, recorder, name, n, scheduled):
+    try:
+        OPERATIONS[name](client, ids, n)
+    except Exception as exc:
+        recorder.record(name, time.time() - scheduled, exc)
+    else:
+        recorder.record(name, time.time() - scheduled)
+
+
+def run(client, mix, duration, concurrency, rate=None, ids=None, seed=None):
+    """Runs one load step.
+
+    :param client: Client the calls are made with
+    :type client: :class:`PyCardPay.CardPay`
+    :param mix: ``(operation, weight)`` pairs, see :data:`OPERATIONS`
+    :type mix: list
+    :param duration: Seconds new requests are started for
+    :type duration: int|float
+    :param concurrency: Maximum number of requests in flight
+    :type concurrency: int
+    :param rate: (optional) Open-loop arrival rate in requests per second, closed loop if not set
+    :type rate: int|float
+    :param ids: (optional) Transaction ids used by status and status change calls
+    :type ids: list
+    :returns: dict -- see :meth:`Recorder.summary`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = random.Random(seed)
+    names = [name for name, weight in mix]
+    weights = [weight for name, weight in mix]
+    recorder = Recorder()
+    cpu_started = time.process_time()
+    started = time.time()
+    deadline = started + duration
+
+    if rate:
+        executor = ThreadPoolExecutor(concurrency)
+        backlog = threading.BoundedSemaphore(MAX_BACKLOG)
+
+        def task(name, n, scheduled):
+            try:
+                _call(client, ids, recorder, name, n, scheduled)
+            finally:
+                backlog.release()
+
+        n = 0
+        scheduled = started
+        while True:
+            scheduled += rng.expovariate(rate)
+            if scheduled >= deadline:
+                break
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if not backlog.acquire(False):
+                recorder.shed += 1
+                continue
+            name = rng.choices(names, weights)[0]
+            executor.submit(task, name, n, scheduled)
+            n += 1
+        executor.shutdown(wait=True)
+    else:
+        counter = iter(range(sys.maxsize))
+        lock = threading.Lock()
+
+        def worker(seed):
+            worker_rng = random.Random(seed)
+            while time.time() < deadline:
+                with lock:
+                    n = next(counter)
+                name = worker_rng.choices(names, weights)[0]
+                _call(client, ids, recorder, name, n, time.time())
+
+        threads = [threading.Thread(target=worker, args=(rng.random(),))
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    summary = recorder.summary(time.time() - started,
+                               time.process_time() - cpu_started)
+    summary.update(concurrency=concurrency, rate=rate)
+    return summary
+
+
+def format_report(summary):
+    """Formats :func:`run` result as text table"""
+    def ms(value):
+        return '{:9.1f}'.format(value * 1000) if value is not None else ' ' * 9
+
+    lines = [
+        'rate={} concurrency={}: {} requests in {:.1f}s, {:.1f} req/s, '
+        '{} errors, {} shed, {:.0f} us CPU/request'.format(
+            summary['rate'] or 'closed-loop', summary['concurrency'],
+            summary['requests'], summary['elapsed'], summary['throughput'],
+            summary['errors'], summary['shed'],
+            (summary['cpu_per_request'] or 0) * 1e6),
+        '{:<16} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+            'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'max ms', 'errors'),
+    ]
+    for name, e in sorted(summary['endpoints'].items()):
+        lines.append('{:<16} {:>8} {:>9.1f} {} {} {} {}  {}'.format(
+            name, e['requests'], e['throughput'], ms(e['p50']), ms(e['p95']),
+            ms(e['p99']), ms(e['max']),
+            ', '.join('{}={}'.format(k, v)
+                      for k, v in sorted(e['error_types'].items())) or '-'))
+    return '\n'.join(lines)
+
+
+def _serve_fake(connection, kwargs):
+    from .fakeserver import FakeCardPay
+    server = FakeCardPay(**kwargs)
+    server._bind()
+    connection.send(tuple(server.settings))
+    server.serve_forever()
+
+
+def _start_fake(wallet_id, secret, login, password, volume, latency):
+    """Starts fake server in a child process so its CPU isn't counted"""
+    import multiprocessing
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve_fake, args=(child, {
+        'wallets': {wallet_id: (secret, login, password)},
+        'volume': volume, 'period': 24 * 60 * 60 * 1000,
+        'latency': latency,
+    }))
+    process.daemon = True
+    process.start()
+    return process, Settings(*parent.recv())
+
+
+def main(argv=None):
+    def numbers(value):
+        return [float(v) for v in value.split(',')]
+
+    parser = argparse.ArgumentParser(
+        prog='python -m PyCardPay.loadtest',
+        description='Load generator for PyCardPay calls',
+    )
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help="service base URL, e.g. "
+                                      "'http://127.0.0.1:8000/MI'")
+    target.add_argument('--sandbox', action='store_true',
+                        help='use sandbox.cardpay.com')
+    target.add_argument('--fake', action='store_true',
+                        help='start a local fake server')
+    parser.add_argument('--wallet-id', type=int, default=1)
+    parser.add_argument('--secret', default='secret')
+    parser.add_argument('--login', default='login')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='operation=weight,... of: ' +
+                             ', '.join(sorted(OPERATIONS)))
+    parser.add_argument('--rate', type=numbers, default=[None],
+                        help='open-loop requests/sec, comma separated steps')
+    parser.add_argument('--concurrency', type=numbers, default=[16],
+                        help='requests in flight, comma separated steps')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per step')
+    parser.add_argument('--transport', choices=('requests', 'urllib3'),
+                        default='urllib3')
+    parser.add_argument('--fake-volume', type=int, default=10000)
+    parser.add_argument('--fake-latency', type=float, default=None,
+                        help='constant latency of the fake server in seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    process = None
+    if args.fake:
+        latency = None
+        if args.fake_latency:
+            from .fakeserver import constant
+            latency = constant(args.fake_latency)
+        process, settings = _start_fake(args.wallet_id, args.secret,
+                                        args.login, args.password,
+                                        args.fake_volume, latency)
+    elif args.sandbox:
+        settings = test_settings
+    else:
+        settings = base_url_settings(args.url)
+
+    transport = Urllib3Transport() if args.transport == 'urllib3' \
+        else RequestsTransport()
+    client = CardPay(args.wallet_id, args.secret, args.login, args.password,
+                     settings=settings, transport=transport)
+    try:
+        end = int(time.time() * 1000)
+        ids = [row['id'] for row in client.list_payments(
+            end - 24 * 60 * 60 * 1000, end, max_count=1000).get('data') or []]
+    except Exception as exc:
+        sys.stderr.write('Failed to load transaction ids: {!r}\n'.format(exc))
+        ids = []
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            for rate in args.rate:
+                summary = run(client, args.mix, args.duration,
+                              int(concurrency), rate=rate, ids=ids,
+                              seed=args.seed)
+                results.append(summary)
+                if not args.json:
+                    print(format_report(summary))
+                    print('')
+    finally:
+        transport.close()
+        if process is not None:
+            process.terminate()
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# coding=utf-8
+"""In-process metrics of CardPay requests.
+
+Metrics are collected only while a registry is enabled; when disabled the
+library pays for one function call and ``is None`` check per request and
+phase. Requests are followed with :class:`PyCardPay.hooks.RequestEvent`,
+which feeds both metrics and hooks.
+
+Endpoints are named after :class:`PyCardPay.settings.Settings` fields:
+'pay', 'status', 'status_change', 'payments', 'refunds', 'payouts'.
+Request phases are 'build' and 'sign' (order XML), 'connect' (only for new
+connections), 'ttfb' (sending the request and waiting for response headers),
+'download' and 'parse'.
+
+Usage example:
+
+>>> from PyCardPay import metrics
+>>> registry = metrics.enable()
+>>> client.payments_status(1001)
+>>> registry.snapshot()['histograms']['pycardpay_request_seconds']
+[{'labels': {'endpoint': 'payments'}, 'count': 1, 'sum': 0.21, 'buckets': [...]}]
+>>> print(registry.prometheus())
+# TYPE pycardpay_requests_total counter
+pycardpay_requests_total{endpoint="payments",status="200"} 1
+...
+"""
+
+import bisect
+import threading
+import time
+
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Upper bounds of payload size histogram buckets in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+PHASES = ('build', 'sign', 'connect', 'ttfb', 'download', 'parse')
+
+_HELP = {
+    'pycardpay_requests_total': 'Requests by endpoint and HTTP status code',
+    'pycardpay_errors_total': 'Failed requests by endpoint and exception class',
+    'pycardpay_list_pages_total': 'List responses by endpoint and hasMore',
+    'pycardpay_new_connections_total': 'Requests that opened a new connection',
+    'pycardpay_in_flight': 'Requests in flight',
+    'pycardpay_request_seconds': 'Request latency from start to parsed result',
+    'pycardpay_phase_seconds': 'Time spent in request phases',
+    'pycardpay_request_bytes': 'Request body sizes',
+    'pycardpay_response_bytes': 'Response body sizes',
+}
+
+# Currently enabled registry, None while metrics are disabled
+active = None
+
+
+class Histogram:
+    """Fixed-bucket histogram; not thread-safe, guarded by the registry lock"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns ``[(upper bound, cumulative count), ...]`` ending with ``inf``"""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _labels(names, values):
+    return dict(zip(names, values))
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms of CardPay requests.
+
+    :param latency_buckets: (optional) Upper bounds of latency buckets in seconds
+    :type latency_buckets: tuple
+    :param size_buckets: (optional) Upper bounds of payload size buckets in bytes
+    :type size_buckets: tuple
+    """
+
+    def __init__(self, latency_buckets=LATENCY_BUCKETS,
+                 size_buckets=SIZE_BUCKETS):
+        self.latency_buckets = tuple(latency_buckets)
+        self.size_buckets = tuple(size_buckets)
+        self._lock = threading.Lock()
+        # name -> (label names, {label values: value})
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    # Primitives
+
+    def incr(self, name, label_names, label_values, value=1):
+        with self._lock:
+            values = self._counters.setdefault(name, (label_names, {}))[1]
+            values[label_values] = values.get(label_values, 0) + value
+
+    def gauge_add(self, name, label_names, label_values, value):
+        with self._lock:
+            values = self._gauges.setdefault(name, (label_names, {}))[1]
+            values[label_values] = values.get(label_values, 0) + value
+
+    def observe(self, name, label_names, label_values, value, bounds=None):
+        with self._lock:
+            values = self._histograms.setdefault(name, (label_names, {}))[1]
+            histogram = values.get(label_values)
+            if histogram is None:
+                histogram = values[label_values] = Histogram(
+                    bounds or self.latency_buckets)
+            histogram.observe(value)
+
+    # Request events
+
+    def phase(self, endpoint, phase, seconds):
+        """Records *seconds* spent in *phase* of a request to *endpoint*"""
+        self.observe('pycardpay_phase_seconds', ('endpoint', 'phase'),
+                     (endpoint, phase), seconds)
+
+    def request_started(self, endpoint):
+        self.gauge_add('pycardpay_in_flight', ('endpoint',), (endpoint,), 1)
+
+    def request_finished(self, endpoint, response=None, exc=None):
+        """Records outcome of a request sent through :func:`PyCardPay.transport.send`
+
+        :param response: Response, if one was received
+        :type response: :class:`PyCardPay.transport.Response`
+        :param exc: Exception raised instead
+        """
+        self.gauge_add('pycardpay_in_flight', ('endpoint',), (endpoint,), -1)
+        if exc is not None:
+            self.incr('pycardpay_errors_total', ('endpoint', 'error'),
+                      (endpoint, type(exc).__name__))
+            return
+        self.incr('pycardpay_requests_total', ('endpoint', 'status'),
+                  (endpoint, str(response.status_code)))
+        if response.connect is not None:
+            self.incr('pycardpay_new_connections_total', ('endpoint',),
+                      (endpoint,))
+            self.phase(endpoint, 'connect', response.connect)
+        self.phase(endpoint, 'ttfb', response.ttfb)
+        self.phase(endpoint, 'download', response.download)
+        self.observe('pycardpay_request_bytes', ('endpoint',), (endpoint,),
+                     response.sent, self.size_buckets)
+        self.observe('pycardpay_response_bytes', ('endpoint',), (endpoint,),
+                     len(response.content), self.size_buckets)
+
+    def parsed(self, endpoint, started, parse_started):
+        """Records parse phase and total latency of a successful request.
+
+        :param started: :func:`time.perf_counter` value when the request started
+        :param parse_started: :func:`time.perf_counter` value when parsing started
+        """
+        now = time.perf_counter()
+        self.phase(endpoint, 'parse', now - parse_started)
+        self.observe('pycardpay_request_seconds', ('endpoint',), (endpoint,),
+                     now - started)
+
+    def error(self, endpoint, exc):
+        """Records request failed with *exc* after a response was received"""
+        self.incr('pycardpay_errors_total', ('endpoint', 'error'),
+                  (endpoint, type(exc).__name__))
+
+    def list_page(self, endpoint, has_more):
+        self.incr('pycardpay_list_pages_total', ('endpoint', 'has_more'),
+                  (endpoint, 'true' if has_more else 'false'))
+
+    # Export
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """Returns copy of all metrics.
+
+        :returns: dict
+
+        Return dict structure:
+
+        >>> {
+            'counters': {'pycardpay_requests_total': [{'labels': {...}, 'value': 10}, ...], ...},
+            'gauges': {'pycardpay_in_flight': [{'labels': {...}, 'value': 2}, ...]},
+            'histograms': {
+                'pycardpay_phase_seconds': [{
+                    'labels': {'endpoint': 'pay', 'phase': 'ttfb'},
+                    'count': 10,
+                    'sum': 1.92,
+                    'buckets': [(0.0005, 0), ..., (inf, 10)],  # cumulative counts
+                }, ...],
+                ...
+            },
+        }
+        """
+        with self._lock:
+            return {
+                'counters': dict(
+                    (name, [{'labels': _labels(names, key), 'value': value}
+                            for key, value in sorted(values.items())])
+                    for name, (names, values) in self._counters.items()
+                ),
+                'gauges': dict(
+                    (name, [{'labels': _labels(names, key), 'value': value}
+                            for key, value in sorted(values.items())])
+                    for name, (names, values) in self._gauges.items()
+                ),
+                'histograms': dict(
+                    (name, [{'labels': _labels(names, key),
+                             'count': histogram.count,
+                             'sum': histogram.sum,
+                             'buckets': histogram.cumulative()}
+                            for key, histogram in sorted(values.items())])
+                    for name, (names, values) in self._histograms.items()
+                ),
+            }
+
+    def prometheus(self):
+        """Returns metrics in Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, kind):
+            if name in _HELP:
+                lines.append('# HELP {} {}'.format(name, _HELP[name]))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        for kind in ('counters', 'gauges'):
+            for name, samples in sorted(snapshot[kind].items()):
+                header(name, 'counter' if kind == 'counters' else 'gauge')
+                for sample in samples:
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(sample['labels']),
+                        _format_value(sample['value'])))
+        for name, samples in sorted(snapshot['histograms'].items()):
+            header(name, 'histogram')
+            for sample in samples:
+                labels = sample['labels']
+                for bound, count in sample['buckets']:
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(dict(labels, le=_format_value(bound))),
+                        count))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), _format_value(sample['sum'])))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), sample['count']))
+        return '\n'.join(lines) + '\n'
+
+    def wsgi_app(self, environ, start_response):
+        """WSGI application serving :meth:`prometheus` output, e.g. at /metrics"""
+        body = self.prometheus().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n'))
+        for k, v in sorted(labels.items())
+    ) + '}'
+
+
+def enable(registry=None):
+    """Starts collecting metrics into *registry* (a new one if not given) and returns it"""
+    global active
+    if registry is None:
+        registry = MetricsRegistry()
+    active = registry
+    return registry
+
+
+def disable():
+    """Stops collecting metrics"""
+    global active
+    active = None
+
+
+def phase_started():
+    """Returns start time of a phase, ``None`` while disabled"""
+    return time.perf_counter() if active is not None else None
+
+
+def phase_done(endpoint, phase, started):
+    """Records *phase* of *endpoint* that began at *started* (see :func:`phase_started`)"""
+    registry = active
+    if started is not None and registry is not None:
+        registry.phase(endpoint, phase, time.perf_counter() - started)
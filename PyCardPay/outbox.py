@@ -0,0 +1,366 @@
+# coding=utf-8
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from . import api, bulk, hooks
+from .exceptions import PyCardPayException
+
+
+logger = logging.getLogger(__name__)
+
+CAPTURE = 'capture'
+VOID = 'void'
+REFUND = 'refund'
+PAYOUT = 'payout'
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# Milliseconds refunds found by a retry may predate the outbox record, for
+# clock differences between this host and CardPay
+_CLOCK_SKEW = 5 * 60 * 1000
+
+# Payment states showing that a capture or void was already applied
+_APPLIED = {
+    CAPTURE: frozenset(['COMPLETED', 'REFUNDED', 'CHARGED_BACK',
+                        'CHARGEBACK_RESOLVED']),
+    VOID: frozenset(['VOIDED']),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    txn_id TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    params TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    result TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (txn_id, operation)
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_attempt);
+"""
+
+
+class _Write:
+    __slots__ = ('row', 'done', 'added', 'error')
+
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.added = None
+        self.error = None
+
+
+class Outbox:
+    """Durable queue of status changes and payouts.
+
+    Operations are stored in a SQLite file and the caller only waits until
+    the record is synced to disk; a background dispatcher sends them to
+    CardPay. Every ``(transaction id, operation)`` pair is accepted once and
+    is not lost by a crash. Attempts are counted when an operation is
+    claimed and every result is written as soon as it arrives, so after a
+    failed attempt or a crash mid-request the operation is checked at
+    CardPay before it is sent again: the payment state for captures and
+    voids, refunds and payouts are looked up (see
+    :func:`PyCardPay.bulk.find_refund` and :func:`PyCardPay.bulk.find_payout`).
+    Payouts answered with ``errors`` end up ``failed``.
+
+    Concurrent writers are group-committed: records arriving while a commit
+    is running are written together by the next one.
+
+    :param path: Database file name
+    :type path: str|unicode
+    :param client: Client executing the operations
+    :type client: :class:`PyCardPay.CardPay`
+    :param batch_size: (optional) Maximum number of operations claimed by a dispatcher run
+    :type batch_size: int
+    :param max_in_flight: (optional) Maximum number of concurrent requests
+    :type max_in_flight: int
+    :param max_attempts: (optional) Attempts after communication or HTTP errors
+    :type max_attempts: int
+    :param retry_delay: (optional) Seconds before the first retry, doubled on every attempt
+    :type retry_delay: int|float
+    :param interval: (optional) Seconds the dispatcher sleeps when there is nothing to do
+    :type interval: int|float
+
+    Usage example:
+
+    >>> outbox = Outbox('/var/lib/myshop/outbox.sqlite', client)
+    >>> outbox.start()
+    >>> outbox.capture(order_id)      # returns once the operation is on disk
+    True
+    >>> outbox.get(order_id, 'capture')
+    {'state': 'done', 'attempts': 1, 'result': {'is_executed': True, 'details': ''}}
+
+    .. warning::
+        Payouts are accepted with *card_token* only, card numbers are never
+        written to the outbox file.
+    """
+
+    def __init__(self, path, client, batch_size=100,
+                 max_in_flight=bulk.DEFAULT_MAX_IN_FLIGHT, max_attempts=5,
+                 retry_delay=5, interval=1):
+        self.path = path
+        self.client = client
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.interval = interval
+        self._db = self._connect()
+        with self._db:
+            self._db.executescript(_SCHEMA)
+            # Operations left in flight by a crashed dispatcher; their attempts
+            # were counted when claimed, so they are checked before re-sending
+            self._db.execute(
+                'UPDATE outbox SET state = ? WHERE state = ?',
+                (PENDING, IN_FLIGHT)
+            )
+        self._db_lock = threading.Lock()
+        self._writes = []
+        self._writes_lock = threading.Lock()
+        self._has_writes = threading.Condition(self._writes_lock)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=FULL')
+        return db
+
+    # Writing
+
+    def enqueue(self, operation, txn_id, **params):
+        """Stores operation and waits until it is synced to disk.
+
+        :param operation: One of :data:`CAPTURE`, :data:`VOID`, :data:`REFUND`, :data:`PAYOUT`
+        :type operation: str
+        :param txn_id: Transaction id (``merchantOrderId`` for payouts)
+        :type txn_id: int|str
+        :param \*\*params: Parameters of the :class:`PyCardPay.CardPay` method
+        :returns: bool -- False if the operation was already in the outbox
+        """
+        now = time.time()
+        write = _Write((str(txn_id), operation,
+                        json.dumps(params, default=str), PENDING, now, now))
+        if not self._threads:
+            self._commit([write])
+        else:
+            with self._writes_lock:
+                self._writes.append(write)
+                self._has_writes.notify()
+            write.done.wait()
+        if write.error is not None:
+            raise write.error
+        self._wakeup.set()
+        return write.added
+
+    def capture(self, id):
+        """Queues :meth:`PyCardPay.CardPay.capture`, see :meth:`enqueue`"""
+        return self.enqueue(CAPTURE, id)
+
+    def void(self, id):
+        """Queues :meth:`PyCardPay.CardPay.void`, see :meth:`enqueue`"""
+        return self.enqueue(VOID, id)
+
+    def refund(self, id, reason, amount=None):
+        """Queues :meth:`PyCardPay.CardPay.refund`, see :meth:`enqueue`"""
+        return self.enqueue(REFUND, id, reason=reason, amount=amount)
+
+    def payouts(self, data, card_token):
+        """Queues :meth:`PyCardPay.CardPay.payouts`, see :meth:`enqueue`"""
+        return self.enqueue(PAYOUT, data['merchantOrderId'], data=data,
+                            card_token=card_token)
+
+    def _commit(self, writes):
+        try:
+            with self._db_lock, self._db:
+                for write in writes:
+                    cursor = self._db.execute(
+                        'INSERT OR IGNORE INTO outbox (txn_id, operation, '
+                        'params, state, created, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', write.row
+                    )
+                    write.added = cursor.rowcount == 1
+        except sqlite3.Error as exc:
+            for write in writes:
+                write.error = exc
+        for write in writes:
+            write.done.set()
+
+    def _write_loop(self):
+        while True:
+            with self._writes_lock:
+                while not self._writes and not self._stop.is_set():
+                    self._has_writes.wait()
+                writes, self._writes = self._writes, []
+            if writes:
+                self._commit(writes)
+            elif self._stop.is_set():
+                return
+
+    # Reading
+
+    def get(self, txn_id, operation):
+        """Returns ``{'state', 'attempts', 'result'}`` of an operation or ``None``"""
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT state, attempts, result FROM outbox '
+                'WHERE txn_id = ? AND operation = ?', (str(txn_id), operation)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'state': row[0], 'attempts': row[1],
+                'result': json.loads(row[2]) if row[2] else None}
+
+    def pending(self):
+        """Returns number of operations not executed yet"""
+        with self._db_lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM outbox WHERE state IN (?, ?)',
+                (PENDING, IN_FLIGHT)
+            ).fetchone()[0]
+
+    # Dispatching
+
+    def _claim(self, now):
+        with self._db_lock, self._db:
+            rows = self._db.execute(
+                'SELECT seq, txn_id, operation, params, attempts, created '
+                'FROM outbox WHERE state = ? AND next_attempt <= ? '
+                'ORDER BY seq LIMIT ?',
+                (PENDING, now, self.batch_size)
+            ).fetchall()
+            # Attempt is counted before it's made: if the process dies while
+            # it's in flight, the next run knows it may have reached CardPay
+            self._db.executemany(
+                'UPDATE outbox SET state = ?, attempts = attempts + 1, '
+                'updated = ? WHERE seq = ?',
+                [(IN_FLIGHT, now, row[0]) for row in rows]
+            )
+        return rows
+
+    def _execute(self, row):
+        with hooks.context(attempt=row[4] + 1):
+            return self._run(*row)
+
+    def _applied(self, operation, txn_id):
+        """Returns payment status response if *operation* was already applied, else ``None``"""
+        client = self.client
+        # Not through the client, its status cache or store may be stale
+        r = api.payments_status(txn_id, client.client_login,
+                                client.client_password,
+                                settings=client.settings,
+                                transport=client.transport)
+        if (r.get('data') or {}).get('state') in _APPLIED[operation]:
+            return r
+        return None
+
+    def _run(self, seq, txn_id, operation, params, attempts, created):
+        params = json.loads(params)
+        client = self.client
+        if operation in (CAPTURE, VOID):
+            if attempts:
+                # Previous attempt may have reached CardPay
+                found = self._applied(operation, txn_id)
+                if found is not None:
+                    return dict(found, is_executed=True, details='')
+            if operation == CAPTURE:
+                return client.capture(txn_id)
+            return client.void(txn_id)
+        elif operation == REFUND:
+            if attempts:
+                # Previous attempt may have reached CardPay
+                found = bulk.find_refund(client, txn_id,
+                                         int(created * 1000) - _CLOCK_SKEW,
+                                         amount=params['amount'])
+                if found is not None:
+                    return dict(found, is_executed=True, details='')
+            return client.refund(txn_id, params['reason'],
+                                 amount=params['amount'])
+        elif operation == PAYOUT:
+            if attempts:
+                found = bulk.find_payout(client, txn_id)
+                if found is not None:
+                    return found
+            return client.payouts(params['data'],
+                                  card_token=params['card_token'])
+        raise ValueError('Unknown operation: {}'.format(operation))
+
+    def dispatch(self):
+        """Executes one batch of due operations.
+
+        :returns: int -- Number of executed operations
+        """
+        rows = self._claim(time.time())
+        results = bulk.imap_unordered(self._execute, rows, self.max_in_flight)
+        for row, result, exc in results:
+            seq, attempts = row[0], row[4] + 1
+            now = time.time()
+            if exc is None:
+                # Payouts rejected by CardPay or by local validation
+                state = FAILED if 'errors' in result else DONE
+                update = (state, attempts, 0,
+                          json.dumps(result, default=str), now, seq)
+            elif isinstance(exc, PyCardPayException) and \
+                    attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                update = (PENDING, attempts, now + delay, None, now, seq)
+            else:
+                logger.error('Outbox operation %s failed', seq, exc_info=exc)
+                update = (FAILED, attempts, 0,
+                          json.dumps({'error': str(exc)}), now, seq)
+            # Written right away, a crash doesn't send finished operations again
+            with self._db_lock, self._db:
+                self._db.execute(
+                    'UPDATE outbox SET state = ?, attempts = ?, '
+                    'next_attempt = ?, result = ?, updated = ? WHERE seq = ?',
+                    update
+                )
+        return len(rows)
+
+    def _dispatch_loop(self):
+        while not self._stop.is_set():
+            try:
+                executed = self.dispatch()
+            except Exception:
+                logger.exception('Outbox dispatcher failed')
+                executed = 0
+            if not executed:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+    def start(self):
+        """Starts group-commit writer and dispatcher threads"""
+        if self._threads:
+            return
+        self._stop.clear()
+        for target, name in [(self._write_loop, 'writer'),
+                             (self._dispatch_loop, 'dispatcher')]:
+            thread = threading.Thread(target=target,
+                                      name='PyCardPay-outbox-' + name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stops background threads; pending operations stay in the outbox"""
+        self._stop.set()
+        self._wakeup.set()
+        with self._writes_lock:
+            self._has_writes.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
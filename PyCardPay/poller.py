@@ -0,0 +1,236 @@
+# coding=utf-8
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from . import api
+from .exceptions import PyCardPayException, StatusTimeout, TransactionNotFound
+from .store import KINDS
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    __slots__ = ('id', 'future', 'since', 'next_check', 'backoff',
+                 'deadline', 'last')
+
+    def __init__(self, id, future, since, next_check, backoff, deadline):
+        self.id = id
+        self.future = future
+        self.since = since
+        self.next_check = next_check
+        self.backoff = backoff
+        self.deadline = deadline
+        # Last seen non-final row or status data
+        self.last = None
+
+
+class StatusPoller:
+    """Waits for many pending transactions to reach a final state.
+
+    All registered ids are checked together: each tick makes one list scan
+    covering the creation time of every pending transaction, and only ids
+    the scan didn't find are checked one by one with the status endpoint,
+    at most *max_status_calls* per tick and with exponential backoff per id.
+
+    :param client: Client providing credentials, wallet and settings
+    :type client: :class:`PyCardPay.CardPay`
+    :param kind: (optional) One of 'payments', 'refunds', 'payouts'
+    :type kind: str
+    :param interval: (optional) Seconds between ticks of the background thread
+    :type interval: int|float
+    :param final_states: (optional) States that resolve a transaction
+    :type final_states: set
+    :param lookback: (optional) Milliseconds scanned before registration when creation time is unknown
+    :type lookback: int
+    :param max_status_calls: (optional) Status requests allowed per tick
+    :type max_status_calls: int
+    :param min_backoff: (optional) Seconds before an id missing in scans is checked again
+    :type min_backoff: int|float
+    :param max_backoff: (optional) Upper limit of per id backoff in seconds
+    :type max_backoff: int|float
+    :param timeout: (optional) Seconds after registration the future of a
+        transaction that isn't final fails with :class:`PyCardPay.exceptions.StatusTimeout`,
+        ``None`` waits forever
+    :type timeout: int|float
+    :param max_scan: (optional) Longest period scanned with list requests in
+        milliseconds; older transactions are only checked one by one
+    :type max_scan: int
+
+    Usage example:
+
+    >>> poller = StatusPoller(client, 'payments')
+    >>> poller.start()
+    >>> future = poller.register(order['id'])
+    >>> future.result(timeout=600)['state']
+    'COMPLETED'
+    """
+
+    def __init__(self, client, kind='payments', interval=5,
+                 final_states=api.FINAL_STATES, lookback=60 * 60 * 1000,
+                 max_status_calls=10, min_backoff=5, max_backoff=300,
+                 timeout=60 * 60, max_scan=24 * 60 * 60 * 1000):
+        if kind not in KINDS:
+            raise ValueError('Unknown transaction kind: {}'.format(kind))
+        self.client = client
+        self.kind = kind
+        self.interval = interval
+        self.final_states = final_states
+        self.lookback = lookback
+        self.max_status_calls = max_status_calls
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.max_scan = max_scan
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def register(self, id, callback=None, created_millis=None, timeout=None):
+        """Starts waiting for transaction *id*.
+
+        :param id: Transaction id
+        :type id: int|str
+        :param callback: (optional) Called with the transaction dict once it is final
+        :type callback: callable
+        :param created_millis: (optional) Epoch time in milliseconds the transaction was created
+        :type created_millis: int
+        :param timeout: (optional) Seconds to wait, *timeout* of the poller by default
+        :type timeout: int|float
+        :returns: :class:`concurrent.futures.Future` resolving to the list row
+            or status ``data`` dict of the transaction
+        """
+        id = str(id)
+        now = time.time()
+        if created_millis is None:
+            created_millis = int(now * 1000) - self.lookback
+        if timeout is None:
+            timeout = self.timeout
+        deadline = now + timeout if timeout is not None else float('inf')
+        with self._lock:
+            pending = self._pending.get(id)
+            if pending is None or pending.future.done():
+                pending = _Pending(id, Future(), created_millis,
+                                   now + self.min_backoff, self.min_backoff,
+                                   deadline)
+                self._pending[id] = pending
+        if callback is not None:
+            def done(future):
+                if not future.cancelled() and future.exception() is None:
+                    callback(future.result())
+            pending.future.add_done_callback(done)
+        return pending.future
+
+    def _resolve(self, id, data=None, exc=None):
+        with self._lock:
+            pending = self._pending.pop(id, None)
+        if pending is None or pending.future.done():
+            return
+        if exc is not None:
+            pending.future.set_exception(exc)
+        else:
+            pending.future.set_result(data)
+
+    def tick(self, now=None):
+        """Checks all pending transactions once.
+
+        :param now: (optional) Epoch time in seconds
+        :type now: float
+        :returns: int -- Number of transactions still pending
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            for id in [id for id, p in self._pending.items()
+                       if p.future.cancelled()]:
+                del self._pending[id]
+            expired = [p for p in self._pending.values() if p.deadline <= now]
+        for p in expired:
+            self._resolve(p.id, exc=StatusTimeout(
+                'Transaction {} did not reach a final state in time'.format(
+                    p.id), p.last))
+        with self._lock:
+            pending = dict(self._pending)
+        if not pending:
+            return 0
+
+        client = self.client
+        base_url = getattr(client.settings, KINDS[self.kind])
+        found = set()
+        try:
+            end = int(now * 1000) + 1
+            start = max(min(p.since for p in pending.values()),
+                        end - self.max_scan)
+            rows = api._iter_list(
+                base_url, client.client_login, client.client_password,
+                start, end, wallet_id=client.wallet_id,
+                transport=client.transport
+            )
+            for row in rows:
+                id = str(row.get('id'))
+                if id not in pending:
+                    continue
+                found.add(id)
+                if row.get('state') in self.final_states:
+                    self._resolve(id, row)
+                else:
+                    pending[id].last = row
+        except PyCardPayException:
+            # Scan failed, fall back to per id checks for this tick
+            pass
+
+        due = sorted(
+            (p for id, p in pending.items()
+             if id not in found and p.next_check <= now),
+            key=lambda p: p.next_check
+        )
+        for p in due[:self.max_status_calls]:
+            try:
+                r = api._status(base_url, p.id, client.client_login,
+                                client.client_password,
+                                transport=client.transport)
+            except TransactionNotFound:
+                r = None
+            except PyCardPayException as exc:
+                r = None
+                if p.backoff >= self.max_backoff:
+                    self._resolve(p.id, exc=exc)
+                    continue
+            data = (r or {}).get('data') or {}
+            if data.get('state') in self.final_states:
+                self._resolve(p.id, data)
+            else:
+                if data:
+                    p.last = data
+                p.backoff = min(p.backoff * 2, self.max_backoff)
+                p.next_check = now + p.backoff
+        return len(self._pending)
+
+    def start(self):
+        """Starts the background thread calling :meth:`tick` every *interval* seconds"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='PyCardPay-StatusPoller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the background thread. Pending futures stay unresolved."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Status poller tick failed')
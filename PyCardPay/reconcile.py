@@ -0,0 +1,468 @@
+# coding=utf-8
+"""Reconciliation of payments with their refunds and payouts.
+
+:class:`Reconciler` joins refunds to their original payments by
+``originalOrderId`` and payouts to payments with the same merchant order
+number, using hash indexes: every row is looked up once, whatever order the
+rows come in. Only a small record per payment is kept in memory, refunds and
+payouts are folded into it as they arrive, so millions of rows can be
+streamed from list iterators or a :class:`PyCardPay.store.TransactionStore`.
+
+Amounts are summed in integer minor units of their currency (see
+:func:`PyCardPay.currencies.to_minor`), so totals are exact.
+
+Net amount of an order is::
+
+    captured - refunded - charged_back - paid_out
+
+where *captured* is the payment amount if its state is one of
+:data:`SETTLED_STATES`, *charged_back* its amount if it's 'CHARGED_BACK',
+and refunds and payouts count when they are 'COMPLETED'.
+
+Mismatches flagged:
+
+* ``orphan_refund`` -- refund whose payment wasn't seen
+* ``currency_mismatch`` -- refund currency differs from the payment currency
+* ``over_refunded`` -- refunds and chargebacks exceed the captured amount
+* ``refunded_amount_mismatch`` -- payment ``refundedAmount`` differs from the sum of its refunds
+* ``refund_not_captured`` -- completed refund of a payment that wasn't captured
+* ``invalid_amount`` -- amount isn't a number, has too many decimal places or unknown currency
+
+Refunds may be made long after the payment; fetch payments for a longer
+period than refunds, or their refunds are reported as orphans.
+
+Usage example:
+
+>>> from PyCardPay.reconcile import Reconciler
+>>> reconciler = Reconciler()
+>>> reconciler.fetch(client, start_millis, end_millis, payments_start=start_millis - 180 * DAY)
+>>> for mismatch in reconciler.mismatches():
+...     print(mismatch)
+{'type': 'over_refunded', 'kind': 'payments', 'id': '108006', 'payment_id': '108006',
+ 'wallet_id': 1, 'detail': 'refunded 2000 of 1000 minor units'}
+>>> reconciler.totals()
+{(1, 'EUR'): {'orders': 5120, 'captured': 51234500, 'refunded': 120000,
+              'charged_back': 0, 'paid_out': 0, 'net': 51114500}, ...}
+"""
+
+import itertools
+import operator
+
+from . import api
+from .currencies import to_minor
+from .store import KINDS
+
+# Payment states in which the payment amount was captured
+SETTLED_STATES = ('COMPLETED', 'REFUNDED', 'CHARGED_BACK')
+
+# State of refunds and payouts that moved money
+COMPLETED = 'COMPLETED'
+
+ORPHAN_REFUND = 'orphan_refund'
+CURRENCY_MISMATCH = 'currency_mismatch'
+OVER_REFUNDED = 'over_refunded'
+REFUNDED_AMOUNT_MISMATCH = 'refunded_amount_mismatch'
+REFUND_NOT_CAPTURED = 'refund_not_captured'
+INVALID_AMOUNT = 'invalid_amount'
+
+_TOTALS = ('captured', 'refunded', 'charged_back', 'paid_out', 'net')
+
+
+def _minor(amount, currency):
+    """Returns *amount* in minor units or ``None`` if it's invalid"""
+    try:
+        return to_minor(amount, currency)
+    except (KeyError, ValueError, TypeError, AttributeError):
+        return None
+
+
+class _Payment:
+    """Payment with sums of its refunds and payouts"""
+
+    __slots__ = ('number', 'wallet_id', 'currency', 'state', 'amount',
+                 'reported_refunded', 'refunded', 'paid_out', 'refunds',
+                 'payouts', 'flags')
+
+    def __init__(self):
+        self.refunded = 0
+        self.paid_out = 0
+        self.refunds = 0
+        self.payouts = 0
+        # [(type, kind, id, detail), ...] of rows joined to the payment
+        self.flags = None
+
+    def flag(self, type, kind, id, detail):
+        if self.flags is None:
+            self.flags = []
+        self.flags.append((type, kind, id, detail))
+
+
+class Reconciler:
+    """Joins refunds and payouts to payments and computes net amounts.
+
+    Rows can be added in any order and in any number of calls. Refunds and
+    payouts seen again (e.g. from overlapping periods) are skipped by id,
+    payments seen again are updated.
+
+    :param settled_states: (optional) Payment states in which the amount was captured
+    :type settled_states: tuple
+    """
+
+    def __init__(self, settled_states=SETTLED_STATES):
+        self.settled_states = frozenset(settled_states)
+        # payment id -> _Payment
+        self._payments = {}
+        # (wallet id, merchant order number) -> payment id
+        self._numbers = {}
+        # Refunds and payouts of payments not seen yet: payment id, or
+        # (wallet id, number) of refunds without originalOrderId ->
+        # [(refund id, wallet id, currency, amount, state), ...]
+        self._pending_refunds = {}
+        # (wallet id, number) -> [(payout id, currency, amount, state), ...]
+        self._pending_payouts = {}
+        self._refund_ids = set()
+        self._payout_ids = set()
+        # Rows not joined to any payment: [(type, kind, id, wallet id, detail), ...]
+        self._errors = []
+        # Repeated strings, e.g. states and currencies, are kept once
+        self._strings = {}
+
+    def _intern(self, value):
+        return self._strings.setdefault(value, value)
+
+    # Input
+
+    def add_payments(self, rows, wallet_id=None):
+        """Adds payment rows, see :func:`PyCardPay.api.list_payments`
+
+        :param rows: Payments
+        :type rows: iterable of dicts
+        :param wallet_id: (optional) Wallet the rows belong to
+        :type wallet_id: int
+        :returns: int -- Number of added rows
+        """
+        payments = self._payments
+        count = 0
+        for row in rows:
+            id = str(row['id'])
+            payment = payments.get(id)
+            if payment is None:
+                payment = payments[id] = _Payment()
+                number = row.get('number')
+                if number is not None:
+                    self._numbers[(wallet_id, number)] = id
+            elif payment.flags is not None:
+                # Seen again, the latest state wins
+                payment.flags = [flag for flag in payment.flags
+                                 if flag[1] != 'payments'] or None
+            currency = (row.get('currency') or '').upper()
+            payment.number = row.get('number')
+            payment.wallet_id = wallet_id
+            payment.currency = self._intern(currency)
+            payment.state = self._intern(row.get('state'))
+            payment.amount = _minor(row.get('amount'), currency)
+            if payment.amount is None:
+                payment.flag(INVALID_AMOUNT, 'payments', id,
+                             'invalid amount {!r} {}'.format(row.get('amount'),
+                                                             currency))
+            reported = row.get('refundedAmount')
+            payment.reported_refunded = None
+            if reported is not None:
+                payment.reported_refunded = _minor(reported, currency)
+            for key in (id, (wallet_id, payment.number)):
+                pending = self._pending_refunds.pop(key, None)
+                if pending is not None:
+                    for refund in pending:
+                        self._join_refund(payment, *refund)
+            pending = self._pending_payouts.pop((wallet_id, payment.number),
+                                                None)
+            if pending is not None:
+                for payout in pending:
+                    self._join_payout(payment, *payout)
+            count += 1
+        return count
+
+    def add_refunds(self, rows, wallet_id=None):
+        """Adds refund rows, see :func:`PyCardPay.api.list_refunds`
+
+        :returns: int -- Number of added rows
+        """
+        payments = self._payments
+        seen = self._refund_ids
+        count = 0
+        for row in rows:
+            id = str(row['id'])
+            if id in seen:
+                continue
+            seen.add(id)
+            currency = self._intern((row.get('currency') or '').upper())
+            state = self._intern(row.get('state'))
+            amount = _minor(row.get('amount'), currency)
+            refund = (id, wallet_id, currency, amount, state)
+            payment_id = row.get('originalOrderId')
+            if payment_id is not None:
+                key = payment_id = str(payment_id)
+            elif row.get('number') is not None:
+                # Without originalOrderId the merchant order number is used
+                key = (wallet_id, row['number'])
+                payment_id = self._numbers.get(key)
+            else:
+                self._errors.append((ORPHAN_REFUND, 'refunds', id, wallet_id,
+                                     'refund references no payment'))
+                count += 1
+                continue
+            payment = payments.get(payment_id)
+            if payment is not None:
+                self._join_refund(payment, *refund)
+            else:
+                self._pending_refunds.setdefault(key, []).append(refund)
+            count += 1
+        return count
+
+    def add_payouts(self, rows, wallet_id=None):
+        """Adds payout rows, see :func:`PyCardPay.api.list_payouts`.
+
+        Payouts are joined to the payment with the same merchant order
+        number; payouts without one only count in :meth:`totals`.
+
+        :returns: int -- Number of added rows
+        """
+        seen = self._payout_ids
+        count = 0
+        for row in rows:
+            id = str(row['id'])
+            if id in seen:
+                continue
+            seen.add(id)
+            currency = self._intern((row.get('currency') or '').upper())
+            payout = (id, currency, _minor(row.get('amount'), currency),
+                      self._intern(row.get('state')))
+            key = (wallet_id, row.get('number'))
+            payment_id = self._numbers.get(key)
+            if payment_id is not None:
+                self._join_payout(self._payments[payment_id], *payout)
+            else:
+                self._pending_payouts.setdefault(key, []).append(payout)
+            count += 1
+        return count
+
+    def add_store(self, store, wallet_id=None, start_millis=None,
+                  end_millis=None, payments_start=None):
+        """Adds rows of a local store, see :meth:`PyCardPay.store.TransactionStore.iter_rows`
+
+        :param payments_start: (optional) Start of the payments period, *start_millis* by default
+        :type payments_start: int
+        :returns: dict -- Number of added rows per kind
+        """
+        if payments_start is None:
+            payments_start = start_millis
+        result = {}
+        for kind, start in (('payments', payments_start),
+                            ('refunds', start_millis),
+                            ('payouts', start_millis)):
+            add = getattr(self, 'add_' + kind)
+            result[kind] = 0
+            rows = store.iter_rows(kind, wallet_id, start, end_millis)
+            for row_wallet_id, group in itertools.groupby(
+                    rows, key=operator.itemgetter(0)):
+                result[kind] += add((row for _, row in group), row_wallet_id)
+        return result
+
+    def fetch(self, client, start_millis, end_millis, payments_start=None,
+              max_count=None):
+        """Adds rows of a period fetched with list requests of *client*.
+
+        :param client: Client providing credentials, wallet and settings
+        :type client: :class:`PyCardPay.CardPay`
+        :param payments_start: (optional) Start of the payments period, *start_millis* by default
+        :type payments_start: int
+        :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+        :returns: dict -- Number of added rows per kind
+        """
+        if payments_start is None:
+            payments_start = start_millis
+        result = {}
+        for kind, start in (('payments', payments_start),
+                            ('refunds', start_millis),
+                            ('payouts', start_millis)):
+            rows = api._iter_list(
+                getattr(client.settings, KINDS[kind]), client.client_login,
+                client.client_password, start, end_millis,
+                wallet_id=client.wallet_id, max_count=max_count,
+                transport=client.transport
+            )
+            result[kind] = getattr(self, 'add_' + kind)(rows, client.wallet_id)
+        return result
+
+    # Joins
+
+    def _join_refund(self, payment, id, wallet_id, currency, amount, state):
+        payment.refunds += 1
+        if amount is None:
+            payment.flag(INVALID_AMOUNT, 'refunds', id, 'invalid amount')
+            return
+        if currency != payment.currency:
+            payment.flag(CURRENCY_MISMATCH, 'refunds', id,
+                         'refund in {}, payment in {}'.format(
+                             currency, payment.currency))
+            return
+        if state == COMPLETED:
+            payment.refunded += amount
+
+    def _join_payout(self, payment, id, currency, amount, state):
+        payment.payouts += 1
+        if amount is None:
+            payment.flag(INVALID_AMOUNT, 'payouts', id, 'invalid amount')
+            return
+        if currency != payment.currency:
+            payment.flag(CURRENCY_MISMATCH, 'payouts', id,
+                         'payout in {}, payment in {}'.format(
+                             currency, payment.currency))
+            return
+        if state == COMPLETED:
+            payment.paid_out += amount
+
+    # Output
+
+    def _captured(self, payment):
+        """Returns captured and charged back amounts of *payment*"""
+        if payment.amount is None or \
+                payment.state not in self.settled_states:
+            return 0, 0
+        if payment.state == 'CHARGED_BACK':
+            return payment.amount, payment.amount
+        return payment.amount, 0
+
+    def _balance(self, id, payment):
+        captured, charged_back = self._captured(payment)
+        mismatches = [{'type': type, 'kind': kind, 'id': row_id,
+                       'payment_id': id, 'wallet_id': payment.wallet_id,
+                       'detail': detail}
+                      for type, kind, row_id, detail in payment.flags or ()]
+
+        def mismatch(type, detail):
+            mismatches.append({'type': type, 'kind': 'payments', 'id': id,
+                               'payment_id': id,
+                               'wallet_id': payment.wallet_id,
+                               'detail': detail})
+
+        if payment.refunded and payment.state not in self.settled_states:
+            mismatch(REFUND_NOT_CAPTURED, 'refunded {} of payment in state {}'
+                     .format(payment.refunded, payment.state))
+        elif payment.refunded + charged_back > captured:
+            mismatch(OVER_REFUNDED, 'refunded {} of {} minor units'.format(
+                payment.refunded + charged_back, captured))
+        if payment.reported_refunded is not None and \
+                payment.reported_refunded != payment.refunded:
+            mismatch(REFUNDED_AMOUNT_MISMATCH,
+                     'refundedAmount is {}, refunds sum to {} minor units'
+                     .format(payment.reported_refunded, payment.refunded))
+        return {
+            'id': id,
+            'number': payment.number,
+            'wallet_id': payment.wallet_id,
+            'currency': payment.currency,
+            'state': payment.state,
+            'amount': payment.amount,
+            'captured': captured,
+            'refunded': payment.refunded,
+            'charged_back': charged_back,
+            'paid_out': payment.paid_out,
+            'net': captured - payment.refunded - charged_back -
+            payment.paid_out,
+            'refunds': payment.refunds,
+            'payouts': payment.payouts,
+            'mismatches': mismatches,
+        }
+
+    def orders(self, mismatched_only=False):
+        """Iterates over reconciled payments; amounts are in minor units of *currency*.
+
+        :param mismatched_only: (optional) Yield only payments with mismatches
+        :type mismatched_only: bool
+        :returns: iterator of dicts
+
+        Dict structure:
+
+        >>> {
+            'id': '108006', 'number': 'order00008005', 'wallet_id': 1,
+            'currency': 'GBP', 'state': 'REFUNDED', 'amount': 71353,
+            'captured': 71353, 'refunded': 71353, 'charged_back': 0,
+            'paid_out': 0, 'net': 0, 'refunds': 1, 'payouts': 0,
+            'mismatches': [],   # see :meth:`mismatches`
+        }
+        """
+        for id, payment in self._payments.items():
+            balance = self._balance(id, payment)
+            if balance['mismatches'] or not mismatched_only:
+                yield balance
+
+    def mismatches(self):
+        """Iterates over all mismatches.
+
+        :returns: iterator of dicts -- ``{'type', 'kind', 'id', 'payment_id',
+            'wallet_id', 'detail'}``; *kind* and *id* are of the mismatched row,
+            *payment_id* is ``None`` for orphan refunds without originalOrderId
+        """
+        for balance in self.orders(mismatched_only=True):
+            for mismatch in balance['mismatches']:
+                yield mismatch
+        for type, kind, id, wallet_id, detail in self._errors:
+            yield {'type': type, 'kind': kind, 'id': id, 'payment_id': None,
+                   'wallet_id': wallet_id, 'detail': detail}
+        for key, refunds in self._pending_refunds.items():
+            if isinstance(key, tuple):
+                payment_id = None
+                detail = 'payment with number {} not found'.format(key[1])
+            else:
+                payment_id = key
+                detail = 'payment {} not found'.format(key)
+            for id, wallet_id, currency, amount, state in refunds:
+                yield {'type': ORPHAN_REFUND, 'kind': 'refunds', 'id': id,
+                       'payment_id': payment_id, 'wallet_id': wallet_id,
+                       'detail': detail}
+
+    def totals(self):
+        """Returns sums per wallet and currency in minor units.
+
+        Completed payouts not joined to any payment count in *paid_out* and
+        *net* too; orphan refunds don't count.
+
+        :returns: dict -- ``{(wallet_id, currency): {'orders', 'captured',
+            'refunded', 'charged_back', 'paid_out', 'net'}}``
+        """
+        result = {}
+
+        def totals(key):
+            sums = result.get(key)
+            if sums is None:
+                sums = result[key] = dict.fromkeys(('orders',) + _TOTALS, 0)
+            return sums
+
+        # Summed as lists first, it's the hot loop
+        lists = {}
+        for payment in self._payments.values():
+            key = (payment.wallet_id, payment.currency)
+            sums = lists.get(key)
+            if sums is None:
+                sums = lists[key] = [0] * 5
+            captured, charged_back = self._captured(payment)
+            sums[0] += 1
+            sums[1] += captured
+            sums[2] += payment.refunded
+            sums[3] += charged_back
+            sums[4] += payment.paid_out
+        for key, (orders, captured, refunded, charged_back, paid_out) in \
+                lists.items():
+            result[key] = {
+                'orders': orders, 'captured': captured, 'refunded': refunded,
+                'charged_back': charged_back, 'paid_out': paid_out,
+                'net': captured - refunded - charged_back - paid_out,
+            }
+        for (wallet_id, number), payouts in self._pending_payouts.items():
+            for id, currency, amount, state in payouts:
+                if amount is not None and state == COMPLETED:
+                    sums = totals((wallet_id, currency))
+                    sums['paid_out'] += amount
+                    sums['net'] -= amount
+        return result
@@ -0,0 +1,59 @@
+# coding=utf-8
+"""Removal of credentials and card data from request payloads.
+
+Used wherever payloads leave the library: hook events, spans and errors.
+"""
+
+REDACTED = '***'
+
+# Keys whose values are replaced with REDACTED at any depth
+SENSITIVE_KEYS = frozenset([
+    'client_password', 'client_login', 'password', 'secret', 'cvv',
+    'cardToken', 'card_token',
+])
+
+# Keys holding signed payloads that may contain card data
+_SUMMARIZED_KEYS = frozenset(['orderXML'])
+
+_CARD_KEYS = frozenset(['card'])
+_PAN_KEYS = frozenset(['number', 'num'])
+
+
+class Redacted(dict):
+    """Dict returned by :func:`redact`, passed through unchanged when redacted again"""
+    __slots__ = ()
+
+
+def mask_pan(number):
+    """Masks card number leaving the BIN and last four digits, e.g. '400000...0002'"""
+    digits = ''.join(c for c in str(number) if c.isdigit())
+    if len(digits) < 12:
+        return REDACTED
+    return '{}...{}'.format(digits[:6], digits[-4:])
+
+
+def redact(data, _card=False):
+    """Returns copy of *data* without credentials, signed XML and full card numbers.
+
+    :param data: Request parameters or JSON payload
+    :type data: dict|list
+    :returns: Redacted copy (:class:`Redacted` for dicts); other values and
+        already redacted dicts are returned as is
+    """
+    if isinstance(data, Redacted):
+        return data
+    if isinstance(data, dict):
+        result = Redacted()
+        for key, value in data.items():
+            if key in SENSITIVE_KEYS:
+                result[key] = REDACTED
+            elif key in _SUMMARIZED_KEYS and value is not None:
+                result[key] = '<{} bytes>'.format(len(value))
+            elif _card and key in _PAN_KEYS:
+                result[key] = mask_pan(value)
+            else:
+                result[key] = redact(value, key in _CARD_KEYS)
+        return result
+    if isinstance(data, (list, tuple)):
+        return [redact(value, _card) for value in data]
+    return data
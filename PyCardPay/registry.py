@@ -0,0 +1,199 @@
+# coding=utf-8
+
+import threading
+import time
+
+from . import bulk
+from .cache import StatusCache
+from .cardpay import CardPay
+
+
+class Limiter:
+    """Limits concurrency and, optionally, rate of requests.
+
+    Used as a context manager around a request.
+
+    :param max_concurrent: Maximum number of requests running at once
+    :type max_concurrent: int
+    :param rate: (optional) Maximum number of requests started per second
+    :type rate: int|float
+    :param burst: (optional) Maximum number of requests started at once after
+        idle time, at least 1; ``max(1, rate)`` by default
+    :type burst: int|float
+    """
+
+    def __init__(self, max_concurrent=bulk.DEFAULT_MAX_IN_FLIGHT, rate=None,
+                 burst=None):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        # A bucket smaller than one token would never allow a request
+        self.burst = max(1.0, float(burst if burst is not None else rate or 0))
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._tokens = self.burst if rate else 0.0
+        self._updated = time.time()
+
+    def _take_token(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        if self.rate:
+            self._take_token()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._semaphore.release()
+
+
+class CardPayRegistry:
+    """Many merchant wallets sharing one connection pool, limiter and cache.
+
+    All clients of the process already reuse the pooled default transport
+    (see :func:`PyCardPay.transport.get_transport`); the registry adds a common
+    :class:`Limiter` for calls routed through it and a common
+    :class:`PyCardPay.cache.StatusCache`.
+
+    :param limiter: (optional) Limiter shared by all wallets
+    :type limiter: :class:`Limiter`
+    :param status_cache: (optional) Status cache shared by all wallets
+    :type status_cache: :class:`PyCardPay.cache.StatusCache`
+    :param \*\*defaults: Default :class:`PyCardPay.CardPay` keyword arguments, e.g. ``test=True``
+
+    Usage example:
+
+    >>> registry = CardPayRegistry(test=True)
+    >>> registry.add(123, 'secret', 'login', 'password')
+    >>> registry.add(456, 'secret2', 'login2', 'password2')
+    >>> registry.call(123, 'capture', 1001)
+    {'is_executed': True, 'details': ''}
+    >>> report = registry.list_payments(start_millis, end_millis)
+    >>> report['data'][0]['walletId']
+    456
+    """
+
+    def __init__(self, limiter=None, status_cache=None, **defaults):
+        self.limiter = limiter if limiter is not None else Limiter()
+        self.status_cache = status_cache if status_cache is not None \
+            else StatusCache()
+        self.defaults = defaults
+        self._clients = {}
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        return iter(list(self._clients.values()))
+
+    def __contains__(self, wallet_id):
+        return wallet_id in self._clients
+
+    def __getitem__(self, wallet_id):
+        return self._clients[wallet_id]
+
+    def add(self, wallet_id, secret, client_login, client_password,
+            **kwargs):
+        """Creates and registers client of wallet *wallet_id*.
+
+        Takes :class:`PyCardPay.CardPay` parameters.
+
+        :returns: :class:`PyCardPay.CardPay`
+        """
+        options = dict(self.defaults, status_cache=self.status_cache)
+        options.update(kwargs)
+        client = CardPay(wallet_id, secret, client_login, client_password,
+                         **options)
+        self._clients[wallet_id] = client
+        return client
+
+    def remove(self, wallet_id):
+        return self._clients.pop(wallet_id)
+
+    def call(self, wallet_id, method, *args, **kwargs):
+        """Calls :class:`PyCardPay.CardPay` *method* of wallet *wallet_id* under the limiter.
+
+        :raises: KeyError if wallet is not registered
+        """
+        client = self._clients[wallet_id]
+        with self.limiter:
+            return getattr(client, method)(*args, **kwargs)
+
+    def fan_out(self, method, *args, **kwargs):
+        """Calls *method* of every wallet concurrently.
+
+        :returns: iterator of ``(wallet_id, result, exception)`` tuples as calls complete
+        """
+        def call(client):
+            with self.limiter:
+                return getattr(client, method)(*args, **kwargs)
+
+        results = bulk.imap_unordered(call, list(self._clients.values()),
+                                      self.limiter.max_concurrent)
+        for client, result, exc in results:
+            yield client.wallet_id, result, exc
+
+    def _list(self, method, start_millis, end_millis, max_count, stream):
+        results = self.fan_out(method, start_millis, end_millis,
+                               max_count=max_count)
+        if stream:
+            return results
+        merged = {'data': [], 'hasMore': False, 'errors': {}}
+        for wallet_id, result, exc in results:
+            if exc is not None:
+                merged['errors'][wallet_id] = exc
+                continue
+            for row in result.get('data') or []:
+                row['walletId'] = wallet_id
+                merged['data'].append(row)
+            merged['hasMore'] = merged['hasMore'] or bool(result.get('hasMore'))
+        merged['data'].sort(key=lambda row: row.get('date') or 0)
+        return merged
+
+    def list_payments(self, start_millis, end_millis, max_count=None,
+                      stream=False):
+        """Get the list of orders of all wallets concurrently.
+
+        :param start_millis: Epoch time in milliseconds when requested period starts (inclusive)
+        :type start_millis: int
+        :param end_millis: Epoch time in milliseconds when requested period ends (not inclusive)
+        :type end_millis: int
+        :param max_count: (optional) Limit number of returned orders per wallet
+        :type max_count: int
+        :param stream: (optional) Yield ``(wallet_id, result, exception)`` tuples as wallets complete
+        :type stream: bool
+        :returns: dict
+
+        Return dict structure:
+
+        >>> {
+            'data': [...],          # Rows of all wallets ordered by date, see PyCardPay.api.list_payments;
+                                    # 'walletId' is added to each row
+            'hasMore': False,       # True if any wallet has more orders
+            'errors': {},           # wallet_id -> exception of failed wallets
+        }
+        """
+        return self._list('list_payments', start_millis, end_millis,
+                          max_count, stream)
+
+    def list_refunds(self, start_millis, end_millis, max_count=None,
+                     stream=False):
+        """Get the list of refunds of all wallets concurrently, see :meth:`list_payments`"""
+        return self._list('list_refunds', start_millis, end_millis,
+                          max_count, stream)
+
+    def list_payouts(self, start_millis, end_millis, max_count=None,
+                     stream=False):
+        """Get the list of payouts of all wallets concurrently, see :meth:`list_payments`"""
+        return self._list('list_payouts', start_millis, end_millis,
+                          max_count, stream)
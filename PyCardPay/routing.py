@@ -0,0 +1,245 @@
+# coding=utf-8
+"""Latency-aware routing of requests across equivalent CardPay endpoints.
+
+:class:`RoutingTransport` takes several :class:`PyCardPay.settings.Settings`,
+e.g. regional endpoints or proxies, and sends every request to the URL of
+its operation that currently scores best. The score of a URL is the moving
+average of its latency, raised by its moving average error rate
+(connection errors and 5xx responses). URLs failing several times in a row
+are evicted for a while; when all of them are evicted the one coming back
+first is used.
+
+A request whose connection couldn't be established is sent to the next URL.
+GET requests are also repeated after other connection errors; other methods
+aren't, as CardPay may have received them.
+
+Usage example:
+
+>>> from PyCardPay.routing import RoutingTransport
+>>> from PyCardPay.settings import live_settings, base_url_settings
+>>> router = RoutingTransport([
+...     live_settings, base_url_settings('https://cardpay-proxy.example.com/MI')])
+>>> client = CardPay(..., settings=router.settings, transport=router)
+"""
+
+import logging
+import random
+import socket
+import threading
+import time
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+from .exceptions import CommunicationError
+from .transport import (
+    Transport, KEEPALIVE_IDLE, get_transport, resolve, urllib3, requests,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Latency in seconds assumed for URLs that were tried but never answered,
+# worse than any measured one
+UNANSWERED_LATENCY = 60.0
+
+
+class Endpoint:
+    """Health of one URL.
+
+    :ivar url: Operation URL
+    :ivar latency: Moving average latency in seconds, ``None`` until the first response;
+        scored as :data:`UNANSWERED_LATENCY` once a request has failed
+    :ivar error_rate: Moving average share of failed requests
+    :ivar failures: Failed requests in a row
+    :ivar evicted_until: Time the URL is skipped until
+    :ivar requests: Number of sent requests
+    """
+
+    __slots__ = ('url', 'latency', 'error_rate', 'failures', 'evicted_until',
+                 'requests')
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.evicted_until = 0
+        self.requests = 0
+
+    def score(self, error_penalty):
+        if self.requests == 0:
+            # Never tried, tried first
+            return 0
+        latency = self.latency
+        if latency is None:
+            # Only failed so far
+            latency = UNANSWERED_LATENCY
+        return latency * (1 + error_penalty * self.error_rate)
+
+
+def _connect_failed(exc):
+    """Checks whether HTTP library exception *exc* happened before the request was sent"""
+    seen = 0
+    while exc is not None and seen < 5:
+        if isinstance(exc, (urllib3.exceptions.NewConnectionError,
+                            urllib3.exceptions.ConnectTimeoutError,
+                            requests.exceptions.ConnectTimeout)):
+            return True
+        seen += 1
+        exc = getattr(exc, 'reason', None) or \
+            (exc.args[0] if exc.args and isinstance(exc.args[0], Exception)
+             else None)
+    return False
+
+
+class RoutingTransport(Transport):
+    """Transport routing every request to the best of equivalent URLs.
+
+    :param settings: Equivalent service URLs, requests are made to URLs of the first one
+    :type settings: list of :class:`PyCardPay.settings.Settings`
+    :param transport: (optional) Transport requests are sent with, the default one if not set
+    :type transport: :class:`PyCardPay.transport.Transport`
+    :param alpha: (optional) Weight of the newest sample in moving averages
+    :type alpha: float
+    :param error_penalty: (optional) Score of a URL failing every request, relative to one that never fails
+    :type error_penalty: int|float
+    :param max_failures: (optional) Failed requests in a row before a URL is evicted
+    :type max_failures: int
+    :param eviction: (optional) Seconds an evicted URL is skipped
+    :type eviction: int|float
+    :param explore: (optional) Share of requests sent to a random URL, so scores of others stay fresh
+    :type explore: float
+    :param seed: (optional) Seed of the random generator used by *explore*
+    """
+
+    def __init__(self, settings, transport=None, alpha=0.2, error_penalty=10,
+                 max_failures=3, eviction=30, explore=0.05, seed=None):
+        settings = list(settings)
+        if not settings:
+            raise ValueError('At least one Settings is required')
+        self.settings = settings[0]
+        self.transport = transport
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.max_failures = max_failures
+        self.eviction = eviction
+        self.explore = explore
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # (URL of the first settings, [Endpoint, ...]), longest URL first
+        routes = {}
+        for field in self.settings._fields:
+            urls = []
+            for item in settings:
+                url = getattr(item, field)
+                if url not in urls:
+                    urls.append(url)
+            routes[urls[0]] = [Endpoint(url) for url in urls]
+        self.routes = sorted(routes.items(), key=lambda item: -len(item[0]))
+
+    def _route(self, url):
+        for prefix, endpoints in self.routes:
+            if url.startswith(prefix):
+                return prefix, endpoints
+        return None, None
+
+    def _candidates(self, endpoints):
+        """Returns *endpoints* in order they are tried"""
+        now = time.time()
+        with self._lock:
+            available = [e for e in endpoints if e.evicted_until <= now]
+            if not available:
+                return sorted(endpoints, key=lambda e: e.evicted_until)
+            available.sort(key=lambda e: e.score(self.error_penalty))
+            if len(available) > 1 and self._random.random() < self.explore:
+                available.insert(0, available.pop(
+                    self._random.randrange(1, len(available))))
+            return available
+
+    def _record(self, endpoint, latency=None, failed=False):
+        alpha = self.alpha
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.error_rate += alpha * ((1.0 if failed else 0.0) -
+                                            endpoint.error_rate)
+            if latency is not None:
+                endpoint.latency = latency if endpoint.latency is None \
+                    else endpoint.latency + alpha * (latency - endpoint.latency)
+            if not failed:
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.max_failures:
+                endpoint.failures = 0
+                endpoint.evicted_until = time.time() + self.eviction
+
+    def request(self, method, url, params=None, data=None, json=None,
+                auth=None, timeout=None):
+        transport = get_transport(self.transport)
+        prefix, endpoints = self._route(url)
+        if prefix is None:
+            return transport.request(method, url, params=params, data=data,
+                                     json=json, auth=auth, timeout=timeout)
+        candidates = self._candidates(endpoints)
+        for n, endpoint in enumerate(candidates):
+            started = time.perf_counter()
+            try:
+                r = transport.request(method, endpoint.url + url[len(prefix):],
+                                      params=params, data=data, json=json,
+                                      auth=auth, timeout=timeout)
+            except CommunicationError as exc:
+                self._record(endpoint, failed=True)
+                if n + 1 < len(candidates) and \
+                        (method == 'GET' or _connect_failed(exc.exc)):
+                    continue
+                raise
+            self._record(endpoint, time.perf_counter() - started,
+                         r.status_code >= 500)
+            return r
+
+    def warmup(self, url, connections=1, keepalive=KEEPALIVE_IDLE):
+        """Warms up connections to the hosts of all URLs equivalent to the
+        ones at the host of *url*; hosts that can't be reached are logged and skipped
+        """
+        origin = urlsplit(url)[:2]
+        hosts = {}
+        for prefix, endpoints in self.routes:
+            if urlsplit(prefix)[:2] != origin:
+                continue
+            for endpoint in endpoints:
+                parts = urlsplit(endpoint.url)
+                hosts[parts[:2]] = parts.hostname
+        transport = get_transport(self.transport)
+        opened = 0
+        for (scheme, netloc), hostname in sorted(hosts.items()):
+            try:
+                if (scheme, netloc) != origin:
+                    resolve(hostname)
+                opened += transport.warmup('{}://{}/'.format(scheme, netloc),
+                                           connections, keepalive)
+            except (socket.error, CommunicationError) as exc:
+                logger.warning('Failed to warm up connections to %s://%s: %s',
+                               scheme, netloc, exc)
+        return opened
+
+    def stats(self):
+        """Returns health of all URLs.
+
+        :returns: dict -- ``{URL of the first settings: [{'url', 'latency',
+            'error_rate', 'evicted', 'requests'}, ...]}`` in the order of *settings*
+        """
+        now = time.time()
+        with self._lock:
+            return dict(
+                (prefix, [{'url': e.url, 'latency': e.latency,
+                           'error_rate': e.error_rate,
+                           'evicted': e.evicted_until > now,
+                           'requests': e.requests} for e in endpoints])
+                for prefix, endpoints in self.routes
+            )
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
@@ -14,6 +14,19 @@ Settings = namedtuple(
 )
 
 
+def base_url_settings(url):
+    """Returns :class:`Settings` of a CardPay deployment at *url*, e.g. 'https://sandbox.cardpay.com/MI'"""
+    url = url.rstrip('/')
+    return Settings(
+        url_pay=url + '/cardpayment.html',
+        url_status=url + '/service/order-report',
+        url_status_change=url + '/service/order-change-status',
+        url_payouts=url + '/api/v2/payouts',
+        url_payments=url + '/api/v2/payments',
+        url_refunds=url + '/api/v2/refunds',
+    )
+
+
 test_settings = Settings(
     url_pay='https://sandbox.cardpay.com/MI/cardpayment.html',
     url_status='https://sandbox.cardpay.com/MI/service/order-report',
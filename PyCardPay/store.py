@@ -0,0 +1,346 @@
+# coding=utf-8
+
+import json
+import sqlite3
+import threading
+import time
+
+from . import api
+
+
+# Kind of transaction -> name of Settings field with its list/status URL
+KINDS = {
+    'payments': 'url_payments',
+    'refunds': 'url_refunds',
+    'payouts': 'url_payouts',
+}
+
+# Default time (in milliseconds) fetched again behind the watermark, so state
+# changes of recent transactions are picked up by incremental sync.
+DEFAULT_OVERLAP = 24 * 60 * 60 * 1000
+
+# States a transaction never leaves; rows in other states are only current
+# while their date is inside the overlap re-fetched by every sync
+SETTLED_STATES = frozenset([
+    'DECLINED', 'CANCELLED', 'VOIDED', 'REFUNDED', 'CHARGEBACK_RESOLVED',
+])
+
+# Settled states per kind: completed refunds and payouts don't change either,
+# completed payments can still be refunded or charged back
+KIND_SETTLED_STATES = {
+    'payments': SETTLED_STATES,
+    'refunds': SETTLED_STATES | frozenset(['COMPLETED']),
+    'payouts': SETTLED_STATES | frozenset(['COMPLETED']),
+}
+
+# How far back (in milliseconds) the first sync of an empty store reaches
+DEFAULT_INITIAL_PERIOD = 30 * 24 * 60 * 60 * 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    number TEXT,
+    customer_id TEXT,
+    state TEXT,
+    date INTEGER,
+    wallet_id INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (kind, id)
+);
+CREATE INDEX IF NOT EXISTS transactions_number
+    ON transactions (kind, number);
+CREATE INDEX IF NOT EXISTS transactions_customer_id
+    ON transactions (kind, customer_id);
+CREATE INDEX IF NOT EXISTS transactions_state
+    ON transactions (kind, state);
+CREATE INDEX IF NOT EXISTS transactions_date
+    ON transactions (kind, date);
+CREATE TABLE IF NOT EXISTS watermarks (
+    kind TEXT NOT NULL,
+    wallet_id INTEGER NOT NULL,
+    millis INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (kind, wallet_id)
+);
+"""
+
+_UPSERT = """
+INSERT INTO transactions
+    (kind, id, number, customer_id, state, date, wallet_id, data)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (kind, id) DO UPDATE SET
+    number = excluded.number,
+    customer_id = excluded.customer_id,
+    state = excluded.state,
+    date = excluded.date,
+    wallet_id = excluded.wallet_id,
+    data = excluded.data
+WHERE transactions.data != excluded.data
+"""
+
+
+def _now_millis():
+    return int(time.time() * 1000)
+
+
+class TransactionStore:
+    """Local SQLite mirror of payments, refunds and payouts.
+
+    Rows are the dicts returned by list endpoints (see
+    :func:`PyCardPay.api.list_payments`), indexed by id, merchant number,
+    customer id, state and date.
+
+    :param path: Database file name, ``':memory:'`` for a private in-memory store
+    :type path: str|unicode
+    :param overlap: (optional) Milliseconds behind the watermark re-fetched on every sync
+    :type overlap: int
+    :param initial_period: (optional) Milliseconds fetched by the first sync of an empty store
+    :type initial_period: int
+
+    Usage example:
+
+    >>> store = TransactionStore('/var/lib/myshop/cardpay.sqlite')
+    >>> client = CardPay(..., store=store)
+    >>> store.sync(client)
+    {'payments': 12, 'refunds': 0, 'payouts': 3}
+    >>> store.find_by_number('order00017')
+    [{'id': '299150', 'number': 'order00017', 'state': 'COMPLETED', ...}]
+    """
+
+    def __init__(self, path, overlap=DEFAULT_OVERLAP,
+                 initial_period=DEFAULT_INITIAL_PERIOD):
+        self.path = path
+        self.overlap = overlap
+        self.initial_period = initial_period
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def watermark(self, kind, wallet_id=None):
+        """Returns ``(millis, synced_at)`` of the last sync or ``None``
+
+        :param kind: One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param wallet_id: (optional) Wallet the sync was limited to
+        :type wallet_id: int
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT millis, synced_at FROM watermarks '
+                'WHERE kind = ? AND wallet_id = ?',
+                (kind, wallet_id or 0)
+            ).fetchone()
+        return row
+
+    def is_fresh(self, kind, max_age, wallet_id=None):
+        """Checks whether *kind* was synced less than *max_age* seconds ago.
+
+        :param kind: One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param max_age: Maximum age of the last sync in seconds
+        :type max_age: int|float
+        :param wallet_id: (optional) Wallet the sync was limited to
+        :type wallet_id: int
+        :returns: bool
+        """
+        mark = self.watermark(kind, wallet_id)
+        return mark is not None and time.time() - mark[1] <= max_age
+
+    def upsert(self, kind, rows, wallet_id=None):
+        """Stores list rows. Rows that didn't change are left untouched.
+
+        :param kind: One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param rows: Rows as returned by list endpoints
+        :type rows: iterable of dicts
+        :param wallet_id: (optional) Wallet the rows belong to
+        :type wallet_id: int
+        :returns: int -- Number of inserted or changed rows
+        """
+        if kind not in KINDS:
+            raise ValueError('Unknown transaction kind: {}'.format(kind))
+        params = (
+            (kind, str(row['id']), row.get('number'), row.get('customerId'),
+             row.get('state'), row.get('date'), wallet_id,
+             json.dumps(row, sort_keys=True, default=str))
+            for row in rows
+        )
+        with self._lock, self._db:
+            before = self._db.total_changes
+            self._db.executemany(_UPSERT, params)
+            return self._db.total_changes - before
+
+    def sync(self, client, kinds=None, now=None):
+        """Fetches transactions newer than the stored watermark.
+
+        Each kind is fetched from ``watermark - overlap`` up to *now*, so
+        recent transactions whose state has changed are updated too.
+
+        :param client: Client providing credentials, wallet and settings
+        :type client: :class:`PyCardPay.CardPay`
+        :param kinds: (optional) Kinds to sync, all by default
+        :type kinds: list
+        :param now: (optional) Epoch time in milliseconds to sync up to
+        :type now: int
+        :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+        :returns: dict -- Number of inserted or changed rows per kind
+        """
+        wallet_id = client.wallet_id
+        result = {}
+        for kind in kinds or sorted(KINDS):
+            end = now if now is not None else _now_millis()
+            mark = self.watermark(kind, wallet_id)
+            if mark is None:
+                start = end - self.initial_period
+            else:
+                start = min(mark[0], end) - self.overlap
+            newest = mark[0] if mark is not None else start
+            changed = 0
+            batch = []
+            rows = api._iter_list(
+                getattr(client.settings, KINDS[kind]), client.client_login,
+                client.client_password, start, end, wallet_id=wallet_id,
+                transport=client.transport
+            )
+            for row in rows:
+                if row.get('date') is not None:
+                    newest = max(newest, int(row['date']))
+                batch.append(row)
+                if len(batch) >= 1000:
+                    changed += self.upsert(kind, batch, wallet_id)
+                    batch = []
+            changed += self.upsert(kind, batch, wallet_id)
+            with self._lock, self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO watermarks '
+                    '(kind, wallet_id, millis, synced_at) VALUES (?, ?, ?, ?)',
+                    (kind, wallet_id or 0, newest, time.time())
+                )
+            result[kind] = changed
+        return result
+
+    def _select(self, where, params, limit=None):
+        sql = 'SELECT data FROM transactions WHERE ' + where + \
+            ' ORDER BY date DESC'
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def get(self, kind, id, wallet_id=None):
+        """Returns stored row of transaction *id* or ``None``
+
+        :param kind: One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param id: Transaction id
+        :type id: int|str
+        :param wallet_id: (optional) Limit result with single WebSite orders
+        :type wallet_id: int
+        """
+        if wallet_id is None:
+            rows = self._select('kind = ? AND id = ?', (kind, str(id)))
+        else:
+            rows = self._select('kind = ? AND id = ? AND wallet_id = ?',
+                                (kind, str(id), wallet_id))
+        return rows[0] if rows else None
+
+    def find_by_number(self, number, kind='payments', wallet_id=None):
+        """Returns stored rows with merchant order *number*
+
+        :param number: Merchant order number
+        :type number: str|unicode
+        :param kind: (optional) One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param wallet_id: (optional) Limit result with single WebSite orders
+        :type wallet_id: int
+        :returns: list
+        """
+        if wallet_id is None:
+            return self._select('kind = ? AND number = ?', (kind, number))
+        return self._select('kind = ? AND number = ? AND wallet_id = ?',
+                            (kind, number, wallet_id))
+
+    def find_by_customer(self, customer_id, kind='payments', limit=None):
+        """Returns stored rows of customer *customer_id*, newest first"""
+        return self._select('kind = ? AND customer_id = ?',
+                            (kind, customer_id), limit=limit)
+
+    def find_by_state(self, state, kind='payments', limit=None):
+        """Returns stored rows in *state*, newest first"""
+        return self._select('kind = ? AND state = ?', (kind, state),
+                            limit=limit)
+
+    def find_by_date(self, start_millis, end_millis, kind='payments',
+                     limit=None):
+        """Returns stored rows with date in ``[start_millis, end_millis)``"""
+        return self._select('kind = ? AND date >= ? AND date < ?',
+                            (kind, start_millis, end_millis), limit=limit)
+
+    def iter_rows(self, kind, wallet_id=None, start_millis=None,
+                  end_millis=None, batch_size=1000):
+        """Iterates over stored rows oldest first, *batch_size* rows are loaded at a time
+
+        :param kind: One of 'payments', 'refunds', 'payouts'
+        :type kind: str
+        :param wallet_id: (optional) Limit result with single WebSite orders
+        :type wallet_id: int
+        :param start_millis: (optional) Epoch time in milliseconds rows start at (inclusive)
+        :type start_millis: int
+        :param end_millis: (optional) Epoch time in milliseconds rows end at (not inclusive)
+        :type end_millis: int
+        :returns: iterator of ``(wallet_id, row)`` tuples
+        """
+        where = 'kind = ?'
+        params = [kind]
+        if wallet_id is not None:
+            where += ' AND wallet_id = ?'
+            params.append(wallet_id)
+        if start_millis is not None:
+            where += ' AND date >= ?'
+            params.append(start_millis)
+        if end_millis is not None:
+            where += ' AND date < ?'
+            params.append(end_millis)
+        with self._lock:
+            cursor = self._db.execute(
+                'SELECT wallet_id, data FROM transactions WHERE ' + where +
+                ' ORDER BY date', params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row_wallet_id, data in rows:
+                yield row_wallet_id, json.loads(data)
+
+    def current_rows(self, kind, rows, max_age, wallet_id=None):
+        """Checks whether stored *rows* reflect the state at the last sync.
+
+        Sync re-fetches only rows created inside the overlap before the
+        watermark, so later changes of older rows (e.g. refunds and
+        chargebacks of completed payments) never reach the store. Such rows
+        are current only in one of :data:`SETTLED_STATES` (or 'COMPLETED'
+        for refunds and payouts).
+
+        :param max_age: Maximum age of the last sync in seconds
+        :type max_age: int|float
+        :returns: bool -- ``False`` also if the store isn't fresh
+        """
+        mark = self.watermark(kind, wallet_id)
+        if mark is None or time.time() - mark[1] > max_age:
+            return False
+        since = mark[0] - self.overlap
+        settled = KIND_SETTLED_STATES.get(kind, SETTLED_STATES)
+        return all(row.get('state') in settled or
+                   (row.get('date') is not None and int(row['date']) >= since)
+                   for row in rows)
@@ -0,0 +1,179 @@
+# coding=utf-8
+
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+from . import api
+from .store import KINDS
+
+
+logger = logging.getLogger(__name__)
+
+# Default time (in milliseconds) re-scanned behind the watermark on each poll
+DEFAULT_OVERLAP = 15 * 60 * 1000
+
+Change = namedtuple('Change', ['kind', 'type', 'row'])
+Change.__doc__ = """Transaction change emitted by :class:`Tailer`.
+
+*type* is ``'insert'`` for a transaction seen for the first time and
+``'update'`` when its state has changed. *row* is the dict returned by the
+list endpoint (see :func:`PyCardPay.api.list_payments`).
+"""
+
+
+def _digest(row):
+    return zlib.crc32((row.get('state') or '').encode('utf-8'))
+
+
+class Tailer:
+    """Change feed over list endpoints.
+
+    Every *interval* seconds the period from ``watermark - overlap`` up to now
+    is fetched and only new transactions and state transitions are emitted.
+    Per id only the transaction date and a CRC32 of its state are kept, and
+    ids that fall behind the overlap window are forgotten, so memory is
+    bounded by the number of transactions inside the window. Ids inside the
+    window are never dropped, forgetting them would emit them again as
+    inserts.
+
+    :param client: Client providing credentials, wallet and settings
+    :type client: :class:`PyCardPay.CardPay`
+    :param kind: (optional) One of 'payments', 'refunds', 'payouts'
+    :type kind: str
+    :param interval: (optional) Seconds between polls
+    :type interval: int|float
+    :param overlap: (optional) Milliseconds re-scanned behind the watermark
+    :type overlap: int
+    :param start_millis: (optional) Where to start when there is no checkpoint, now by default
+    :type start_millis: int
+    :param checkpoint: (optional) File the watermark and seen states are saved to after each poll
+    :type checkpoint: str|unicode
+    :param max_tracked: (optional) Number of remembered ids above which a warning is
+        logged, suggesting a shorter *overlap*
+    :type max_tracked: int
+
+    Usage example:
+
+    >>> tailer = Tailer(client, 'payments', checkpoint='/var/lib/myshop/payments.tail')
+    >>> for change in tailer:
+    ...     print(change.type, change.row['id'], change.row['state'])
+
+    or from a coroutine:
+
+    >>> async for change in tailer:
+    ...     await handle(change)
+    """
+
+    def __init__(self, client, kind='payments', interval=30,
+                 overlap=DEFAULT_OVERLAP, start_millis=None, checkpoint=None,
+                 max_tracked=100000):
+        if kind not in KINDS:
+            raise ValueError('Unknown transaction kind: {}'.format(kind))
+        self.client = client
+        self.kind = kind
+        self.interval = interval
+        self.overlap = overlap
+        self.checkpoint = checkpoint
+        self.max_tracked = max_tracked
+        self.watermark = start_millis
+        # id -> (date, state digest), oldest first
+        self._seen = OrderedDict()
+        self._warned = False
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self._load()
+        if self.watermark is None:
+            self.watermark = int(time.time() * 1000)
+
+    def _load(self):
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.watermark = state['watermark']
+        self._seen = OrderedDict(
+            (id, tuple(value)) for id, value in state['seen']
+        )
+
+    def save(self):
+        """Writes watermark and seen states to the checkpoint file atomically"""
+        if self.checkpoint is None:
+            return
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'watermark': self.watermark,
+                       'seen': list(self._seen.items())}, f,
+                      separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint)
+
+    def poll(self, now=None):
+        """Fetches one window and returns changes since the previous poll.
+
+        Seen states are updated immediately but not saved; call :meth:`save`
+        once the changes are handled.
+
+        :param now: (optional) Epoch time in milliseconds to fetch up to
+        :type now: int
+        :raises: :class:`PyCardPay.exceptions.HTTPError`, :class:`PyCardPay.exceptions.JSONParsingError`
+        :returns: list of :class:`Change`
+        """
+        client = self.client
+        end = now if now is not None else int(time.time() * 1000)
+        start = self.watermark - self.overlap
+        rows = api._iter_list(
+            getattr(client.settings, KINDS[self.kind]), client.client_login,
+            client.client_password, start, end, wallet_id=client.wallet_id,
+            transport=client.transport
+        )
+        changes = []
+        watermark = self.watermark
+        seen = self._seen
+        for row in rows:
+            id = str(row['id'])
+            date = row.get('date') or watermark
+            digest = _digest(row)
+            previous = seen.pop(id, None)
+            seen[id] = (date, digest)
+            if previous is None:
+                changes.append(Change(self.kind, 'insert', row))
+            elif previous[1] != digest:
+                changes.append(Change(self.kind, 'update', row))
+            watermark = max(watermark, date)
+        self.watermark = watermark
+        self._forget(watermark - self.overlap)
+        return changes
+
+    def _forget(self, before):
+        seen = self._seen
+        stale = [id for id, (date, _) in seen.items() if date < before]
+        for id in stale:
+            del seen[id]
+        if len(seen) > self.max_tracked and not self._warned:
+            self._warned = True
+            logger.warning('%d %s ids inside the overlap window are tracked, '
+                           'more than max_tracked=%d', len(seen), self.kind,
+                           self.max_tracked)
+
+    def __iter__(self):
+        while True:
+            started = time.time()
+            for change in self.poll():
+                yield change
+            self.save()
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            changes = await loop.run_in_executor(None, self.poll)
+            for change in changes:
+                yield change
+            await loop.run_in_executor(None, self.save)
+            await asyncio.sleep(
+                max(0, self.interval - (loop.time() - started))
+            )
@@ -0,0 +1,430 @@
+# coding=utf-8
+
+import base64
+import json
+import socket
+import threading
+import time
+try:
+    from urllib import urlencode
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlencode, urlsplit
+
+from .exceptions import CommunicationError
+from .lazy import LazyModule
+
+
+requests = LazyModule('requests')
+urllib3 = LazyModule('urllib3')
+
+# Maximum number of kept-alive connections per host
+POOL_SIZE = 32
+
+# Seconds a connection is idle before TCP keep-alive probes are sent
+KEEPALIVE_IDLE = 30
+
+# Seconds addresses of hosts resolved with resolve() are reused
+DNS_TTL = 300
+
+# host -> (address, expiry time) of hosts resolved with resolve()
+_addresses = {}
+
+
+class Response:
+    """HTTP response returned by transports.
+
+    :ivar status_code: HTTP status code
+    :ivar headers: Response headers (case-insensitive mapping)
+    :ivar content: Response body
+    :ivar url: Requested URL including query string
+    :ivar connect: Seconds spent opening a new connection, ``None`` if a pooled one was reused
+    :ivar ttfb: Seconds from sending the request to receiving response headers
+    :ivar download: Seconds spent reading the response body
+    :ivar sent: Size of the request body in bytes
+    """
+
+    __slots__ = ('status_code', 'headers', 'content', 'url', 'connect',
+                 'ttfb', 'download', 'sent')
+
+    def __init__(self, status_code, headers, content, url, connect=None,
+                 ttfb=0.0, download=0.0, sent=0):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+        self.connect = connect
+        self.ttfb = ttfb
+        self.download = download
+        self.sent = sent
+
+    def __repr__(self):
+        return '<Response [{}]>'.format(self.status_code)
+
+
+def _full_url(url, params):
+    if not params:
+        return url
+    return url + ('&' if '?' in url else '?') + urlencode(params)
+
+
+_connect_times = threading.local()
+
+
+def resolve(host):
+    """Resolves *host* and caches its address for new connections.
+
+    The address is refreshed once :data:`DNS_TTL` seconds passed; it's
+    forgotten when connecting to it fails.
+
+    :raises: :class:`socket.gaierror` if *host* can't be resolved
+    :returns: str -- IP address
+    """
+    address = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)[0][4][0]
+    _addresses[host] = (address, time.time() + DNS_TTL)
+    return address
+
+
+def _cached_address(host):
+    entry = _addresses.get(host)
+    if entry is None:
+        return None
+    if entry[1] <= time.time():
+        try:
+            return resolve(host)
+        except socket.gaierror:
+            _addresses.pop(host, None)
+            return None
+    return entry[0]
+
+
+def _timed_connection(base):
+    class TimedConnection(base):
+        def connect(self):
+            started = time.perf_counter()
+            base.connect(self)
+            _connect_times.value = time.perf_counter() - started
+
+        def _new_conn(self):
+            host = self._dns_host
+            address = _cached_address(host)
+            if address is None:
+                return base._new_conn(self)
+            # host property reads _dns_host, restored before TLS uses it
+            self._dns_host = address
+            try:
+                return base._new_conn(self)
+            except urllib3.exceptions.NewConnectionError:
+                _addresses.pop(host, None)
+            finally:
+                self._dns_host = host
+            return base._new_conn(self)
+    TimedConnection.__name__ = 'Timed' + base.__name__
+    return TimedConnection
+
+
+def _time_connects(pool_manager):
+    """Makes connections of *pool_manager* record how long connecting took
+    and use addresses cached by :func:`resolve`
+    """
+    pools = urllib3.connectionpool
+    pool_manager.pool_classes_by_scheme = {
+        'http': type('TimedHTTPConnectionPool', (pools.HTTPConnectionPool,), {
+            'ConnectionCls': _timed_connection(
+                pools.HTTPConnectionPool.ConnectionCls)}),
+        'https': type('TimedHTTPSConnectionPool', (pools.HTTPSConnectionPool,), {
+            'ConnectionCls': _timed_connection(
+                pools.HTTPSConnectionPool.ConnectionCls)}),
+    }
+
+
+def _take_connect_time():
+    value = getattr(_connect_times, 'value', None)
+    _connect_times.value = None
+    return value
+
+
+def _keepalive_options(idle):
+    options = list(urllib3.connection.HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle))
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, idle))
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle))
+    return options
+
+
+def _enable_keepalive(pool_manager, idle):
+    """Makes new connections of *pool_manager* send TCP keep-alive probes"""
+    options = _keepalive_options(idle)
+    if pool_manager.connection_pool_kw.get('socket_options') != options:
+        pool_manager.connection_pool_kw['socket_options'] = options
+
+
+def _open_connections(pool, count):
+    """Connects up to *count* connections of *pool* and returns them to it idle"""
+    connections = []
+    try:
+        for _ in range(min(count, pool.pool.maxsize)):
+            connection = pool._get_conn()
+            connections.append(connection)
+            if connection.sock is None:
+                connection.connect()
+    finally:
+        for connection in connections:
+            pool._put_conn(connection)
+        _take_connect_time()
+    return len(connections)
+
+
+class Transport:
+    """Interface of HTTP backends all CardPay requests go through.
+
+    Subclasses implement :meth:`request`; they must raise
+    :class:`PyCardPay.exceptions.CommunicationError` on connection errors and
+    return :class:`Response` for any HTTP status code.
+    """
+
+    def request(self, method, url, params=None, data=None, json=None,
+                auth=None, timeout=None):
+        """Sends HTTP request.
+
+        :param method: HTTP method, e.g. 'GET'
+        :type method: str
+        :param url: Request url
+        :type url: str|unicode
+        :param params: (optional) Query string parameters
+        :type params: dict
+        :param data: (optional) Form fields sent url encoded; ``None`` values are skipped
+        :type data: dict
+        :param json: (optional) Object sent as JSON body
+        :param auth: (optional) ``(login, password)`` for HTTP basic auth
+        :type auth: tuple
+        :param timeout: (optional) Seconds, or ``(connect, read)`` tuple
+        :type timeout: float|tuple
+        :raises: :class:`PyCardPay.exceptions.CommunicationError`
+        :returns: :class:`Response`
+
+        Phase timings of the response are optional; transports that can't
+        measure them leave the defaults.
+        """
+        raise NotImplementedError
+
+    def warmup(self, url, connections=1, keepalive=KEEPALIVE_IDLE):
+        """Opens pooled connections to the host of *url* ahead of requests.
+
+        :param url: Any url of the host
+        :type url: str|unicode
+        :param connections: (optional) Number of connections to open, at most the pool size
+        :type connections: int
+        :param keepalive: (optional) Seconds idle connections wait between TCP keep-alive
+            probes, so middleboxes don't drop them; ``None`` disables probes
+        :type keepalive: int
+        :raises: :class:`PyCardPay.exceptions.CommunicationError`
+        :returns: int -- Number of open pooled connections
+
+        Transports without connection pools don't implement it and return 0.
+        """
+        return 0
+
+    def close(self):
+        """Closes pooled connections"""
+
+
+class RequestsTransport(Transport):
+    """Transport using a pooled :class:`requests.Session`.
+
+    :param pool_size: (optional) Maximum number of kept-alive connections per host
+    :type pool_size: int
+    """
+
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4,
+                                                pool_maxsize=pool_size)
+        _time_connects(adapter.poolmanager)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.session = session
+
+    def request(self, method, url, params=None, data=None, json=None,
+                auth=None, timeout=None):
+        _take_connect_time()
+        started = time.perf_counter()
+        try:
+            r = self.session.request(method, url, params=params, data=data,
+                                     json=json, auth=auth, timeout=timeout,
+                                     verify=True, stream=True)
+            headers_received = time.perf_counter()
+            content = r.content
+        except requests.exceptions.RequestException as exc:
+            raise CommunicationError('Communication error', exc)
+        connect = _take_connect_time()
+        body = r.request.body
+        return Response(r.status_code, r.headers, content, r.url,
+                        connect=connect,
+                        ttfb=headers_received - started - (connect or 0),
+                        download=time.perf_counter() - headers_received,
+                        sent=len(body) if body else 0)
+
+    def warmup(self, url, connections=1, keepalive=KEEPALIVE_IDLE):
+        adapter = self.session.get_adapter(url)
+        if keepalive is not None:
+            _enable_keepalive(adapter.poolmanager, keepalive)
+        try:
+            # Same CA bundle and proxies as requests use, or another pool
+            # would be warmed up
+            options = self.session.merge_environment_settings(
+                url, {}, None, True, None)
+            if hasattr(adapter, 'get_connection_with_tls_context'):
+                pool = adapter.get_connection_with_tls_context(
+                    requests.Request('GET', url).prepare(),
+                    options['verify'], options['proxies'])
+            else:
+                pool = adapter.get_connection(url, options['proxies'])
+            return _open_connections(pool, connections)
+        except (requests.exceptions.RequestException,
+                urllib3.exceptions.HTTPError, OSError) as exc:
+            raise CommunicationError('Communication error', exc)
+
+    def close(self):
+        self.session.close()
+
+
+class Urllib3Transport(Transport):
+    """Lean transport using :class:`urllib3.PoolManager` directly.
+
+    Skips the per request work of requests (sessions, hooks, cookie jars,
+    environment proxies and netrc lookups); requests are otherwise sent the
+    same way. Certificates are verified with certifi's bundle when it's
+    installed, the system store otherwise.
+
+    :param pool_size: (optional) Maximum number of kept-alive connections per host
+    :type pool_size: int
+    :param \*\*pool_kwargs: Extra :class:`urllib3.PoolManager` arguments
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, **pool_kwargs):
+        self.pool_size = pool_size
+        try:
+            import certifi
+            pool_kwargs.setdefault('ca_certs', certifi.where())
+        except ImportError:
+            pass
+        pool_kwargs.setdefault('cert_reqs', 'CERT_REQUIRED')
+        self.pool = urllib3.PoolManager(maxsize=pool_size, retries=False,
+                                        **pool_kwargs)
+        _time_connects(self.pool)
+
+    def request(self, method, url, params=None, data=None, json=None,
+                auth=None, timeout=None):
+        url = _full_url(url, params)
+        headers = {}
+        body = None
+        if data is not None:
+            body = urlencode([(k, v) for k, v in data.items()
+                              if v is not None]).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json is not None:
+            body = _json_dumps(json)
+            headers['Content-Type'] = 'application/json'
+        if auth is not None:
+            headers['Authorization'] = _basic_auth(*auth)
+        if isinstance(timeout, tuple):
+            timeout = urllib3.Timeout(connect=timeout[0], read=timeout[1])
+        elif timeout is None:
+            timeout = urllib3.Timeout(connect=None, read=None)
+        _take_connect_time()
+        started = time.perf_counter()
+        try:
+            r = self.pool.request(method, url, body=body, headers=headers,
+                                  timeout=timeout, preload_content=False)
+            headers_received = time.perf_counter()
+            try:
+                content = r.read()
+            finally:
+                r.release_conn()
+        except urllib3.exceptions.HTTPError as exc:
+            raise CommunicationError('Communication error', exc)
+        connect = _take_connect_time()
+        return Response(r.status, r.headers, content, url, connect=connect,
+                        ttfb=headers_received - started - (connect or 0),
+                        download=time.perf_counter() - headers_received,
+                        sent=len(body) if body else 0)
+
+    def warmup(self, url, connections=1, keepalive=KEEPALIVE_IDLE):
+        if keepalive is not None:
+            _enable_keepalive(self.pool, keepalive)
+        try:
+            return _open_connections(self.pool.connection_from_url(url),
+                                     connections)
+        except (urllib3.exceptions.HTTPError, OSError) as exc:
+            raise CommunicationError('Communication error', exc)
+
+    def close(self):
+        self.pool.clear()
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _basic_auth(login, password):
+    if not isinstance(login, bytes):
+        login = login.encode('latin1')
+    if not isinstance(password, bytes):
+        password = password.encode('latin1')
+    return 'Basic ' + base64.b64encode(login + b':' + password).decode('ascii')
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_transport(transport=None):
+    """Returns *transport* or, if it's ``None``, the default transport.
+
+    The default is a :class:`RequestsTransport` created on first use and
+    shared by the whole process; replace it with :func:`set_transport`.
+    """
+    global _default
+    if transport is not None:
+        return transport
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = RequestsTransport()
+    return _default
+
+
+def send(method, url, transport=None, event=None, **kwargs):
+    """Sends request with :meth:`Transport.request`, reporting it to *event*.
+
+    :param transport: (optional) Transport to use instead of the default one
+    :type transport: :class:`Transport`
+    :param event: (optional) Event of the request, see :func:`PyCardPay.hooks.start`
+    :type event: :class:`PyCardPay.hooks.RequestEvent`
+    :param \*\*kwargs: :meth:`Transport.request` arguments
+    :raises: :class:`PyCardPay.exceptions.CommunicationError`
+    :returns: :class:`Response`
+    """
+    if event is None:
+        return get_transport(transport).request(method, url, **kwargs)
+    event.request_started()
+    try:
+        r = get_transport(transport).request(method, url, **kwargs)
+    except Exception as exc:
+        event.error(exc)
+        raise
+    event.response(r)
+    return r
+
+
+def set_transport(transport):
+    """Replaces the default transport, e.g. ``set_transport(Urllib3Transport())``"""
+    global _default
+    with _default_lock:
+        _default = transport
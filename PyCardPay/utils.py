@@ -5,11 +5,15 @@ import datetime as dt
 import hashlib
 from decimal import Decimal
 
-from lxml import etree
-from lxml.builder import E
-import requests
+from .lazy import LazyModule
+from .exceptions import HTTPError, XMLParsingError
+from . import hooks
+from .transport import send
 
-from .exceptions import HTTPError, XMLParsingError, CommunicationError
+
+# Imported on first use to keep ``import PyCardPay`` fast
+etree = LazyModule('lxml.etree')
+E = LazyModule('lxml.builder', 'E')
 
 
 def order_to_xml(order, items=None, billing=None, shipping=None, card=None,
@@ -221,6 +225,24 @@ def xml_get_sha512(xml, secret):
     return hashlib.sha512(xml_string).hexdigest()
 
 
+def xml_sign(xml, secret):
+    """Serializes xml once and returns it base64 encoded together with its sha512 checksum
+
+    Same as calling :func:`xml_to_string` and :func:`xml_get_sha512`, but
+    the xml is serialized only once.
+
+    :param xml: Order XML
+    :type xml: :class:`lxml.etree.Element`
+    :param secret: Your CardPay secret password.
+    :type secret: bytes
+    :raises: TypeError if passed not an :class:`lxml.etree.Element` as xml parameter.
+    :returns: tuple -- (base64 encoded xml, SHA512)
+    """
+    xml_string = xml_to_string(xml, encode_base64=False)
+    return (base64.standard_b64encode(xml_string),
+            hashlib.sha512(xml_string + secret).hexdigest())
+
+
 def xml_check_sha512(base64_string, sha512, secret):
     """Checks if returned base64 encoded string is encoded  with our secret password.
 
@@ -253,56 +275,95 @@ def parse_response(xml):
         )
 
 
-def make_http_request(url, method='get', http_timeout=None, **kwargs):
+def make_http_request(url, method='get', http_timeout=None, transport=None,
+                      endpoint='other', event=None, **kwargs):
     """Make http get request to *url* passing *kwargs* as arguments
 
     :param url: Request url
     :type url: str|unicode
     :param method: HTTP method
     :type method: str|unicode
+    :param transport: (optional) Transport to use instead of the default one
+    :type transport: :class:`PyCardPay.transport.Transport`
+    :param endpoint: (optional) Endpoint name reported to metrics and hooks, see :mod:`PyCardPay.metrics`
+    :type endpoint: str
+    :param event: (optional) Event of the request finished by the caller after parsing;
+        if not set the request is reported as done once the content is received
+    :type event: :class:`PyCardPay.hooks.RequestEvent`
     :param \*\*kwargs: Request parameters
     :raises: :class:`PyCardPay.exceptions.HTTPError` if server returns status code different from 2xx
+    :raises: :class:`PyCardPay.exceptions.CommunicationError` on connection errors
     :returns: HTML content
     """
-
-    try:
-        try:
-            r = getattr(requests, method)(url, data=kwargs, verify=True,
-                                          timeout=http_timeout)
-        except AttributeError:
-            r = requests.get(url, data=kwargs, verify=True)
-    except requests.exceptions.RequestException as exc:
-        raise CommunicationError('Communication error', exc)
+    owned = event is None
+    if owned:
+        event = hooks.start(endpoint, method.upper(), url, kwargs)
+    r = send(method.upper(), url, transport=transport, event=event,
+             data=kwargs, timeout=http_timeout)
 
     if not (200 <= r.status_code < 300):
-        raise HTTPError(
+        error = HTTPError(
             u'Expected HTTP response code "2xx" but '
             u'received "{}"'.format(r.status_code),
             method=method, url=url, data=kwargs, response=r
         )
+        if event is not None:
+            event.error(error)
+        raise error
+    if owned and event is not None:
+        event.done()
     return r.content
 
 
-def xml_http_request(url, method='get', **kwargs):
+def xml_http_request(url, method='get', transport=None, endpoint='other',
+                     **kwargs):
     """Make http get request to *url* passing *kwargs* as arguments
 
     :param url: Request url
     :type url: str|unicode
     :param method: HTTP method
     :type method: str|unicode
+    :param transport: (optional) Transport to use instead of the default one
+    :type transport: :class:`PyCardPay.transport.Transport`
+    :param endpoint: (optional) Endpoint name reported to metrics and hooks, see :mod:`PyCardPay.metrics`
+    :type endpoint: str
     :param \*\*kwargs: Request parameters
     :raises: :class:`PyCardPay.exceptions.HTTPError` if server returns status code different from 2xx
     :raises: :class:`PyCardPay.exceptions.XMLParsingError` if lxml failed to parse string
     :returns: :class:`lxml.etree.Element`
     """
-    xml = make_http_request(url, method=method, **kwargs)
+    event = hooks.start(endpoint, method.upper(), url, kwargs,
+                        wallet_id=kwargs.get('wallet_id'))
+    xml = make_http_request(url, method=method, transport=transport,
+                            endpoint=endpoint, event=event, **kwargs)
+    return parse_xml_response(xml, event, method=method, url=url,
+                              data=kwargs)
+
+
+def parse_xml_response(xml, event=None, **error_kwargs):
+    """Parses response *xml*, reporting the parse phase to *event*
+
+    :param event: (optional) Event of the request, see :func:`PyCardPay.hooks.start`
+    :type event: :class:`PyCardPay.hooks.RequestEvent`
+    :param \*\*error_kwargs: Request details stored in the raised error
+    :raises: :class:`PyCardPay.exceptions.XMLParsingError` if lxml failed to parse string
+    :returns: :class:`lxml.etree.Element`
+    """
+    if event is not None:
+        event.parsing()
     try:
-        return etree.fromstring(xml)
+        result = etree.fromstring(xml)
     except etree.Error as e:
-        raise XMLParsingError(
+        error = XMLParsingError(
             u'Failed to parse response from CardPay service: {}'.format(e),
-            method=method, url=url, data=kwargs, content=xml
+            content=xml, **error_kwargs
         )
+        if event is not None:
+            event.error(error)
+        raise error
+    if event is not None:
+        event.done()
+    return result
 
 
 def parse_order(xml):
@@ -0,0 +1,246 @@
+# coding=utf-8
+"""Local validation of payout and payment data before anything is sent.
+
+Errors have the structure of CardPay API errors, e.g.::
+
+    {
+        'status': '400',
+        'source': {'pointer': '/data/card/number'},
+        'title': 'Invalid Attribute',
+        'detail': 'invalid credit card number',
+    }
+
+so a payout rejected locally looks the same as one rejected by CardPay.
+Validators only use precompiled patterns and lookup tables; a row takes a
+few microseconds.
+
+:class:`PyCardPay.CardPay` runs them before sending when created with
+``validate=True``.
+
+Usage example:
+
+>>> from PyCardPay import validation
+>>> validation.validate_payout({'merchantOrderId': 'PO1', 'amount': 10, 'currency': 'USD'},
+...                            card={'number': '4000 0000 0000 0001', 'expiryMonth': 7, 'expiryYear': 2030})
+[{'status': '400', 'source': {'pointer': '/data/card/number'}, 'title': 'Invalid Attribute',
+  'detail': 'invalid credit card number'}]
+>>> validation.validate_batch(rows, validation.validate_payout_item)
+[(3, [...]), (17, [...])]
+"""
+
+import datetime as dt
+import re
+from decimal import Decimal, InvalidOperation
+
+from .currencies import EXPONENTS
+
+# Shortest and longest card numbers (ISO/IEC 7812)
+PAN_LENGTHS = (12, 19)
+
+_PAN_SEPARATORS = re.compile(r'[\s-]+')
+_DIGITS = re.compile(r'\d+\Z')
+_CVV = re.compile(r'\d{3,4}\Z')
+_EXPIRES = re.compile(r'(0[1-9]|1[0-2])/(\d{2}|\d{4})\Z')
+_EMAIL = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+\Z')
+# Digit sums of doubled digits
+_DOUBLED = str.maketrans('0123456789', '0246813579')
+
+_ORDER_REQUIRED = ('number', 'amount', 'email')
+_PAYOUT_REQUIRED = ('merchantOrderId', 'amount', 'currency')
+
+
+def _error(pointer, detail, title='Invalid Attribute'):
+    return {'status': '400', 'source': {'pointer': pointer}, 'title': title,
+            'detail': detail}
+
+
+def _missing(pointer):
+    return _error(pointer, 'required attribute is missing',
+                  'Missing Attribute')
+
+
+def normalize_pan(number):
+    """Returns card *number* without spaces and dashes"""
+    return _PAN_SEPARATORS.sub('', str(number))
+
+
+def luhn_valid(digits):
+    """Checks Luhn checksum of string of *digits*"""
+    odd = digits[-1::-2]
+    even = digits[-2::-2].translate(_DOUBLED)
+    return sum(map(int, odd + even)) % 10 == 0
+
+
+def pan_error(number):
+    """Returns description of what's wrong with card *number* or ``None``"""
+    digits = normalize_pan(number)
+    if not _DIGITS.match(digits):
+        return 'card number must contain only digits'
+    if not PAN_LENGTHS[0] <= len(digits) <= PAN_LENGTHS[1]:
+        return 'card number must be {}-{} digits long'.format(*PAN_LENGTHS)
+    if not luhn_valid(digits):
+        return 'invalid credit card number'
+    return None
+
+
+def _today(now):
+    today = now or dt.date.today()
+    return today.year, today.month
+
+
+def _expiry_error(month, year, now):
+    try:
+        month = int(month)
+        year = int(year)
+    except (TypeError, ValueError):
+        return 'card expiration date must be numeric'
+    if not 1 <= month <= 12:
+        return 'card expiration month must be 1-12'
+    if year < 100:
+        year += 2000
+    if (year, month) < _today(now):
+        return 'card is expired'
+    return None
+
+
+def amount_error(amount, currency=None):
+    """Returns description of what's wrong with *amount* in *currency* or ``None``"""
+    if isinstance(amount, bool):
+        return 'amount must be a number'
+    if isinstance(amount, int):
+        return None if amount > 0 else 'amount must be positive'
+    try:
+        value = Decimal(str(amount))
+    except (InvalidOperation, ValueError):
+        return 'amount must be a number'
+    if not value.is_finite() or value <= 0:
+        return 'amount must be positive'
+    digits = EXPONENTS.get(currency.upper()) if currency else None
+    if digits is not None and value.as_tuple().exponent < -digits and \
+            value != value.quantize(Decimal(1).scaleb(-digits)):
+        return 'amount has more than {} decimal places for {}'.format(
+            digits, currency)
+    return None
+
+
+def currency_error(currency):
+    if not isinstance(currency, str) or currency.upper() not in EXPONENTS:
+        return 'unknown ISO 4217 currency code'
+    return None
+
+
+def validate_payout(data, card=None, card_token=None, now=None):
+    """Validates :meth:`PyCardPay.CardPay.payouts` arguments.
+
+    :param now: (optional) Date card expiry is checked against, today by default
+    :type now: :class:`datetime.date`
+    :returns: list -- Errors, empty if arguments are valid
+    """
+    errors = []
+    for key in _PAYOUT_REQUIRED:
+        if data.get(key) in (None, ''):
+            errors.append(_missing('/data/' + key))
+    currency = data.get('currency')
+    if currency is not None:
+        detail = currency_error(currency)
+        if detail is not None:
+            errors.append(_error('/data/currency', detail))
+            currency = None
+    if data.get('amount') is not None:
+        detail = amount_error(data['amount'], currency)
+        if detail is not None:
+            errors.append(_error('/data/amount', detail))
+    if card_token is not None:
+        return errors
+    if not card or card.get('number') in (None, ''):
+        errors.append(_missing('/data/card/number'))
+        return errors
+    detail = pan_error(card['number'])
+    if detail is not None:
+        errors.append(_error('/data/card/number', detail))
+    if card.get('expiryMonth') is not None or \
+            card.get('expiryYear') is not None:
+        detail = _expiry_error(card.get('expiryMonth'),
+                               card.get('expiryYear'), now)
+        if detail is not None:
+            errors.append(_error('/data/card/expiryMonth', detail))
+    return errors
+
+
+def validate_order(order, items=None, card=None, card_token=None, now=None):
+    """Validates :meth:`PyCardPay.CardPay.pay` arguments; pointers start with '/order', '/items' or '/card'.
+
+    :param now: (optional) Date card expiry is checked against, today by default
+    :type now: :class:`datetime.date`
+    :returns: list -- Errors, empty if arguments are valid
+    """
+    errors = []
+    for key in _ORDER_REQUIRED:
+        if order.get(key) in (None, ''):
+            errors.append(_missing('/order/' + key))
+    currency = order.get('currency')
+    if currency:
+        detail = currency_error(currency)
+        if detail is not None:
+            errors.append(_error('/order/currency', detail))
+            currency = None
+    if order.get('amount') is not None:
+        detail = amount_error(order['amount'], currency)
+        if detail is not None:
+            errors.append(_error('/order/amount', detail))
+    email = order.get('email')
+    if email and not _EMAIL.match(email):
+        errors.append(_error('/order/email', 'invalid e-mail address'))
+    for n, item in enumerate(items or ()):
+        if item.get('name') in (None, ''):
+            errors.append(_missing('/items/{}/name'.format(n)))
+    if card:
+        if card_token is None:
+            if card.get('num') in (None, ''):
+                errors.append(_missing('/card/num'))
+            else:
+                detail = pan_error(card['num'])
+                if detail is not None:
+                    errors.append(_error('/card/num', detail))
+            expires = card.get('expires')
+            if expires:
+                match = _EXPIRES.match(expires)
+                detail = _expiry_error(match.group(1), match.group(2), now) \
+                    if match else 'card expiration date must be MM/YY'
+                if detail is not None:
+                    errors.append(_error('/card/expires', detail))
+        cvv = card.get('cvv')
+        if cvv is not None and not _CVV.match(str(cvv)):
+            errors.append(_error('/card/cvv', 'CVV must be 3-4 digits'))
+    return errors
+
+
+def validate_payout_item(item, now=None):
+    """Validates item of :meth:`PyCardPay.CardPay.payouts_many`"""
+    return validate_payout(item.get('data') or {}, card=item.get('card'),
+                           card_token=item.get('card_token'), now=now)
+
+
+def validate_payment_item(item, now=None):
+    """Validates item of :meth:`PyCardPay.CardPay.pay_many`"""
+    return validate_order(item.get('order') or {}, items=item.get('items'),
+                          card=item.get('card'),
+                          card_token=item.get('card_token'), now=now)
+
+
+def validate_batch(items, validator=validate_payout_item, now=None):
+    """Validates many rows with *validator*.
+
+    :param items: Rows, e.g. of :meth:`PyCardPay.CardPay.payouts_many`
+    :type items: iterable
+    :param validator: (optional) :func:`validate_payout_item` or :func:`validate_payment_item`
+    :returns: list of ``(index, errors)`` of invalid rows
+    """
+    if now is None:
+        now = dt.date.today()
+    result = []
+    for n, item in enumerate(items):
+        errors = validator(item, now)
+        if errors:
+            result.append((n, errors))
+    return result
@@ -0,0 +1,92 @@
+# coding=utf-8
+"""Deterministic payloads used by the benchmarks.
+
+Every fixture takes *size*: the number of order items, report rows or list
+rows it contains.
+"""
+
+import base64
+import hashlib
+import json
+
+SECRET = b'benchmark-secret'
+WALLET_ID = 20
+START_MILLIS = 1500000000000
+
+
+def order(n=0):
+    return {
+        'wallet_id': WALLET_ID,
+        'number': 'order{:08d}'.format(n),
+        'description': 'Order {}'.format(n),
+        'currency': 'USD',
+        'amount': '{}.{:02d}'.format(100 + n % 900, n % 100),
+        'customer_id': str(n % 1000),
+        'email': 'customer{}@example.com'.format(n),
+        'note': 'Benchmark order',
+    }
+
+
+def items(size):
+    return [{
+        'name': 'Item {}'.format(n),
+        'description': 'Description of item {}'.format(n),
+        'count': 1 + n % 3,
+        'price': '{}.{:02d}'.format(1 + n % 50, n % 100),
+    } for n in range(size)]
+
+
+def callback_xml(n=0):
+    """Callback order XML as sent by CardPay"""
+    return (
+        u'<?xml version="1.0" encoding="UTF-8"?>\n'
+        u'<order id="{0}" refund_id="-" number="order{0:08d}" '
+        u'status="APPROVED" description="Order {0}" '
+        u'date="15-01-2013 10:30:45" customer_id="{1}" '
+        u'card_bin="400000...0000" card_holder="John Silver" '
+        u'approval_code="DK3H25" is_3d="true" currency="USD" '
+        u'amount="{2}.{3:02d}" note="Benchmark order"/>'
+    ).format(100000 + n, n % 1000, 100 + n % 900, n % 100).encode('utf-8')
+
+
+def callbacks(size):
+    """List of ``(base64 orderXML, sha512)`` callbacks"""
+    result = []
+    for n in range(size):
+        xml = callback_xml(n)
+        result.append((base64.standard_b64encode(xml),
+                       hashlib.sha512(xml + SECRET).hexdigest()))
+    return result
+
+
+def status_report(size):
+    """order-report response with *size* orders"""
+    orders = u''.join(
+        u'<orderu id="{0}" orderu_number="order{0:08d}" '
+        u'status_name="capture_success" date_in="2014-04-28 21:55" '
+        u'amount="{1}" hold_number="{2}" email="customer{0}@example.com"/>'
+        .format(n, 100 + n % 900, hashlib.sha1(str(n).encode()).hexdigest())
+        for n in range(size)
+    )
+    return (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+            u'<response is_executed="yes" details="">'
+            u'<orders>' + orders + u'</orders></response>').encode('utf-8')
+
+
+def list_rows(size, start_millis=START_MILLIS):
+    return [{
+        'id': str(100000 + n),
+        'number': 'order{:08d}'.format(n),
+        'state': 'COMPLETED' if n % 10 else 'DECLINED',
+        'date': start_millis + n * 1000,
+        'customerId': str(n % 1000),
+        'is3d': n % 3 == 0,
+        'currency': 'USD',
+        'amount': '{}.{:02d}'.format(100 + n % 900, n % 100),
+        'email': 'customer{}@example.com'.format(n),
+    } for n in range(size)]
+
+
+def list_response(size):
+    """v2 list response with *size* rows"""
+    return json.dumps({'data': list_rows(size), 'hasMore': False}).encode('utf-8')
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""Import time of PyCardPay entry points.
+
+Every entry point is imported in a fresh interpreter with
+``python -X importtime``; the cumulative time of its top level import and
+whether lxml and requests were loaded is reported as JSON, e.g.::
+
+    python benchmarks/importtime.py --repeat 5 > importtime.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+
+ENTRY_POINTS = {
+    'package': 'import PyCardPay',
+    'CardPay': 'from PyCardPay import CardPay',
+    'parse_callback': (
+        'from PyCardPay import CardPay; import base64, hashlib; '
+        'x = b"<order id=\\"1\\" status=\\"APPROVED\\"/>"; '
+        'CardPay(1, "s", "l", "p").parse_callback('
+        'base64.b64encode(x), hashlib.sha512(x + b"s").hexdigest())'
+    ),
+    'api': 'import PyCardPay.api',
+    'callbacks': 'import PyCardPay.callbacks',
+    'store': 'import PyCardPay.store',
+}
+
+HEAVY_MODULES = ('lxml.etree', 'requests')
+
+
+def measure(code):
+    """Runs *code* with ``-X importtime``, returns stats of the run"""
+    probe = code + '; import sys; print(" ".join(m for m in {!r} ' \
+        'if m in sys.modules))'.format(HEAVY_MODULES)
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', probe],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True
+    )
+    total = 0
+    pycardpay = 0
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            continue
+        name = parts[2].rstrip()
+        # Top level imports are not indented
+        if not name.startswith('  ') and name.strip():
+            total += cumulative
+            if name.strip().startswith('PyCardPay'):
+                pycardpay += cumulative
+    return {
+        'total_us': total,
+        'pycardpay_us': pycardpay,
+        'loaded': proc.stdout.split(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per entry point, the fastest is reported')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, code in sorted(ENTRY_POINTS.items()):
+        runs = [measure(code) for _ in range(args.repeat)]
+        results[name] = min(runs, key=lambda run: run['pycardpay_us'])
+    json.dump({'python': sys.version.split()[0], 'entry_points': results},
+              sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
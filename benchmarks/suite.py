@@ -0,0 +1,250 @@
+# coding=utf-8
+"""Benchmarks of PyCardPay hot paths.
+
+Every benchmark runs at several sizes: the number of order items for XML
+building and signing, the number of orders for report parsing, the number
+of rows for list decoding, and the number of records handled in one batch
+for per-order calls (``sign_order``, ``parse_callback``, ``parse_order``).
+HTTP is replaced with an in-process transport returning fixture payloads, so
+only the library's own work is measured.
+
+The end-to-end section sends requests to :class:`PyCardPay.fakeserver.FakeCardPay`
+over a real socket and reports requests per second.
+
+Results are written as JSON; pass a previous result file with ``--compare``
+to print the change of every benchmark, e.g.::
+
+    python benchmarks/suite.py --output 1.0.0.json
+    python benchmarks/suite.py --compare 1.0.0.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import fixtures                                             # noqa: E402
+from PyCardPay import api, utils                            # noqa: E402
+from PyCardPay.cardpay import CardPay                       # noqa: E402
+from PyCardPay.fakeserver import FakeCardPay                # noqa: E402
+from PyCardPay.settings import test_settings                # noqa: E402
+from PyCardPay.transport import (                           # noqa: E402
+    Transport, Response, Urllib3Transport,
+)
+
+SIZES = (1, 100, 10000)
+
+
+class StubTransport(Transport):
+    """Answers every request with the same payload"""
+
+    def __init__(self, content):
+        self.content = content
+
+    def request(self, method, url, params=None, data=None, json=None,
+                auth=None, timeout=None):
+        return Response(200, {}, self.content, url)
+
+
+def hot_paths(size):
+    """Returns ``{name: callable}`` of benchmarks at *size*"""
+    order = fixtures.order()
+    items = fixtures.items(size)
+    xml = utils.order_to_xml(order, items=items)
+    base64_xml = utils.xml_to_string(xml)
+    sha512 = utils.xml_get_sha512(xml, fixtures.SECRET)
+    client = CardPay(fixtures.WALLET_ID, fixtures.SECRET, 'login', 'password')
+    orders = [fixtures.order(n) for n in range(size)]
+    callbacks = fixtures.callbacks(size)
+    parsed = [utils.etree.fromstring(fixtures.callback_xml(n))
+              for n in range(size)]
+    report = StubTransport(fixtures.status_report(size))
+    rows = StubTransport(fixtures.list_response(size))
+
+    def sign_order():
+        for order in orders:
+            client.sign_order(order)
+
+    def parse_callback():
+        for callback in callbacks:
+            client.parse_callback(*callback)
+
+    def parse_order():
+        for element in parsed:
+            utils.parse_order(element)
+
+    return {
+        'order_to_xml': lambda: utils.order_to_xml(order, items=items),
+        'xml_to_string': lambda: utils.xml_to_string(xml),
+        'xml_get_sha512': lambda: utils.xml_get_sha512(xml, fixtures.SECRET),
+        'xml_check_sha512': lambda: utils.xml_check_sha512(
+            base64_xml, sha512, fixtures.SECRET),
+        'sign_order': sign_order,
+        'parse_callback': parse_callback,
+        'parse_order': parse_order,
+        'status': lambda: api.status(
+            settings=test_settings, transport=report, client_login='login',
+            client_password='password', wallet_id=fixtures.WALLET_ID),
+        '_list': lambda: api._list(
+            test_settings.url_payments, 'login', 'password',
+            fixtures.START_MILLIS, fixtures.START_MILLIS + 1,
+            transport=rows),
+    }
+
+
+def measure(fn, repeat, min_time):
+    """Returns sorted seconds per call of *repeat* runs lasting at least *min_time*"""
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed == 0 else \
+            max(2, min(10, int(min_time / elapsed * 1.2) + 1))
+    timings = [elapsed / loops]
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        timings.append((time.perf_counter() - started) / loops)
+    return sorted(timings), loops
+
+
+def run_hot_paths(sizes, repeat, min_time, only):
+    results = []
+    for size in sizes:
+        for name, fn in sorted(hot_paths(size).items()):
+            if only and name not in only:
+                continue
+            timings, loops = measure(fn, repeat, min_time)
+            best = timings[0]
+            results.append({
+                'name': name,
+                'size': size,
+                'loops': loops,
+                'best': best,
+                'median': timings[len(timings) // 2],
+                'ops_per_sec': 1 / best,
+                'rows_per_sec': size / best,
+            })
+            sys.stderr.write('{:<18} {:>6}  {:>12.1f} us\n'.format(
+                name, size, best * 1e6))
+    return results
+
+
+def run_end_to_end(requests, threads, sizes):
+    server = FakeCardPay(wallets={fixtures.WALLET_ID: (
+        fixtures.SECRET.decode('ascii'), 'login', 'password')},
+        volume=max(sizes) * 2, period=24 * 60 * 60 * 1000, seed=1)
+    settings = server.start()
+    transport = Urllib3Transport()
+    client = CardPay(fixtures.WALLET_ID, fixtures.SECRET, 'login', 'password',
+                     settings=settings, transport=transport)
+    rows = server.rows('payments', fixtures.WALLET_ID)
+    ids = [row['id'] for row in rows]
+    start, end = rows[0]['date'], rows[-1]['date'] + 1
+    calls = {
+        'payments_status': lambda i: client.payments_status(ids[i % len(ids)]),
+        'void': lambda i: client.void(ids[i % len(ids)]),
+        'pay': lambda i: client.pay(fixtures.order(i)),
+    }
+    for size in sizes:
+        calls['list_payments@{}'.format(size)] = \
+            lambda i, size=size: client.list_payments(start, end,
+                                                      max_count=size)
+    results = []
+    try:
+        for name, call in sorted(calls.items()):
+            count = requests if '@' not in name else \
+                max(10, requests * 100 // int(name.split('@')[1]) // 10)
+            for workers in sorted(set([1, threads])):
+                for i in range(workers):
+                    call(i)
+                started = time.perf_counter()
+                if workers == 1:
+                    for i in range(count):
+                        call(i)
+                else:
+                    with ThreadPoolExecutor(workers) as executor:
+                        for _ in executor.map(call, range(count)):
+                            pass
+                rps = count / (time.perf_counter() - started)
+                results.append({'name': name, 'threads': workers,
+                                'requests': count, 'rps': rps})
+                sys.stderr.write('{:<22} {:>3} threads  {:>9.1f} req/s\n'
+                                 .format(name, workers, rps))
+    finally:
+        transport.close()
+        server.stop()
+    return results
+
+
+def compare(results, baseline):
+    """Prints ratio of best timings (hot paths) and rps (end to end) to *baseline*"""
+    def index(data):
+        hot = dict(((r['name'], r['size']), r['best'])
+                   for r in data.get('hot_paths', []))
+        e2e = dict(((r['name'], r['threads']), r['rps'])
+                   for r in data.get('end_to_end', []))
+        return hot, e2e
+
+    hot, e2e = index(results)
+    old_hot, old_e2e = index(baseline)
+    for key in sorted(set(hot) & set(old_hot)):
+        sys.stderr.write('{:<18} {:>6}  {:>+7.1%} time\n'.format(
+            key[0], key[1], hot[key] / old_hot[key] - 1))
+    for key in sorted(set(e2e) & set(old_e2e)):
+        sys.stderr.write('{:<22} {:>3} threads  {:>+7.1%} req/s\n'.format(
+            key[0], key[1], e2e[key] / old_e2e[key] - 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')],
+                        default=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds every timing run lasts at least')
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only this hot path benchmark')
+    parser.add_argument('--no-e2e', action='store_true',
+                        help='skip end-to-end benchmarks')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--output', help='result file, stdout by default')
+    parser.add_argument('--compare', help='previous result file')
+    args = parser.parse_args(argv)
+
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'timestamp': int(time.time()),
+        'hot_paths': run_hot_paths(args.sizes, args.repeat, args.min_time,
+                                   args.only),
+    }
+    if not args.no_e2e:
+        results['end_to_end'] = run_end_to_end(args.requests, args.threads,
+                                               args.sizes)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
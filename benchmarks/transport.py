@@ -0,0 +1,121 @@
+# coding=utf-8
+"""Requests per second of PyCardPay transports.
+
+Every transport sends status requests (``GET`` with basic auth and a JSON
+response, like :func:`PyCardPay.api.payments_status`) to a local HTTP server,
+first one at a time and then from a thread pool; results are reported as
+JSON, e.g.::
+
+    python benchmarks/transport.py --requests 5000 --threads 16 > transport.json
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from PyCardPay.transport import RequestsTransport, Urllib3Transport
+
+
+BODY = json.dumps({
+    'data': {'id': '1001', 'number': '10', 'state': 'COMPLETED',
+             'date': 1500000000000, 'amount': 120, 'currency': 'USD'}
+}).encode('utf-8')
+
+TRANSPORTS = {
+    'requests': RequestsTransport,
+    'urllib3': Urllib3Transport,
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def run(transport, url, requests, threads):
+    """Sends *requests* requests from *threads* threads, returns requests/sec"""
+    auth = ('login', 'password')
+
+    def call(i):
+        r = transport.request('GET', url + str(i), auth=auth, timeout=10)
+        assert r.status_code == 200
+        json.loads(r.content.decode('utf-8'))
+
+    # Opens pooled connections
+    for i in range(threads):
+        call(i)
+    started = time.time()
+    if threads == 1:
+        for i in range(requests):
+            call(i)
+    else:
+        with ThreadPoolExecutor(threads) as executor:
+            for _ in executor.map(call, range(requests)):
+                pass
+    return requests / (time.time() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}/api/payments/'.format(server.server_address[1])
+
+    results = {}
+    try:
+        for name, factory in sorted(TRANSPORTS.items()):
+            stats = {}
+            for mode, threads in [('sequential', 1),
+                                  ('concurrent', args.threads)]:
+                transport = factory()
+                try:
+                    rates = [run(transport, url, args.requests, threads)
+                             for _ in range(args.repeat)]
+                finally:
+                    transport.close()
+                stats[mode] = {'threads': threads,
+                               'rps_best': round(max(rates), 1),
+                               'rps': [round(rate, 1) for rate in rates]}
+            results[name] = stats
+    finally:
+        server.shutdown()
+        server.server_close()
+    json.dump({'python': sys.version.split()[0], 'requests': args.requests,
+               'results': results}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,4 +13,7 @@ setup(
         'lxml',
         'requests',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
 )